@@ -0,0 +1,228 @@
+"""
+Benchmarks of parsing, scoring, rendering and storage round trips on synthetic games.
+COS is replaced by a local S3 stand-in, moto, so no credentials are needed.  USAGE:
+python benchmarks/bench.py run --save results.json
+python benchmarks/bench.py compare baseline.json results.json
+"""
+import click
+import ibm_boto3
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+from bridgepy import *
+from bridgepy.cos import cos_resources
+
+SIZES = [10, 1000, 100000]
+SEED = 0
+LOCAL_API_KEY = "local-api-key"
+LOCAL_INSTANCE_ID = "local-instance-id"
+
+
+def synthetic_hands(count: int, seed: int = SEED) -> List[Result]:
+    "count random hands that can be written as bids, down at most 9"
+    rand = random.Random(seed)
+    hands = []
+    for i in range(count):
+        bid = rand.randint(1, 7)
+        hands.append(
+            Result(
+                rand.choice(list(Team)),
+                bid,
+                rand.choice(list(Suit)),
+                rand.randint(-min(6 + bid, 9), 7 - bid),
+                rand.choice(list(Honors)),
+                rand.choice(list(Double)),
+            )
+        )
+    return hands
+
+
+def bid_str(hand: Result) -> str:
+    "the bid string that bid_parse turns into hand"
+    ret = "wt"[hand.team.value] + str(hand.bid) + hand.suit.value
+    ret += "d" + str(-hand.over) if hand.over < 0 else "m" + str(hand.bid + hand.over)
+    ret += {Double.NONE: "", Double.DOUBLE: "d", Double.REDOUBLE: "r"}[hand.double]
+    ret += {Honors.NONE: "", Honors.H100: "0", Honors.H150: "5"}[hand.honors]
+    return ret
+
+
+def measure(function: Callable[[], object], repeat: int, min_time: float) -> Dict:
+    """call function repeat times or more until min_time seconds have passed,
+    return the seconds of the fastest and median call"""
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat or (time.perf_counter() - start < min_time and len(times) < 100 * repeat):
+        call_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - call_start)
+    return {"min": min(times), "median": statistics.median(times), "calls": len(times)}
+
+
+def add_hands(hands: List[Result]):
+    "Rubber.add each hand, starting a new rubber when one is complete"
+    rubber = Rubber()
+    for hand in hands:
+        if rubber.add(hand):
+            rubber = Rubber()
+
+
+def store_cycle(result_storage, hands: List[Result]) -> Callable[[], object]:
+    "start a new game in the storage, return a function that stores the hands in it and loads them back"
+    result_storage.new_results()
+
+    def cycle():
+        result_storage.store_results(hands)
+        loaded = result_storage.existing_results()
+        assert len(loaded) == len(hands)
+
+    return cycle
+
+
+class LocalCOS:
+    "a moto server registered in the COS resource pool, each bucket() is a ResultsCOS for a new bucket"
+
+    def __init__(self):
+        import moto.server
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)  # the request log of the server
+        self.server = moto.server.ThreadedMotoServer(port=0, verbose=False)
+        self.server.start()
+        host, port = self.server.get_host_and_port()
+        self.endpoint_url = "http://{}:{}".format(host, port)
+        self.resource = ibm_boto3.resource(
+            "s3",
+            endpoint_url=self.endpoint_url,
+            aws_access_key_id="local",
+            aws_secret_access_key="local",
+            region_name="us-east-1",
+        )
+        cos_resources[(self.endpoint_url, LOCAL_INSTANCE_ID, LOCAL_API_KEY)] = self.resource
+        self.count = 0
+
+    def bucket(self, **kwargs) -> ResultsCOS:
+        self.count += 1
+        bucket_name = "bridgepy-bench-{}".format(self.count)
+        self.resource.create_bucket(Bucket=bucket_name)
+        return ResultsCOS(bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, self.endpoint_url, **kwargs)
+
+    def stop(self):
+        self.server.stop()
+
+
+def benchmarks(hands: List[Result], directory: str, local_cos: Optional[LocalCOS]) -> Dict[str, Callable[[], object]]:
+    "the benchmarks for one game of hands, name -> function to time"
+    bids = [bid_str(hand) for hand in hands]
+    dictionaries = [hand.to_json_dictionary() for hand in hands]
+    rs = rubbers(hands)
+    ret = {
+        "bid_parse": lambda: [bid_parse(bid) for bid in bids],
+        "rubber_add": lambda: add_hands(hands),
+        "rubbers": lambda: rubbers(hands),
+        "score_str": lambda: score_str(hands),
+        "rubbers_str": lambda: rubbers_str(rs),
+        "to_json_dictionary": lambda: [hand.to_json_dictionary() for hand in hands],
+        "from_json_dictionary": lambda: [Result.from_json_dictionary(**d) for d in dictionaries],
+        "file_store_load": store_cycle(ResultsFile(directory, table="json"), hands),
+        "file_packed_store_load": store_cycle(ResultsFile(directory, packed=True, table="packed"), hands),
+    }
+    if local_cos != None:
+        ret["cos_store_load"] = store_cycle(local_cos.bucket(), hands)
+        ret["cos_packed_store_load"] = store_cycle(local_cos.bucket(packed=True), hands)
+    return ret
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    "benchmarks of bridgepy"
+
+
+@cli.command()
+@click.option("--sizes", default=",".join(str(size) for size in SIZES), help="comma separated number of hands in each game")
+@click.option("--repeat", default=5, help="minimum number of timed calls of each benchmark")
+@click.option("--min-time", default=0.2, help="keep calling a benchmark until this many seconds have passed")
+@click.option("-k", "--select", "select", default="", help="only run the benchmarks whose name contains this string")
+@click.option("--cos/--no-cos", default=True, help="include the COS benchmarks, needs moto")
+@click.option("--save", type=click.Path(dir_okay=False), help="save the results as json to this file")
+def run(sizes, repeat, min_time, select, cos, save):
+    "run the benchmarks and print the seconds per call"
+    local_cos = None
+    if cos:
+        try:
+            local_cos = LocalCOS()
+        except ImportError:
+            click.echo("moto is not installed, skipping the COS benchmarks", err=True)
+    results = {}
+    click.echo("{:32s} {:>12s} {:>12s} {:>6s}".format("benchmark", "min", "median", "calls"))
+    try:
+        for size in [int(size) for size in sizes.split(",")]:
+            hands = synthetic_hands(size)
+            with tempfile.TemporaryDirectory() as directory:
+                for name, function in benchmarks(hands, directory, local_cos).items():
+                    if select not in name:
+                        continue
+                    result = measure(function, repeat, min_time)
+                    result["hands"] = size
+                    results["{}[{}]".format(name, size)] = result
+                    click.echo("{:32s} {:12.6f} {:12.6f} {:6d}".format("{}[{}]".format(name, size), result["min"], result["median"], result["calls"]))
+    finally:
+        if local_cos != None:
+            local_cos.stop()
+    if save:
+        with open(save, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": time.strftime("%Y-%m-%d-%H-%M-%S"),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float) -> List[Dict]:
+    """the benchmarks found in both results with the ratio of the current to the baseline fastest call,
+    regression is True when the ratio is more than 1 + threshold"""
+    ret = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["min"] / baseline["results"][name]["min"]
+        ret.append({"name": name, "baseline": baseline["results"][name]["min"], "current": result["min"], "ratio": ratio, "regression": ratio > 1 + threshold})
+    return ret
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", default=0.1, help="a benchmark that is this fraction slower than the baseline is a regression")
+def compare(baseline, current, threshold):
+    "compare two saved results, exit with 1 if there is a regression"
+    baseline = json.load(baseline)
+    current = json.load(current)
+    click.echo("baseline {} current {}".format(baseline.get("commit"), current.get("commit")))
+    rows = compare_results(baseline, current, threshold)
+    for row in rows:
+        click.echo("{:32s} {:12.6f} {:12.6f} {:6.2f}x{}".format(row["name"], row["baseline"], row["current"], row["ratio"], " REGRESSION" if row["regression"] else ""))
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -28,6 +28,95 @@ const guestbook = {
   }
 };
 
+// Live score from the server sent events of the bridgepy fast.py service, see bridgepy/service.py.
+// A score event carries the whole score, a diff event only the points added by one bid, so the service
+// does work when a bid is stored rather than for every viewer poll.
+// The https URL of the service is the data-score-url of the #score element or the scoreUrl query parameter,
+// for example ?scoreUrl=https://bridgepy.example.com.  The service allows this page in BRIDGEPY_CORS_ORIGINS.
+// An https page can not open an http EventSource so an http URL is only used by an http page.
+function scoreServiceUrl() {
+  const url = new URLSearchParams(window.location.search).get('scoreUrl') || $('#score').data('score-url');
+  if (!url) {
+    return null;
+  }
+  if (window.location.protocol == 'https:' && !url.startsWith('https:')) {
+    console.log('Score service must be https', url);
+    return null;
+  }
+  return url.replace(/\/$/, '');
+}
+const scoreboard = {
+  score: null,
+  pad(n) {
+    return String(n).padStart(3);
+  },
+  line(we, they) {
+    return ` ${scoreboard.pad(we)} | ${scoreboard.pad(they)}\n`;
+  },
+  // same layout as bridgepy rubbers_str
+  text(score) {
+    let ret = '';
+    for (const rubber of score.rubbers) {
+      ret += '  We | They\n';
+      const aboveCount = Math.max(rubber.above[0].length, rubber.above[1].length);
+      for (let i = aboveCount - 1; i >= 0; i--) {
+        ret += scoreboard.line(rubber.above[0][i] || 0, rubber.above[1][i] || 0);
+      }
+      rubber.games.forEach(function(game, gameIndex) {
+        ret += gameIndex == 0 ? '-------------\n' : '- - - - - - -\n';
+        const belowCount = Math.max(game[0].length, game[1].length);
+        for (let i = 0; i < belowCount; i++) {
+          ret += scoreboard.line(game[0][i] || 0, game[1][i] || 0);
+        }
+      });
+      ret += '-------------\n' + scoreboard.line(rubber.total[0], rubber.total[1]) + '\n';
+    }
+    if (score.rubbers.length > 1) {
+      ret += '=================\n== All Rubbers ==\n=================\n';
+      ret += scoreboard.line(score.total[0], score.total[1]);
+    }
+    return ret;
+  },
+  applyDiff(diff) {
+    const rubbers = scoreboard.score.rubbers;
+    while (rubbers.length < diff.rubbers) {
+      rubbers.push({above: [[], []], games: [[[], []]], total: [0, 0], games_won: [0, 0]});
+    }
+    const rubber = rubbers[diff.rubber];
+    for (const team of [0, 1]) {
+      rubber.above[team].push(...diff.above[team]);
+    }
+    for (const game of diff.games) {
+      if (rubber.games.length <= game.game) {
+        rubber.games.push([[], []]);
+      }
+      for (const team of [0, 1]) {
+        rubber.games[game.game][team].push(...game.below[team]);
+      }
+    }
+    rubber.total = diff.total;
+    rubber.games_won = diff.games_won;
+    scoreboard.score.total = diff.totals;
+  },
+  listen() {
+    const scoreUrl = scoreServiceUrl();
+    if (!scoreUrl) {
+      return;
+    }
+    const events = new EventSource(`${scoreUrl}/events`);
+    events.addEventListener('score', function(e) {
+      scoreboard.score = JSON.parse(e.data);
+      $('#score').text(scoreboard.text(scoreboard.score));
+    });
+    events.addEventListener('diff', function(e) {
+      if (scoreboard.score) {
+        scoreboard.applyDiff(JSON.parse(e.data));
+        $('#score').text(scoreboard.text(scoreboard.score));
+      }
+    });
+  }
+};
+
 (function() {
 
   let entriesTemplate;
@@ -80,5 +169,6 @@ const guestbook = {
   $(document).ready(function() {
     prepareTemplates();
     loadEntries();
+    scoreboard.listen();
   });
 })();
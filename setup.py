@@ -14,6 +14,9 @@ setup(
     package_dir={'': 'src'},
 
     install_requires=['click'],
+    extras_require={
+        'batch': ['numpy'],
+    },
 
     entry_points={
         'console_scripts': [
@@ -1,12 +1,24 @@
 import bridgepy
+from bridgepy import metrics
 import json
+import os
 
 api_key = "api_key"
 def main(dict):
-    body = bridgepy.function_call_get_score(dict)
-    return { 'body': body }
+    params = {
+        "root": bridgepy.ROOT,
+        "cos_instance_id": bridgepy.COS_INSTANCE_ID,
+        "cos_service_endpoint": bridgepy.COS_SERVICE_ENDPOINT,
+        "log_spans": "BRIDGEPY_LOG_SPANS" in os.environ,
+    }
+    params.update(dict)
+    if params["log_spans"] and metrics.span_handler == None:
+        # the spans are written to stderr, the activation log
+        metrics.log_spans()
+    body = bridgepy.function_call_get_score(**params)
+    cache = bridgepy.score_cache
+    return { 'body': body, 'headers': {'X-Score-Cache': 'hits={} misses={}'.format(cache.hits, cache.misses)} }
 
-import os
 if __name__=="__main__":
     the_api_key = "no BRIDGEPY_API_KEY in environment"
     if "BRIDGEPY_API_KEY" in os.environ:
@@ -1,25 +1,87 @@
+"""
+Keep score in a game of bridge.  Storage and scoring are imported with the package.  The COS and SQLite
+backends, the async wrappers, the command line and the service import ibm_boto3, sqlite3, asyncio and click
+so they are imported on first use of one of the LAZY names
+"""
+import importlib
 from .storage import (
     hands_to_json_file,
     hands_from_json_file,
     new_game_file,
     existing_game_file,
+    game_files,
+    GameCatalog,
+    hands_diff,
+    rebase_hands,
+    pack_hands,
+    hands_from_bytes,
+    hands_from_path,
+    open_packed_file,
+    PackedHands,
+    FSYNC_ALWAYS,
+    FSYNC_COMPACT,
+    FSYNC_NEVER,
+    FSYNC_POLICIES,
     ResultsFile,
-    ResultsCOS,
+    check_table,
     Result,
     Team,
     Suit,
     Honors,
     Double,
 )
-from .cli import (
+from .scoring import (
     Rubber,
+    Score,
+    game_score,
+    score_str,
+    rubbers_str,
     bid_parse,
-    bid_and_store,
-    cli,
-    click_cli,
+    bid_parse_many,
+    BidError,
     rubbers,
-    click_cli,
-    COS_SERVICE_ENDPOINT,
-    COS_INSTANCE_ID,
-    function_call_get_score,
+    score_artifacts,
 )
+
+LAZY = {
+    "ResultsCOS": "cos",
+    "cos_resource": "cos",
+    "ResultsSQLite": "sqlite",
+    "AsyncResults": "aio",
+    "ResultsWriteBehind": "writebehind",
+    "bid_and_store": "cli",
+    "cli": "cli",
+    "click_cli": "cli",
+    "ROOT": "cli",
+    "COS_SERVICE_ENDPOINT": "cli",
+    "COS_INSTANCE_ID": "cli",
+    "function_call_get_score": "cli",
+    "ScoreCache": "cli",
+    "score_cache": "cli",
+    "GameTotals": "cli",
+    "rescore": "cli",
+    "results_storage": "cli",
+    "ScoreService": "service",
+    "ScoreTables": "service",
+    "storage_from_environment": "service",
+}
+
+__all__ = [
+    name
+    for name in list(globals())
+    if not name.startswith("_") and name not in ("importlib", "storage", "scoring", "metrics", "render", "LAZY")
+] + list(LAZY)
+
+
+def __getattr__(name: str):
+    module_name = LAZY.get(name)
+    if module_name == None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + module_name, __name__), name)
+    # later lookups find it without calling __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY))
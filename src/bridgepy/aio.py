@@ -0,0 +1,98 @@
+"""
+Async access to the storages for the HTTP service.  The storages are synchronous, their calls run on one pool of
+threads shared by every storage so a COS round trip never blocks the event loop and the number of threads, and of
+COS connections, is bounded.  The pool size is set by configure_pool(), POOL_SIZE by default
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from typing import Callable, List, Optional
+
+from .storage import Result
+
+POOL_SIZE = 10  # threads, the same as the default max_pool_connections of a COS client
+
+pool = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+pool_lock = threading.Lock()
+
+
+def get_pool() -> concurrent.futures.ThreadPoolExecutor:
+    "the shared pool, created on first use"
+    global pool
+    with pool_lock:
+        if pool == None:
+            pool = concurrent.futures.ThreadPoolExecutor(POOL_SIZE, thread_name_prefix="bridgepy-storage")
+        return pool
+
+
+def configure_pool(pool_size: int):
+    "replace the shared pool with one of pool_size threads, calls already running finish in the old pool"
+    global pool
+    if pool_size < 1:
+        raise ValueError("pool size must be at least 1", pool_size)
+    with pool_lock:
+        old = pool
+        pool = concurrent.futures.ThreadPoolExecutor(pool_size, thread_name_prefix="bridgepy-storage")
+    if old != None:
+        old.shutdown(wait=False)
+
+
+async def run(f: Callable, *args, **kwargs):
+    "call f in the shared pool and return what it returns"
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), functools.partial(f, *args, **kwargs))
+
+
+class AsyncResults:
+    """
+    The async methods of a storage, a ResultsFile, ResultsCOS or ResultsSQLite.  A storage remembers the game it
+    read so its calls are run one at a time.  Concurrent existing_results calls share one in-flight read of the
+    game and each gets its own list of the hands.  reads counts the reads of the storage
+    """
+
+    def __init__(self, result_storage):
+        self.result_storage = result_storage
+        self.lock = asyncio.Lock()
+        self.reading = None  # type: Optional[asyncio.Future]
+        self.reads = 0
+
+    async def call(self, f: Callable, *args):
+        async with self.lock:
+            return await run(f, *args)
+
+    async def existing_results(self) -> List[Result]:
+        reading = self.reading
+        if reading == None:
+            reading = self.reading = asyncio.ensure_future(self.read())
+        # a caller that is cancelled does not cancel the read of the others
+        return list(await asyncio.shield(reading))
+
+    async def read(self) -> List[Result]:
+        try:
+            self.reads += 1
+            return await self.call(self.result_storage.existing_results)
+        finally:
+            self.reading = None
+
+    async def new_results(self) -> List[Result]:
+        return await self.call(self.result_storage.new_results)
+
+    async def store_results(self, hands: List[Result]):
+        "see the store_results of the storage, hands may be rebased in place"
+        return await self.call(self.result_storage.store_results, hands)
+
+    def game_version(self) -> Optional[str]:
+        "see the game_version of the storage, it does no I/O"
+        return self.result_storage.game_version()
+
+    async def existing_checkpoint(self) -> Optional[List[dict]]:
+        return await self.call(self.result_storage.existing_checkpoint)
+
+    async def store_checkpoint(self, entries: List[dict], replace: bool = True):
+        return await self.call(self.result_storage.store_checkpoint, entries, replace)
+
+    async def game_names(self) -> List[str]:
+        return await self.call(lambda: list(self.result_storage.game_names()))
+
+    async def load_game(self, name: str) -> List[Result]:
+        return await self.call(self.result_storage.load_game, name)
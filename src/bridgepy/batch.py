@@ -0,0 +1,129 @@
+"""
+Score large archives of hands in columnar form with numpy.  Each hand is a row across the columns
+team (Team.value), bid, suit (index in SUITS), over, honors (Honors.value) and double (Double.value).
+The per hand points match Rubber.add, see vulnerability() for the part of the rubber state that is sequential
+"""
+import numpy as np
+from typing import Dict, List, Tuple
+from .storage import Result, Suit, Double
+
+SUITS = list(Suit)
+COLUMNS = ["team", "bid", "suit", "over", "honors", "double"]
+
+# set points for the first, second and third, fourth and later tricks
+# indexed by 4 * (0 if vulnerable else 1) + double value - 1, see Rubber.add
+SET_TRICK1 = np.array([100, 200, 0, 400, 50, 100, 0, 200])
+SET_TRICK23 = np.array([100, 300, 0, 600, 50, 200, 0, 400])
+SET_TRICK4 = np.array([100, 300, 0, 600, 50, 300, 0, 600])
+
+
+def results_to_columns(results: List[Result]) -> Dict[str, np.ndarray]:
+    "convert a list of results into a dictionary of COLUMNS"
+    return {
+        "team": np.array([r.team.value for r in results], dtype=np.int64),
+        "bid": np.array([r.bid for r in results], dtype=np.int64),
+        "suit": np.array([SUITS.index(r.suit) for r in results], dtype=np.int64),
+        "over": np.array([r.over for r in results], dtype=np.int64),
+        "honors": np.array([r.honors.value for r in results], dtype=np.int64),
+        "double": np.array([r.double.value for r in results], dtype=np.int64),
+    }
+
+
+def trick_value(suit: np.ndarray) -> np.ndarray:
+    minor = (suit == SUITS.index(Suit.DIAMOND)) | (suit == SUITS.index(Suit.CLUB))
+    return np.where(minor, 20, 30)
+
+
+def below_points(bid, suit, over, double) -> np.ndarray:
+    "points below the line for the declaring team, 0 for contracts that were set"
+    points = trick_value(suit) * bid * double + np.where(
+        suit == SUITS.index(Suit.NOTRUMP), 10, 0
+    )
+    return np.where(over >= 0, points, 0)
+
+
+def vulnerability(team, bid, suit, over, double) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    return the vulnerable column, True if the declaring team was vulnerable, and the rubber bonus column,
+    the bonus won by the declaring team on the hand that completed a rubber.
+    Games and rubbers are boundaries that depend on every earlier hand so this is a single pass over the hands,
+    only the below line points it needs are computed vectorized
+    """
+    below = below_points(bid, suit, over, double).tolist()
+    made = (np.asarray(over) >= 0).tolist()
+    teams = np.asarray(team).tolist()
+    vulnerable = np.zeros(len(teams), dtype=bool)
+    rubber_bonus = np.zeros(len(teams), dtype=np.int64)
+    game = [0, 0]
+    games_won = [0, 0]
+    for i, declarer in enumerate(teams):
+        vulnerable[i] = games_won[declarer] == 1
+        game[declarer] += below[i]
+        if made[i] and game[declarer] >= 100:
+            game = [0, 0]
+            games_won[declarer] += 1
+            if games_won[declarer] == 2:
+                rubber_bonus[i] = 700 if games_won[1 - declarer] == 0 else 500
+                games_won = [0, 0]
+    return vulnerable, rubber_bonus
+
+
+def score_batch(
+    team, bid, suit, over, honors, double, vulnerable, rubber_bonus=None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    return the above and below the line points of each hand as two arrays of shape (hands, 2),
+    column Team.value is the points for that team
+    """
+    team = np.asarray(team)
+    bid = np.asarray(bid)
+    over = np.asarray(over)
+    double = np.asarray(double)
+    vulnerable = np.asarray(vulnerable, dtype=bool)
+    made = over >= 0
+    doubled = double != Double.NONE.value
+    over_tricks = np.maximum(over, 0)
+
+    over_trick_points = np.where(
+        doubled,
+        50 * over_tricks * double * np.where(vulnerable, 2, 1),
+        trick_value(suit) * over_tricks,
+    )
+    slam_bonus = np.where(
+        bid == 6,
+        np.where(vulnerable, 750, 500),
+        np.where(bid == 7, np.where(vulnerable, 1000, 1500), 0),
+    )
+    insult = np.where(
+        double == Double.DOUBLE.value,
+        50,
+        np.where(double == Double.REDOUBLE.value, 100, 0),
+    )
+    made_above = over_trick_points + slam_bonus + insult + honors
+    if rubber_bonus is not None:
+        made_above = made_above + rubber_bonus
+
+    set_tricks = np.maximum(-over, 1)
+    point_index = 4 * np.where(vulnerable, 0, 1) + double - 1
+    set_points = (
+        SET_TRICK1[point_index]
+        + SET_TRICK23[point_index] * np.minimum(set_tricks - 1, 2)
+        + SET_TRICK4[point_index] * np.maximum(set_tricks - 3, 0)
+    )
+
+    rows = np.arange(len(team))
+    above = np.zeros((len(team), 2), dtype=np.int64)
+    below = np.zeros((len(team), 2), dtype=np.int64)
+    above[rows, team] = np.where(made, made_above, 0)
+    above[rows, 1 - team] = np.where(made, 0, set_points)
+    below[rows, team] = below_points(bid, suit, over, double)
+    return above, below
+
+
+def score_results(results: List[Result]) -> Tuple[np.ndarray, np.ndarray]:
+    "return the above and below the line points of each hand in a sequence of rubbers, see score_batch()"
+    columns = results_to_columns(results)
+    vulnerable, rubber_bonus = vulnerability(
+        columns["team"], columns["bid"], columns["suit"], columns["over"], columns["double"]
+    )
+    return score_batch(vulnerable=vulnerable, rubber_bonus=rubber_bonus, **columns)
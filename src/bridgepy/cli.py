@@ -4,12 +4,20 @@ Keep score in a game of bridge
 import click
 import json
 import collections
-import enum
-from typing import List
-from bridgepy import *
+import concurrent.futures
+import functools
+import os
+import sys
+import time
+from typing import Callable, Iterator, List, NamedTuple, Optional
+from bridgepy.storage import *
+from bridgepy.scoring import *
+from bridgepy import metrics, render
+from bridgepy.sync import sync, MAX_IN_FLIGHT, PREFERENCES, WORKERS
 
 STORAGE_FILE = "file"
 STORAGE_COS = "cos"
+STORAGE_SQLITE = "sqlite"
 ROOT = "pfq-bridgepy"
 # COS_INSTANCE_ID="crn:v1:bluemix:public:cloud-object-storage:global:a/713c783d9a507a53135fe6793c37cc74:816ac7d3-10f7-4b06-a7bc-570da47b4c0b::"
 COS_INSTANCE_ID = "crn:v1:bluemix:public:cloud-object-storage:global:a/713c783d9a507a53135fe6793c37cc74:eefa2d30-edb6-4105-ac49-2a66ff0de075::"
@@ -17,289 +25,316 @@ COS_SERVICE_ENDPOINT = "https://s3-api.us-geo.objectstorage.softlayer.net"
 ENV_PREFIX = "BRIDGEPY"
 
 
-def honors_double(s):
-    if s == "d":
-        return {"double": Double.DOUBLE}
-    elif s == "r":
-        return {"double": Double.REDOUBLE}
-    elif s == "0":
-        return {"honors": Honors.H100}
-    elif s == "5":
-        return {"honors": Honors.H150}
-    else:
-        raise Exception("Honors or double must be d, r, 0, 5 but was", s)
-
-
-def bid_parse(bid: str) -> Result:
-    """
-    bid: (wt)N(shdc)(md)M[dr][15], like w3sm2 or w3sd1 both me team WE bid 3 SPADES made 8 tricks, down 1
-    0 (wt) - We or They, must choose one
-    1 (shdc) - suit
-    2 N - bid number in excess of 6
-    3 (md) - one of either Made or Down
-    4 M - amoutn made or down
-    5/6 [dr] - optional double or redouble
-    5/6 [05] - optional 100 or 150 honors points
-    Examples:
-    w3sm25: WE, 3, SPADES, -1, honors 150
-    w3sd1d0: WE, 3, SPADES, -1, honors 100, doubled
-    w3sm3r: WE, 3, SPADES, 0, Redoubled
-    """
-    team = Team.WE if bid[0] == "w" else Team.THEY
-    bid_tricks = int(bid[1])
-    suit = Suit(bid[2])
-    made_or_down = bid[3]
-    over_tricks = int(bid[4])
-    over_tricks = -over_tricks if made_or_down == "d" else over_tricks - bid_tricks
-    ret = Result(team, bid_tricks, suit, over_tricks)
-    for indx in range(5, len(bid)):
-        ret = ret._replace(**honors_double(bid[indx]))
-    return ret
-
-
-def score_print(hands: List[Result]):
+def score_print(hands: List[Result], format: str = render.TEXT):
     "Print the score for a set of hands by converting them to rubbers and printing the rubbers"
-    click.echo(score_str(hands))
+    rubbers_print(rubbers(hands), format)
 
 
-def add_nl(s: str) -> str:
-    return s + "\n"
-
-
-def score_str(hands: List[Result]) -> str:
-    "generate a string score for a set of hands by converting them to rubbers and printing the rubbers"
-    ret = ""
-    point_format = " {:3d} | {:3d}"
-    we_total = 0
-    they_total = 0
-    rs = rubbers(hands)
-    for r in rs:
-        ret += add_nl("  We | They")
-        above_count = max(len(r.above[0]), len(r.above[1]))
-        for i in range(above_count - 1, -1, -1):
-            we = 0 if len(r.above[0]) <= i else r.above[0][i]
-            they = 0 if len(r.above[1]) <= i else r.above[1][i]
-            ret += add_nl(point_format.format(we, they))
-        ret += add_nl("-------------")
-        first_game = True
-        for game in r.games:
-            if first_game:
-                first_game = False
-            else:
-                ret += add_nl("- - - - - - -")
-            score_count = max(len(game[0]), len(game[1]))
-            for i in range(0, score_count):
-                we = 0 if len(game[0]) <= i else game[0][i]
-                they = 0 if len(game[1]) <= i else game[1][i]
-                ret += add_nl(point_format.format(we, they))
-        ret += add_nl("-------------")
-        ret += add_nl(point_format.format(r.total[0], r.total[1]))
-        we_total += r.total[0]
-        they_total += r.total[1]
-        ret += add_nl("")
-    if len(rs) > 1:
-        # print total for all the rubbers
-        ret += add_nl("=================")
-        ret += add_nl("== All Rubbers ==")
-        ret += add_nl("=================")
-        ret += add_nl(point_format.format(we_total, they_total))
-    return ret
-
-
-class Rubber:
-    """
-    state of a rubber.  Call the add() function to add another hand result to the rubber
-    Example
-    we | they
-    50 | 
-    30 | 
-    ---------
-    70 |
-    30 |
-    - - - - - 
-       | 90
-    - - - - - 
-    180|90
-
-    above: [[30, 50], []] # above line, over tricks, honors, rubber bonus, ... arranged by time, print in reverse order
-    games: [ 
-                [[70, 30],[]], # game 1
-                [[], [90]] # game 2
-            ]
-    totoal: [100, 90] # just a sum of everything
-    """
-
-    def __init__(self):
-        self.above = [[], []]  # we and they list above the line
-        self.games = [
-            [[], []]
-        ]  # games below the line, list of games, each game has a list of contracts won for We and They
-        self.games_won = [0, 0]  # we, they games won
-        self.total = [0, 0]  # we and they totals
-
-    def complete(self):
-        return (
-            self.games_won[Team.WE.value] == 2 or self.games_won[Team.THEY.value] == 2
-        )
-
-    def add(self, result: Result) -> bool:
-        """add the result to the rubber return True if the rubber is now complete"""
-        if self.complete():
-            raise Exception("Can not add to this Rubber, is is complete")
-        contract_winner = result.team.value
-        contract_loser = 1 - contract_winner
-        vulnerable = self.games_won[contract_winner] == 1
-        if result.over >= 0:  # made contract
-            above_points = []  # apoints earned above the line for this hand
-            last_game = self.games[len(self.games) - 1]
-            trick_value = (
-                20 if result.suit == Suit.DIAMOND or result.suit == Suit.CLUB else 30
-            )
-            under_points = trick_value * result.bid * result.double.value
-            under_points += 10 if result.suit == Suit.NOTRUMP else 0
-            last_game[contract_winner].append(under_points)
-            if result.over > 0:
-                over_trick_points = 0
-                if result.double == Double.NONE:
-                    over_trick_points = trick_value * result.over * result.double.value
-                else:
-                    over_trick_points = (
-                        50
-                        * result.over
-                        * result.double.value
-                        * (2 if vulnerable else 1)
-                    )
-                above_points.append(over_trick_points)
-            slam_bonus = 0
-            if result.bid == 6:
-                slam_bonus = 750 if vulnerable else 500
-            if result.bid == 7:
-                slam_bonus = 1000 if vulnerable else 1500
-            if slam_bonus:
-                above_points.append(slam_bonus)
-            if result.double != Double.NONE:
-                above_points.append(
-                    50 if result.double == Double.DOUBLE else 100
-                )  # insult
-            if result.honors != Honors.NONE:
-                above_points.append(result.honors.value)
-            if sum(last_game[contract_winner]) >= 100:
-                self.games_won[
-                    contract_winner
-                ] += 1  # keep track of games won for each team
-                if self.complete():
-                    rubber_bonus = 700 if self.games_won[contract_loser] == 0 else 500
-                    above_points.append(rubber_bonus)
-                else:
-                    self.games.append([[], []])  # add a new game
-
-            self.above[contract_winner].extend(above_points)
-            self.total[contract_winner] += under_points
-            self.total[contract_winner] += sum(above_points)
-        else:  # set
-            #          vu   vd      vr   nu  nd      nr
-            trick1 = [
-                100,
-                200,
-                0,
-                400,
-                50,
-                100,
-                0,
-                200,
-            ]  # vulnerable undoubled, doubled, redoubled, not vulnerable, ...
-            trick23 = [
-                100,
-                300,
-                0,
-                600,
-                50,
-                200,
-                0,
-                400,
-            ]  # vulnerable undoubled, doubled, redoubled, not vulnerable, ...
-            trick4 = [
-                100,
-                300,
-                0,
-                600,
-                50,
-                300,
-                0,
-                600,
-            ]  # vulnerable undoubled, doubled, redoubled, not vulnerable, ...
-            set_tricks = -result.over
-            point_index = (
-                4 * (0 if vulnerable else 1) + result.double.value - 1
-            )  # double value is 1, 2, 4
-            set_points = trick1[point_index]  # first set trick
-            set_tricks -= 1
-            for i in range(0, set_tricks if set_tricks <= 2 else 2):
-                set_points += trick23[point_index]
-                set_tricks -= 1
-            for i in range(0, set_tricks):
-                set_points += trick4[point_index]
-            self.above[contract_loser].append(set_points)
-            self.total[contract_loser] += set_points
-        return self.complete()
-
-
-def rubbers(results: List[Result]) -> List[Rubber]:
-    rubber = Rubber()
-    ret = [rubber]
-    for result in results:
-        if rubber.add(result):
-            rubber = Rubber()
-            ret.append(rubber)
-    return ret
+def rubbers_print(rs: List["Rubber"], format: str = render.TEXT):
+    "Print the score for a list of rubbers"
+    with metrics.span(metrics.RENDER):
+        render.write(rs, functools.partial(click.echo, nl=False), format)
+    click.echo()
 
 
 def help_print():
     click.echo(cli.get_help(click.Context(cli)))
 
 
-def bid_and_store(results_storeage, hands, bid):
+def bid_and_store(results_storeage, hands, bid, format=render.TEXT):
+    "a bid that can not be parsed is reported as a click usage error, nothing is stored"
     if bid == None:
-        score_print(hands)
+        rubbers_print(game_score(results_storeage, hands).rubbers, format)
         return
-    elif bid == "u":
+    elif bid == UNDO:
         if len(hands) == 0:
             return
-        hands.pop()
+        score = apply_bid(results_storeage, hands, None, bid)
     else:
-        tpl = bid_parse(bid)
-        if tpl:
-            hands.append(tpl)
-        else:
-            help_print()
-            return
-    results_storeage.store_results(hands)
-    score_print(hands)
+        try:
+            score = apply_bid(
+                results_storeage, hands, game_score(results_storeage, hands), bid
+            )
+        except BidError as e:
+            raise click.BadArgumentUsage(
+                "bid {!r} {} at position {}\n  {}\n  {}^".format(
+                    e.bid, e.reason, e.position, e.bid, " " * e.position
+                )
+            )
+    rubbers_print(score.rubbers, format)
+
+
+class ScoreCache:
+    """
+    Rendered score of the latest game in each bucket, validated with a conditional GET against the ETag of the
+    game object so an unchanged game is not downloaded, parsed or scored again.  When the storage publishes
+    artifacts the game is only checked with a HEAD and the text artifact of the game is read instead of the game
+    when the game changed.  The artifact is only used when it was published for the ETag of the game, see
+    ResultsCOS.publish_artifacts(), otherwise the game is scored.
+    hits counts scores returned from the cache, misses counts scores that were loaded and rendered
+    """
+
+    def __init__(self):
+        self.scores = {}  # (bucket name, table) -> (key, etag of the game, score string)
+        self.hits = 0
+        self.misses = 0
+
+    def score_str(self, result_storage: "ResultsCOS") -> str:
+        "return the score string of the latest game in the result_storage bucket"
+        try:
+            return self.key_score_str(
+                result_storage, result_storage.get_latest_result_object()
+            )
+        except FileNotFoundError:
+            # the latest pointer is stale, the game it points to was archived or removed
+            return self.key_score_str(
+                result_storage, result_storage.list_latest_result_object()
+            )
+
+    def key_score_str(self, result_storage: "ResultsCOS", key: Optional[str]) -> str:
+        "return the score string of the game stored at key, raise FileNotFoundError if there is not one"
+        if key == None:
+            self.misses += 1
+            return score_str([])
+        cached_key, etag, cached_str = self.scores.get(
+            (result_storage.bucket_name, result_storage.table), (None, None, None)
+        )
+        if key != cached_key:
+            etag = None
+        if result_storage.artifacts:
+            game_etag = result_storage.existing_etag(key)
+            if game_etag == etag:
+                return self.loaded_str(result_storage, key, None, cached_str, str)
+            try:
+                artifact_etag, content = result_storage.existing_artifact(
+                    key, TEXT_ARTIFACT_SUFFIX
+                )
+            except FileNotFoundError:
+                artifact_etag = None  # a game stored before artifacts were published
+            if artifact_etag != None and artifact_etag == game_etag.strip('"'):
+                return self.loaded_str(
+                    result_storage, key, (game_etag, content), cached_str, bytes.decode
+                )
+            # the artifact is missing or it is not for this version of the game, score it
+        loaded = result_storage.existing_results_if_none_match(key, etag)
+        return self.loaded_str(result_storage, key, loaded, cached_str, score_str)
+
+    def loaded_str(self, result_storage, key, loaded, cached_str, to_str) -> str:
+        """return cached_str if nothing was loaded, otherwise cache and return the score string of the
+        (etag, value) loaded from key"""
+        if loaded == None:
+            self.hits += 1
+            return cached_str
+        self.misses += 1
+        etag, value = loaded
+        ret = to_str(value)
+        self.scores[(result_storage.bucket_name, result_storage.table)] = (
+            key,
+            etag,
+            ret,
+        )
+        return ret
+
+
+score_cache = ScoreCache()
 
 
 def function_call_get_score(**kwargs):
+    from bridgepy.cos import ResultsCOS
+
     result_storage = ResultsCOS(
         kwargs["root"],
         kwargs["api_key"],
         kwargs["cos_instance_id"],
         kwargs["cos_service_endpoint"],
+        table=kwargs.get("table"),
+        artifacts=bool(kwargs.get("artifacts", False)),
+    )
+    return score_cache.score_str(result_storage)
+
+
+def results_storage(
+    storage,
+    root,
+    api_key=None,
+    instance_id=None,
+    cos_service_endpoint=None,
+    table=None,
+    artifacts=False,
+    **kwargs
+):
+    """create the ResultsFile, ResultsCOS or ResultsSQLite for the storage, STORAGE_FILE, STORAGE_COS or
+    STORAGE_SQLITE, kwargs are passed to the storage class.  The COS and SQLite backends are only imported
+    when they are used.  artifacts publishes the score artifacts of the file and COS games, SQLite games
+    are read through the service which renders the score it keeps"""
+    if storage == STORAGE_FILE:
+        return ResultsFile(root, table=table, artifacts=artifacts, **kwargs)
+    if storage == STORAGE_SQLITE:
+        from bridgepy.sqlite import ResultsSQLite
+
+        return ResultsSQLite(root, table=table, **kwargs)
+    from bridgepy.cos import ResultsCOS
+
+    return ResultsCOS(
+        root,
+        api_key,
+        instance_id,
+        cos_service_endpoint,
+        table=table,
+        artifacts=artifacts,
+        **kwargs
+    )
+
+
+class GameTotals(NamedTuple):
+    "the score of one game, see rescore()"
+    name: str
+    hands: int
+    rubbers: int
+    we: int
+    they: int
+
+
+rescore_storage = None  # storage of a rescore worker process, see rescore_init()
+
+
+def rescore_init(storage_factory: Callable[[], object]):
+    "create the storage of a rescore worker process"
+    global rescore_storage
+    if "bridgepy.cos" in sys.modules:
+        # a forked worker must not share the http connections of the parent
+        sys.modules["bridgepy.cos"].cos_resources.clear()
+    rescore_storage = storage_factory()
+
+
+def rescore_game(name: str) -> GameTotals:
+    "load and score one game with the storage of the worker process"
+    hands = rescore_storage.load_game(name)
+    rs = rubbers(hands)
+    return GameTotals(
+        name,
+        len(hands),
+        len(rs),
+        sum(r.total[0] for r in rs),
+        sum(r.total[1] for r in rs),
     )
-    hands = result_storage.existing_results()
-    return score_str(hands)
 
 
-def run(root, new_game, storage, api_key, instance_id, cos_service_endpoint, bid):
+def rescore(
+    storage_factory: Callable[[], object],
+    workers: Optional[int] = None,
+    in_flight: Optional[int] = None,
+) -> Iterator[GameTotals]:
+    """
+    Score every game of the storage created by storage_factory, a picklable function like a functools.partial
+    of results_storage.  Yield the GameTotals of each game in the order of game_names().
+    The games are scored by a pool of workers processes, os.cpu_count() by default, one storage per process.
+    At most in_flight games, 4 per worker by default, are loaded or waiting to be yielded at a time so memory
+    does not grow with the number of games.  With 1 worker the games are scored in this process
+    """
+    if workers == None:
+        workers = os.cpu_count() or 1
+    if in_flight == None:
+        in_flight = 4 * workers
+    names = storage_factory().game_names()
+    if workers <= 1:
+        global rescore_storage
+        rescore_storage = storage_factory()
+        for name in names:
+            yield rescore_game(name)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=rescore_init, initargs=(storage_factory,)
+    ) as executor:
+        pending = collections.deque()
+        for name in names:
+            pending.append(executor.submit(rescore_game, name))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def run(
+    root,
+    new_game,
+    storage,
+    api_key,
+    instance_id,
+    cos_service_endpoint,
+    bid,
+    journal=False,
+    fsync=FSYNC_COMPACT,
+    packed=False,
+    format=render.TEXT,
+    table=None,
+    artifacts=False,
+    cache=None,
+):
     print(root, new_game, storage, api_key, instance_id, cos_service_endpoint, bid)
     if storage == STORAGE_FILE:
-        result_storage = ResultsFile(root)
+        result_storage = results_storage(
+            storage,
+            root,
+            table=table,
+            artifacts=artifacts,
+            journal=journal,
+            fsync=fsync,
+            packed=packed,
+        )
+    elif storage == STORAGE_SQLITE:
+        result_storage = results_storage(storage, root, table=table)
     else:
-        result_storage = ResultsCOS(root, api_key, instance_id, cos_service_endpoint)
+        result_storage = results_storage(
+            storage,
+            root,
+            api_key,
+            instance_id,
+            cos_service_endpoint,
+            table=table,
+            artifacts=artifacts,
+            packed=packed,
+        )
+        if cache != None:
+            from bridgepy.writebehind import ResultsWriteBehind
+
+            result_storage = ResultsWriteBehind(cache, result_storage)
 
     if new_game:
         hands = result_storage.new_results()
     else:
         hands = result_storage.existing_results()
-    bid_and_store(result_storage, hands, bid)
+    bid_and_store(result_storage, hands, bid, format)
+    if storage == STORAGE_COS and cache != None:
+        # the score is printed, now push the bid
+        try:
+            result_storage.flush(retries=0)
+        except Exception as e:
+            click.echo(
+                "{} games not pushed to COS, run bridgepy sync: {}".format(
+                    result_storage.pending(), e
+                ),
+                err=True,
+            )
+
+
+def storage_options(f):
+    "the click options that select the storage, shared by the commands"
+    options = [
+        click.option("-t", "--table", help="table id, each table keeps its own games"),
+        click.option("--file", "storage", flag_value=STORAGE_FILE),
+        click.option("--cos", "storage", flag_value=STORAGE_COS, default=True),
+        click.option("--sqlite", "storage", flag_value=STORAGE_SQLITE),
+        click.option("-k", "--api-key", help="ibm cloud api key,  needed for COS"),
+        click.option("-r", "--root", help="cos bucket, root directory or sqlite database"),
+        click.option(
+            "-i", "--cos-instance-id", help="ibm cloud instance id, needed for COS"
+        ),
+        click.option("-e", "--cos-service_endpoint", help="COS service endpoint"),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
 
 
 # Command line calls cli
@@ -310,13 +345,44 @@ def run(root, new_game, storage, api_key, instance_id, cos_service_endpoint, bid
     is_flag=True,
     help="start a new game, this will create a new file to store the hands",
 )
-@click.option("--file", "storage", flag_value=STORAGE_FILE)
-@click.option("--cos", "storage", flag_value=STORAGE_COS, default=True)
-@click.option("-k", "--api-key", help="ibm cloud api key,  needed for COS")
-@click.option("-r", "--root", help="cos bucket or root directory")
+@storage_options
+@click.option(
+    "--journal",
+    is_flag=True,
+    default=False,
+    help="file storage appends each bid or undo to a journal instead of rewriting the game",
+)
+@click.option(
+    "--fsync",
+    type=click.Choice(FSYNC_POLICIES),
+    default=FSYNC_COMPACT,
+    help="when file storage forces writes to disk",
+)
+@click.option(
+    "--packed",
+    is_flag=True,
+    default=False,
+    help="store new games in the packed binary format, json games are still read",
+)
+@click.option(
+    "--artifacts",
+    is_flag=True,
+    default=False,
+    help="publish the rendered score next to the game on each store, read by the cloud function",
+)
+@click.option(
+    "--cache",
+    type=click.Path(file_okay=False),
+    help="local directory that COS bids are stored in first, they are pushed to COS after the score is printed",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(render.FORMATS),
+    default=render.TEXT,
+    help="format of the score",
+)
 @click.option("--root-test", help="cos bucket or root test directory")
-@click.option("-i", "--cos-instance-id", help="ibm cloud instance id, needed for COS")
-@click.option("-e", "--cos-service_endpoint", help="COS service endpoint")
 @click.option(
     "-p",
     "--print-params",
@@ -331,18 +397,32 @@ def run(root, new_game, storage, api_key, instance_id, cos_service_endpoint, bid
     default=False,
     help="simulate the call that the cloud function makes",
 )
+@click.option(
+    "--log-spans",
+    is_flag=True,
+    default=False,
+    help="log the time spent in storage, parsing, scoring and rendering to stderr",
+)
 @click.argument("bid", nargs=1, required=False)
 def click_cli(
     root,
     root_test,
     new_game,
+    table,
     storage,
+    journal,
+    fsync,
+    packed,
+    artifacts,
+    cache,
+    output_format,
     api_key,
     cos_instance_id,
     cos_service_endpoint,
     bid,
     print_params,
     simulate_function,
+    log_spans,
 ):
     """
     score a collection of bridge hands USAGE:
@@ -358,27 +438,340 @@ def click_cli(
                     "root": root,
                     "root_test": root_test,
                     "new_game": new_game,
+                    "table": table,
                     "storage": storage,
+                    "journal": journal,
+                    "fsync": fsync,
+                    "packed": packed,
+                    "artifacts": artifacts,
+                    "cache": cache,
+                    "format": output_format,
                     "api_key": api_key,
                     "cos_instance_id": cos_instance_id,
                     "cos_service_endpoint": cos_service_endpoint,
                     "print_params": print_params,
                     "simulate_function": simulate_function,
+                    "log_spans": log_spans,
                     "bid": bid,
                 }
             )
         )
         return
+    if log_spans:
+        metrics.log_spans()
     if simulate_function:
-        function_call_get_score(**d)
+        click.echo(
+            function_call_get_score(
+                root=root,
+                api_key=api_key,
+                cos_instance_id=cos_instance_id,
+                cos_service_endpoint=cos_service_endpoint,
+                table=table,
+                artifacts=artifacts,
+            )
+        )
     else:
         run(
-            root, new_game, storage, api_key, cos_instance_id, cos_service_endpoint, bid
+            root,
+            new_game,
+            storage,
+            api_key,
+            cos_instance_id,
+            cos_service_endpoint,
+            bid,
+            journal=journal,
+            fsync=fsync,
+            packed=packed,
+            format=output_format,
+            table=table,
+            artifacts=artifacts,
+            cache=cache,
+        )
+
+
+@click.command()
+@storage_options
+@click.option(
+    "-j",
+    "--workers",
+    type=int,
+    default=None,
+    help="number of worker processes, default is the number of cores",
+)
+def rescore_cli(
+    root, table, storage, api_key, cos_instance_id, cos_service_endpoint, workers
+):
+    """
+    score every game in the directory or bucket, print the totals of each game and of all of the games USAGE:
+    bridgepy rescore [options]
+    """
+    storage_factory = functools.partial(
+        results_storage,
+        storage,
+        root,
+        api_key,
+        cos_instance_id,
+        cos_service_endpoint,
+        table,
+    )
+    games = hands = we = they = 0
+    start = time.perf_counter()
+    for totals in rescore(storage_factory, workers):
+        click.echo(
+            "{} hands {} rubbers {} we {} they {}".format(
+                totals.name, totals.hands, totals.rubbers, totals.we, totals.they
+            )
+        )
+        games += 1
+        hands += totals.hands
+        we += totals.we
+        they += totals.they
+    elapsed = time.perf_counter() - start
+    click.echo(
+        "games {} hands {} we {} they {} seconds {:.3f} games/second {:.1f}".format(
+            games, hands, we, they, elapsed, games / elapsed if elapsed > 0 else 0.0
+        )
+    )
+
+
+@click.command()
+@click.option("-r", "--root", help="root directory")
+@click.option("-t", "--table", help="table id, each table keeps its own games")
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    default=False,
+    help="replace the catalog with a scan of the directory",
+)
+def catalog_cli(root, table, rebuild):
+    """
+    check the catalog of the games in a directory against the directory, exit with 1 if they differ USAGE:
+    bridgepy catalog [--rebuild] [options]
+    """
+    catalog = ResultsFile(root, table=table).catalog
+    if rebuild:
+        catalog.rebuild()
+    missing, unlisted = catalog.drift()
+    for name in missing:
+        click.echo("missing {}".format(name))
+    for name in unlisted:
+        click.echo("unlisted {}".format(name))
+    click.echo("games {} latest {}".format(len(catalog.games()), catalog.latest()))
+    if len(missing) > 0 or len(unlisted) > 0:
+        sys.exit(1)
+
+
+def sync_cache(result_storage, retries: int) -> bool:
+    "flush, verify and pull the write-behind cache, return False if a game is not in COS"
+    try:
+        pushed = result_storage.flush(retries=retries)
+    except Exception as e:
+        click.echo(
+            "pushed {} pending {} error {}".format(
+                len(result_storage.flushed), result_storage.pending(), e
+            )
         )
+        return False
+    mismatched = result_storage.verify()
+    for key in mismatched:
+        click.echo("not verified {}".format(key))
+    click.echo(
+        "pushed {} verified {} pending {} latest {}".format(
+            pushed,
+            pushed - len(mismatched),
+            result_storage.pending(),
+            result_storage.pull(),
+        )
+    )
+    return len(mismatched) == 0
+
+
+def sync_directory(local, remote, workers, max_in_flight, prefer) -> bool:
+    "sync the games of the ResultsFile and the ResultsCOS, return False if a game was not synced"
+    stats = sync(
+        local,
+        remote,
+        workers=workers,
+        max_in_flight=max_in_flight,
+        prefer=prefer,
+        progress=lambda action, name, size: click.echo(
+            "{} {} {}".format(action, name, size)
+        ),
+    )
+    for name in stats.conflicts:
+        click.echo("conflict {}".format(name))
+    for name, error in stats.failed:
+        click.echo("failed {} {}".format(name, error))
+    click.echo(
+        "uploaded {} downloaded {} same {} conflicts {} failed {} bytes {} seconds {:.3f} MB/second {:.3f} objects/second {:.1f}".format(
+            len(stats.uploaded),
+            len(stats.downloaded),
+            stats.same,
+            len(stats.conflicts),
+            len(stats.failed),
+            stats.bytes,
+            stats.seconds,
+            stats.bytes / stats.seconds / 1e6 if stats.seconds > 0 else 0.0,
+            (len(stats.uploaded) + len(stats.downloaded)) / stats.seconds
+            if stats.seconds > 0
+            else 0.0,
+        )
+    )
+    return len(stats.conflicts) == 0 and len(stats.failed) == 0
+
+
+@click.command()
+@storage_options
+@click.option(
+    "--cache",
+    type=click.Path(file_okay=False),
+    help="local directory of the write-behind cache, its bids are pushed to COS",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=3,
+    help="times a push of the write-behind cache that fails is retried",
+)
+@click.option(
+    "-d",
+    "--dir",
+    "directory",
+    type=click.Path(file_okay=False),
+    help="root directory of file storage to sync with the COS bucket in both directions",
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=int,
+    default=WORKERS,
+    help="number of transfers at a time of the directory sync",
+)
+@click.option(
+    "--max-in-flight",
+    type=int,
+    default=MAX_IN_FLIGHT,
+    help="bytes of the transfers of the directory sync at a time",
+)
+@click.option(
+    "--prefer",
+    type=click.Choice(PREFERENCES),
+    default=None,
+    help="copy a game changed on both sides from this side, otherwise it is a conflict",
+)
+def sync_cli(
+    root,
+    table,
+    storage,
+    api_key,
+    cos_instance_id,
+    cos_service_endpoint,
+    cache,
+    retries,
+    directory,
+    workers,
+    max_in_flight,
+    prefer,
+):
+    """
+    push the bids in the write-behind cache to COS, check that COS has them and read the latest game from COS.
+    Sync the games of a file storage directory and the COS bucket in both directions, an interrupted sync
+    continues where it stopped.  Exit with 1 if a game is not synced USAGE:
+    bridgepy sync --cache DIR [options]
+    bridgepy sync --dir DIR [options]
+    """
+    if storage != STORAGE_COS:
+        raise click.UsageError("sync is with --cos")
+    if cache == None and directory == None:
+        raise click.UsageError("sync needs --cache or --dir")
+    remote = results_storage(
+        STORAGE_COS, root, api_key, cos_instance_id, cos_service_endpoint, table
+    )
+    ok = True
+    if cache != None:
+        from bridgepy.writebehind import ResultsWriteBehind
+
+        ok = sync_cache(ResultsWriteBehind(cache, remote), retries)
+    if directory != None:
+        local = results_storage(STORAGE_FILE, directory, table=table)
+        ok = sync_directory(local, remote, workers, max_in_flight, prefer) and ok
+    if not ok:
+        sys.exit(1)
+
+
+@click.command()
+@storage_options
+def archive_cli(root, table, storage, api_key, cos_instance_id, cos_service_endpoint):
+    """
+    pack the games in the bucket except the latest into one compressed archive object and delete them, the
+    archived games are still listed and read by rescore USAGE:
+    bridgepy archive [options]
+    """
+    if storage != STORAGE_COS:
+        raise click.UsageError("archives are for --cos")
+    result_storage = results_storage(
+        STORAGE_COS, root, api_key, cos_instance_id, cos_service_endpoint, table
+    )
+    archived = result_storage.archive()
+    if archived == None:
+        click.echo("no games to archive")
+        return
+    archive_key, keys, kept = archived
+    for key in keys:
+        click.echo("archived {}".format(key))
+    for key in kept:
+        click.echo("kept {}, stored since it was read".format(key))
+    click.echo("games {} archive {}".format(len(keys), archive_key))
+
+
+@click.command()
+@storage_options
+@click.option(
+    "--creds",
+    type=click.File("r"),
+    help="json service credentials of the COS instance with apikey and resource_instance_id, like creds.json",
+)
+def bucket_cli(
+    root, table, storage, api_key, cos_instance_id, cos_service_endpoint, creds
+):
+    """
+    create the COS bucket if it does not exist USAGE:
+    bridgepy bucket [--creds creds.json] [options]
+    """
+    if storage != STORAGE_COS:
+        raise click.UsageError("buckets are for --cos")
+    if creds != None:
+        credentials = json.load(creds)
+        api_key = credentials["apikey"]
+        cos_instance_id = credentials["resource_instance_id"]
+    result_storage = results_storage(
+        STORAGE_COS, root, api_key, cos_instance_id, cos_service_endpoint, table
+    )
+    if root in [bucket.name for bucket in result_storage.resource.buckets.all()]:
+        click.echo("bucket exists {}".format(root))
+        return
+    result_storage.get_or_create_bucket(root)
+    click.echo("bucket created {}".format(root))
+
+
+COMMANDS = {
+    "rescore": rescore_cli,
+    "catalog": catalog_cli,
+    "sync": sync_cli,
+    "archive": archive_cli,
+    "bucket": bucket_cli,
+}  # bridgepy <command> [options], otherwise bridgepy [options] [bid]
 
 
 def cli():
-    click_cli(auto_envvar_prefix=ENV_PREFIX)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](
+            args=sys.argv[2:],
+            prog_name="bridgepy " + sys.argv[1],
+            auto_envvar_prefix=ENV_PREFIX,
+        )
+    else:
+        click_cli(auto_envvar_prefix=ENV_PREFIX)
 
 
 if __name__ == "__main__":
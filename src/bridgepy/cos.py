@@ -1,44 +1,450 @@
+"""
+The ResultsCOS storage, games are objects in an IBM Cloud Object Storage bucket.
+This module imports ibm_boto3, it is only imported when COS is used
+"""
+import json
+import threading
+import weakref
 import ibm_boto3
 from ibm_botocore.client import Config
-import json
+from ibm_botocore.exceptions import ClientError
+from typing import (Dict, List, Iterator, Optional, Tuple)
+from . import metrics
+from .storage import (Result, check_table, hands_from_bytes, hands_to_bytes, rebase_hands, is_game_name, new_name_string, checkpoint_name, artifact_name, score_artifacts, ARTIFACT_CONTENT_TYPES, ARTIFACT_SUFFIXES, JSON_SUFFIX, PACKED_SUFFIX, CONFLICT_RETRIES,
+    is_archive_name, archive_bytes, archive_footer, archive_index, archived_hands, ARCHIVE_PREFIX, ARCHIVE_SUFFIX, ARCHIVE_TAIL)
+
+LATEST_KEY = "latest"
+ARTIFACT_GAME_ETAG = "game-etag" # metadata of a score artifact, see ResultsCOS.publish_artifacts()
+PUSH_IDS = "push-ids" # metadata of a game, the ids of the last pushes stored in it, see ResultsCOS.store_results()
+PUSH_IDS_KEPT = 16
+
+def push_ids(response: dict) -> List[str]:
+    "the PUSH_IDS of the game in the response of a GET or HEAD"
+    return response.get("Metadata", {}).get(PUSH_IDS, "").split()
+
+def is_no_such_key(e: ClientError) -> bool:
+    "True if the ClientError is the error returned for a missing object by a GET, PUT, HEAD or DELETE"
+    return e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound")
+
+def is_conflict(e: ClientError) -> bool:
+    "True if the ClientError is the error returned when the condition of a conditional write failed"
+    return e.response.get("Error", {}).get("Code") in CONFLICT_CODES
+
+cos_resources = {} # (endpoint_url, ibm_service_instance_id, ibm_api_key_id) -> s3 resource
+cos_resources_lock = threading.Lock()
+
+def cos_resource(ibm_api_key_id: str, ibm_service_instance_id: str, endpoint_url: str, max_pool_connections: Optional[int] = None):
+    """return the s3 resource for the credentials.  It is created on first use and kept for the life of the process
+    so warm cloud function invocations reuse the connections and the IAM token.  max_pool_connections, the number of
+    connections kept open, is the botocore default unless given and is set by the call that creates the resource"""
+    key = (endpoint_url, ibm_service_instance_id, ibm_api_key_id)
+    with cos_resources_lock:
+        resource = cos_resources.get(key)
+        if resource == None:
+            config = {} if max_pool_connections == None else {"max_pool_connections": max_pool_connections}
+            resource = ibm_boto3.resource('s3',
+                ibm_api_key_id=ibm_api_key_id,
+                ibm_service_instance_id=ibm_service_instance_id,
+                config=Config(signature_version='oauth', **config),
+                endpoint_url=endpoint_url,
+            )
+            cos_resources[key] = resource
+        return resource
+
+DELETE_BATCH = 1000 # the most keys of one delete_objects request
+
+CONFLICT_CODES = ("PreconditionFailed", "412", "ConditionalRequestConflict", "409")
+CONDITIONAL_WRITE_HEADERS = {"IfMatch": "If-Match", "IfNoneMatch": "If-None-Match"}
+conditional_write_clients = weakref.WeakSet()
+
+def register_conditional_writes(client):
+    """allow the IfMatch and IfNoneMatch parameters on put_object and delete_object, the S3 conditional writes that
+    the client model does not know about.  They are removed before the parameters are validated and sent as headers"""
+    def pop_conditions(params, context, **kwargs):
+        context["conditional_write_headers"] = {header: params.pop(name) for name, header in CONDITIONAL_WRITE_HEADERS.items() if name in params}
+    def add_headers(params, context, **kwargs):
+        params["headers"].update(context.get("conditional_write_headers", {}))
+    for operation in ("PutObject", "DeleteObject"):
+        client.meta.events.register_first("before-parameter-build.s3." + operation, pop_conditions)
+        client.meta.events.register_first("before-call.s3." + operation, add_headers)
+    conditional_write_clients.add(client)
+
+class ResultsCOS:
+    """
+    Games are objects in the bucket, the keys of the games of a table are prefixed by the table and a /.
+    archive() packs the games before the latest into an archive object, see storage.archive_bytes().  game_names()
+    and load_game() read the archives too, the index of each archive is read once and kept.
+    With artifacts each store also replaces the score artifact objects next to the game, see publish_artifacts()
+    """
+    def __init__(self, bucket_name: str, ibm_api_key_id: str, ibm_service_instance_id: str, endpoint_url: str, packed: bool = False, table: Optional[str] = None, conflict_retries: int = CONFLICT_RETRIES, artifacts: bool = False, max_pool_connections: Optional[int] = None):
+        self.bucket_name = bucket_name
+        self.max_pool_connections = max_pool_connections
+        self.artifacts = artifacts
+        self.conflict_retries = conflict_retries
+        self.table = check_table(table)
+        self.prefix = "" if table == None else table + "/"
+        self.suffix = PACKED_SUFFIX if packed else JSON_SUFFIX
+        self.ibm_api_key_id = ibm_api_key_id
+        self.ibm_service_instance_id = ibm_service_instance_id
+        self.endpoint_url = endpoint_url
+        self.key = None
+        self.etag = None
+        self.stored = []
+        self.push_ids = None # of the version read, None if it is not known
+        self._bucket = None
+        self.archived = None # game key -> (archive key, offset, length) of the archived games, see read_archives()
+        self.archive_keys = set() # of the archives read
+        self.game_objects = set() # keys of the games listed as objects by game_names(), read in place of an archived copy
+        self.checkpoint_key = None # of the game of the checkpoint read or stored
+        self.checkpoint_lines = {} # rubber -> json entry of the checkpoint of checkpoint_key
+
+    @property
+    def resource(self):
+        return cos_resource(self.ibm_api_key_id, self.ibm_service_instance_id, self.endpoint_url, self.max_pool_connections)
+
+    @property
+    def client(self):
+        client = self.resource.meta.client
+        if client not in conditional_write_clients:
+            register_conditional_writes(client)
+        return client
+
+    @property
+    def bucket(self):
+        "the bucket is not checked, a missing bucket will be reported by the first request"
+        if self._bucket == None:
+            self.client # conditional writes are registered
+            self._bucket = self.resource.Bucket(self.bucket_name)
+        return self._bucket
+
+    def get_bucket(self, bucket_name):
+        "return the bucket, raise ClientError if it does not exist"
+        self.client.head_bucket(Bucket=bucket_name)
+        return self.resource.Bucket(bucket_name)
+
+    def get_or_create_bucket(self, bucket_name):
+        "return the bucket, it is created and waited for if it does not exist.  See bridgepy bucket"
+        try:
+            return self.get_bucket(bucket_name)
+        except ClientError:
+            waiter_bucket_exists = self.client.get_waiter('bucket_exists')
+            self.resource.create_bucket(Bucket=bucket_name)
+            waiter_bucket_exists.wait(Bucket=bucket_name)
+            return self.get_bucket(bucket_name)
+
+    @metrics.timed(metrics.STORAGE_LATEST)
+    def get_latest_result_object(self):
+        "Return the key of the object that is latest, read from the LATEST_KEY pointer object when it exists"
+        try:
+            return self.bucket.Object(key=self.prefix + LATEST_KEY).get()["Body"].read().decode()
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+        return self.list_latest_result_object()
+
+    def list_latest_result_object(self):
+        "Return the key of the object that is latest by listing the bucket and store the LATEST_KEY pointer to it"
+        keys = sorted(self.game_keys())
+        if len(keys) > 0:
+            self.store_latest_result_object(keys[len(keys) - 1])
+            return keys[len(keys) - 1]
+        else:
+            return None
+
+    def table_keys(self) -> Iterator[str]:
+        "list the keys of the objects of the table"
+        for object_summary in self.bucket.objects.filter(Prefix=self.prefix):
+            if "/" not in object_summary.key[len(self.prefix):]:
+                yield object_summary.key
+
+    def game_keys(self) -> Iterator[str]:
+        "list the keys of the games of the table that are not archived"
+        for key in self.table_keys():
+            if is_game_name(key[len(self.prefix):]):
+                yield key
+
+    def game_names(self) -> Iterator[str]:
+        "the keys of all of the games of the table, archived or not, oldest first"
+        keys = set()
+        archive_keys = []
+        for key in self.table_keys():
+            name = key[len(self.prefix):]
+            if is_game_name(name):
+                keys.add(key)
+            elif is_archive_name(name):
+                archive_keys.append(key)
+        self.game_objects = set(keys)
+        keys.update(self.read_archives(archive_keys))
+        return iter(sorted(keys))
+
+    def read_archives(self, archive_keys: Optional[List[str]] = None) -> Dict[str, Tuple[str, int, int]]:
+        """read the indexes of the archives of the table, listed when archive_keys is None, that have not been read
+        and return the location of each archived game, see archived"""
+        if archive_keys == None:
+            archive_keys = [key for key in self.table_keys() if is_archive_name(key[len(self.prefix):])]
+        if self.archived == None:
+            self.archived = {}
+        for archive_key in archive_keys:
+            if archive_key not in self.archive_keys:
+                for name, offset, length in self.read_archive_index(archive_key):
+                    self.archived[self.prefix + name] = (archive_key, offset, length)
+                self.archive_keys.add(archive_key)
+        return self.archived
+
+    def read_archive_index(self, archive_key: str) -> List[Tuple[str, int, int]]:
+        "the (name, offset, length) of the games in the archive, read with one ranged GET of its end unless the index is long"
+        response = self.client.get_object(Bucket=self.bucket_name, Key=archive_key, Range="bytes=-{}".format(ARCHIVE_TAIL))
+        tail = response["Body"].read()
+        content_range = response.get("ContentRange")
+        size = len(tail) if content_range == None else int(content_range.rsplit("/", 1)[1])
+        offset, length = archive_footer(tail)
+        start = offset - (size - len(tail)) # of the index in the tail
+        if start >= 0:
+            return archive_index(tail[start:start + length])
+        return archive_index(self.read_range(archive_key, offset, length))
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket_name, Key=key, Range="bytes={}-{}".format(offset, offset + length - 1))
+        return response["Body"].read()
+
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def load_game(self, key: str) -> List[Result]:
+        """return the results of the game stored at a key from game_names(), the current game is not changed.
+        An archived game is read with one ranged GET of the archive once its index is read, a game stored again since
+        it was archived is read from its object once game_names() lists it"""
+        location = None if self.archived == None or key in self.game_objects else self.archived.get(key)
+        if location == None:
+            try:
+                return hands_from_bytes(self.bucket.Object(key=key).get()["Body"].read())
+            except ClientError as e:
+                if not is_no_such_key(e):
+                    raise
+            # it may have been archived since the archives were read
+            location = self.read_archives().get(key)
+            if location == None:
+                raise FileNotFoundError(key)
+        archive_key, offset, length = location
+        return archived_hands(self.read_range(archive_key, offset, length))
+
+    def archive(self) -> Optional[Tuple[str, List[str], List[str]]]:
+        """pack the games of the table except the latest into a new archive object, then delete the games with their
+        checkpoints and artifacts.  A game is deleted If-Match the ETag it was read with, a game stored since it was
+        read is kept and is read in place of its copy in the archive.  Return the key of the archive, the keys of the
+        games archived and the keys of the games kept, None if there are no games to archive"""
+        latest = self.get_latest_result_object()
+        keys = sorted(self.game_keys())
+        versions = {} # game key -> (ETag, results) read
+        for key in keys[:-1]:
+            version = None if key == latest else self.existing_version(key)
+            if version != None:
+                versions[key] = version[:2]
+        keys = sorted(versions)
+        if len(keys) == 0:
+            return None
+        archive_key = self.prefix + ARCHIVE_PREFIX + new_name_string(ARCHIVE_SUFFIX)
+        data = archive_bytes([(key[len(self.prefix):], versions[key][1]) for key in keys])
+        self.bucket.Object(key=archive_key).put(Body=data, IfNoneMatch="*")
+        # the archive is read back before anything is deleted
+        if [self.prefix + name for name, offset, length in self.read_archive_index(archive_key)] != keys:
+            raise RuntimeError("archive index does not match the games archived", archive_key)
+        self.read_archives([archive_key])
+        archived = []
+        kept = []
+        for key in keys:
+            try:
+                self.client.delete_object(Bucket=self.bucket_name, Key=key, IfMatch=versions[key][0])
+            except ClientError as e:
+                if is_conflict(e):
+                    # stored since it was read
+                    kept.append(key)
+                    continue
+                if not is_no_such_key(e):
+                    raise
+            archived.append(key)
+        deleted = []
+        for key in archived:
+            deleted.append(checkpoint_name(key))
+            deleted.extend(artifact_name(key, suffix) for suffix in ARTIFACT_SUFFIXES)
+        for i in range(0, len(deleted), DELETE_BATCH):
+            self.bucket.delete_objects(Delete={"Objects": [{"Key": key} for key in deleted[i:i + DELETE_BATCH]], "Quiet": True})
+        return archive_key, archived, kept
+
+    def store_latest_result_object(self, key: str):
+        "point the LATEST_KEY object at key"
+        self.bucket.Object(key=self.prefix + LATEST_KEY).put(Body=key)
 
-with open("creds.json") as f:
-    creds = json.load(f)
-
-api_key = creds["apikey"]
-service_instance_id = creds["resource_instance_id"]
-auth_endpoint = 'https://iam.bluemix.net/oidc/token'
-service_endpoint = 'https://s3-api.us-geo.objectstorage.softlayer.net'
-
-bridgepy_bucket = 'pfq-bridgepy'
-
-# ibm_auth_endpoint=auth_endpoint,
-cos = ibm_boto3.resource('s3',
-    ibm_api_key_id=api_key,
-    ibm_service_instance_id=service_instance_id,
-    config=Config(signature_version='oauth'),
-    endpoint_url=service_endpoint,
-)
-
-client = ibm_boto3.client('s3',
-    ibm_api_key_id=api_key,
-    ibm_service_instance_id=service_instance_id,
-    config=Config(signature_version='oauth'),
-    endpoint_url=service_endpoint,
-)
-waiter_bucket_exists = client.get_waiter('bucket_exists')
-waiter_bucket_not_exists = client.get_waiter('bucket_not_exists')
-
-bucket = cos.Bucket(bridgepy_bucket)
-bucket.load()
-buckets = {bucket.name: bucket for bucket in cos.buckets.all()}
-if bridgepy_bucket in buckets:
-    bucket = buckets[bridgepy_bucket]
-    print("bucket exists")
-else:
-    print("creating a bucket")
-    bucket = cos.create_bucket(Bucket=bridgepy_bucket)
-    print("waitin")
-    waiter_bucket_exists.wait(Bucket=bridgepy_bucket)
-
-print(bucket.name)
\ No newline at end of file
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def existing_results(self) -> List[Result]:
+        "return a list results from the last results file persisted, create a new file if no files exist"
+        key = self.get_latest_result_object()
+        if key == None:
+            return self.new_results()
+        try:
+            response = self.bucket.Object(key=key).get()
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+            # the pointer is stale, the game it points to was removed
+            key = self.list_latest_result_object()
+            if key == None:
+                return self.new_results()
+            response = self.bucket.Object(key=key).get()
+        return self.loaded(key, response["ETag"], hands_from_bytes(response["Body"].read()), push_ids(response))
+    def loaded(self, key: str, etag: str, hands: List[Result], push_ids: Optional[List[str]] = None) -> List[Result]:
+        "remember the game read from the bucket, store_results only replaces this version of it"
+        self.key = key
+        self.etag = etag
+        self.stored = list(hands)
+        self.push_ids = push_ids
+        return hands
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def existing_results_if_none_match(self, key: str, etag: Optional[str]) -> Optional[Tuple[str, List[Result]]]:
+        """conditional GET of the game stored at key, return None if its ETag is still etag, otherwise
+        return the new ETag and the list of results.  Raise FileNotFoundError if there is not one"""
+        try:
+            response = self.get_if_none_match(key, etag)
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+            raise FileNotFoundError(key)
+        if response == None:
+            return None
+        hands = self.loaded(key, response["ETag"], hands_from_bytes(response["Body"].read()), push_ids(response))
+        return response["ETag"], hands
+    def existing_version(self, key: str) -> Optional[Tuple[str, List[Result], List[str]]]:
+        """return the ETag, the list of results and the push ids of the game stored at key, None if there is not one.
+        The current game is not changed"""
+        try:
+            response = self.bucket.Object(key=key).get()
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+            return None
+        return response["ETag"], hands_from_bytes(response["Body"].read()), push_ids(response)
+    def current_version(self, key: str) -> Tuple[Optional[str], List[Result], List[str]]:
+        """return the ETag, the list of results and the push ids of the game stored at key like existing_version, an
+        archived game has no ETag.  Raise FileNotFoundError if there is not one"""
+        version = self.existing_version(key)
+        if version != None:
+            return version
+        location = self.read_archives().get(key)
+        if location == None:
+            raise FileNotFoundError(key)
+        archive_key, offset, length = location
+        return None, archived_hands(self.read_range(archive_key, offset, length)), []
+    def get_if_none_match(self, key: str, etag: Optional[str]) -> Optional[dict]:
+        "GET the object at key, return None if its ETag is still etag"
+        params = {"Bucket": self.bucket_name, "Key": key}
+        if etag != None:
+            params["IfNoneMatch"] = etag
+        try:
+            return self.client.get_object(**params)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                return None
+            raise
+    def existing_etag(self, key: str) -> str:
+        "HEAD the game stored at key and return its ETag, raise FileNotFoundError if there is not one"
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=key)["ETag"]
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+            raise FileNotFoundError(key)
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def existing_artifact(self, key: str, suffix: str) -> Tuple[Optional[str], bytes]:
+        """return the ETag of the version of the game stored at key that the score artifact with the suffix was
+        published for, None if it is not known, and the content.  Raise FileNotFoundError if there is not one"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=artifact_name(key, suffix))
+        except ClientError as e:
+            if not is_no_such_key(e):
+                raise
+            raise FileNotFoundError(artifact_name(key, suffix))
+        return response.get("Metadata", {}).get(ARTIFACT_GAME_ETAG), response["Body"].read()
+    def new_results(self) -> List[Result]:
+        "create a new results file and return an empty list of results"
+        self.key = None
+        self.etag = None
+        self.stored = []
+        self.push_ids = []
+        return []
+    @metrics.timed(metrics.STORAGE_STORE)
+    def store_results(self, hands:List[Result], push_id: Optional[str] = None) -> bool:
+        """store the results in the file created by new or existing_results.  The write only succeeds if the game
+        was not changed since it was read, If-Match the ETag read or If-None-Match * for a new game.  When it was
+        changed the bids and undos made to hands since it was read are applied again to the changed game, the hands
+        list is updated in place, and the store is retried.  A game archived since it was read is stored again as a
+        new object that is read in place of the archived copy.  Return True if hands was changed.
+        The PUSH_IDS metadata of the version read is kept with push_id added so the writer of an interrupted push
+        can tell if it was stored, see ResultsWriteBehind.push()"""
+        name = self.key
+        if name == None:
+            name = self.prefix + new_name_string(self.suffix)
+        rebased = False
+        for attempt in range(self.conflict_retries + 1):
+            conditions = {"IfNoneMatch": "*"} if self.etag == None else {"IfMatch": self.etag}
+            if self.push_ids == None and self.etag != None:
+                # the version was not read here, if it changed since the put fails and current_version reads them
+                try:
+                    response = self.client.head_object(Bucket=self.bucket_name, Key=name)
+                    self.push_ids = push_ids(response) if response["ETag"] == self.etag else []
+                except ClientError as e:
+                    if not is_no_such_key(e):
+                        raise
+                    self.push_ids = []
+            ids = (self.push_ids or []) + ([] if push_id == None else [push_id])
+            metadata = {PUSH_IDS: " ".join(ids[-PUSH_IDS_KEPT:])} if len(ids) > 0 else {}
+            try:
+                response = self.bucket.Object(key=name).put(Body=hands_to_bytes(name, hands), Metadata=metadata, **conditions)
+                break
+            except ClientError as e:
+                # If-Match a game that was archived is a missing key
+                if not (is_conflict(e) or (self.etag != None and is_no_such_key(e))) or attempt == self.conflict_retries:
+                    raise
+            etag, current, ids = self.current_version(name)
+            hands[:] = rebase_hands(self.stored, hands, current)
+            self.loaded(name, etag, current, ids)
+            rebased = True
+        if self.artifacts:
+            self.publish_artifacts(name, hands, response["ETag"])
+        if self.key == None:
+            # a new game, it is now the latest
+            self.store_latest_result_object(name)
+        self.loaded(name, response["ETag"], hands, ids[-PUSH_IDS_KEPT:])
+        return rebased
+    @metrics.timed(metrics.ARTIFACT_STORE)
+    def publish_artifacts(self, key: str, hands: List[Result], etag: str):
+        """put the score artifacts of the hands next to the game stored at key.  A put replaces the whole object
+        so a reader gets the previous or the new score, never part of one.  Each artifact keeps the ETag of the
+        version of the game it scores in its ARTIFACT_GAME_ETAG metadata, a reader compares it with the ETag of
+        the game so an artifact left by a store without artifacts, or published out of order, is not used"""
+        for suffix, content in score_artifacts(hands).items():
+            self.bucket.Object(key=artifact_name(key, suffix)).put(Body=content, ContentType=ARTIFACT_CONTENT_TYPES[suffix], Metadata={ARTIFACT_GAME_ETAG: etag.strip('"')})
+    def game_version(self) -> Optional[str]:
+        "the version of the current game as it was loaded or stored, its ETag"
+        return self.etag
+    @metrics.timed(metrics.CHECKPOINT_LOAD)
+    def existing_checkpoint(self) -> Optional[List[dict]]:
+        """return the entries of the scoring checkpoint stored next to the current game or None if there is not one.
+        The checkpoint read or stored last is kept so it is read once while the game is played"""
+        if self.key == None:
+            return None
+        if self.checkpoint_key != self.key:
+            try:
+                lines = self.bucket.Object(key=checkpoint_name(self.key)).get()["Body"].read().decode().splitlines()
+                self.checkpoint_lines = {json.loads(line)["rubber"]: line for line in lines}
+            except (ClientError, ValueError, KeyError, TypeError):
+                return None
+            self.checkpoint_key = self.key
+        return json.loads("[" + ",".join(line for rubber, line in sorted(self.checkpoint_lines.items())) + "]")
+    @metrics.timed(metrics.CHECKPOINT_STORE)
+    def store_checkpoint(self, entries: List[dict], replace: bool = True):
+        """replace the rubbers of the entries in the scoring checkpoint next to the current game, or all of them.
+        An object can not be appended to, the kept checkpoint is put with one line per rubber"""
+        if replace or self.checkpoint_key != self.key:
+            self.checkpoint_lines = {}
+        self.checkpoint_lines.update((entry["rubber"], json.dumps(entry)) for entry in entries)
+        self.checkpoint_key = self.key
+        body = "".join(line + "\n" for rubber, line in sorted(self.checkpoint_lines.items()))
+        self.bucket.Object(key=checkpoint_name(self.key)).put(Body=body)
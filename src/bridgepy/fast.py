@@ -1,85 +1,197 @@
-import bridgepy
+from bridgepy import aio, metrics, render
+from bridgepy.service import (
+    ScoreTables,
+    Table,
+    cors_origins_from_environment,
+    pool_size_from_environment,
+)
 import fastapi
-from starlette.responses import Response
-import click
-import pathlib
+from fastapi.middleware.cors import CORSMiddleware
+import json
+from pydantic import BaseModel
+from starlette.responses import Response, StreamingResponse
+from typing import Optional
 import uvicorn
 
+# The storage of each table is configured with the BRIDGEPY_ environment variables, see storage_from_environment.
+# The routes without /tables/{table} are for the default table.
+# Each table has its own lock, requests for different tables do not wait for each other and the storage
+# calls run in the bounded thread pool of bridgepy.aio so they do not block the event loop, BRIDGEPY_POOL_SIZE
+# threads and COS connections.  Concurrent reads of a game that is not in memory share one load, see Table.load().
+# Requests are counted by route and status and the spans of the bridgepy.metrics module are served at /metrics.
+# The pages of BRIDGEPY_CORS_ORIGINS, the GitHub Pages site by default, may read the scores and the events
 app = fastapi.FastAPI()
-hands = []
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=cors_origins_from_environment(),
+    allow_methods=["GET"],
+)
+tables = None
+
+
+@app.middleware("http")
+async def count_requests(request: fastapi.Request, call_next):
+    # a request that raises, or is cancelled, is counted as a 500
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        metrics.REQUESTS.inc(
+            method=request.method,
+            route=route.path if route != None else "unmatched",
+            status=status,
+        )
+    return response
+
+
+class Bid(BaseModel):
+    bid: str
+
+
+def get_table(table: Optional[str]) -> Table:
+    global tables
+    if tables == None:
+        aio.configure_pool(pool_size_from_environment())
+        tables = ScoreTables()
+    try:
+        return tables.get(table)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+
+def score_response(shard: Table, format: str) -> StreamingResponse:
+    """call with the table lock held and the game loaded.  The score is rendered while the lock is held, the game
+    can change as soon as it is released, the chunks are then streamed"""
+    if format not in render.FORMATS:
+        raise fastapi.HTTPException(
+            status_code=400, detail="format must be one of {}".format(render.FORMATS)
+        )
+    with metrics.span(metrics.RENDER):
+        chunks = list(shard.service.render(format))
+    return StreamingResponse(iter(chunks), media_type=render.CONTENT_TYPES[format])
+
+
+async def table_score(table: Optional[str], format: str):
+    shard = get_table(table)
+    await shard.load()
+    async with shard.lock:
+        if shard.service.hands == None:
+            # a bid failed since the load, the game is read again
+            await aio.run(shard.service.load)
+        return score_response(shard, format)
+
+
+async def table_bid(table: Optional[str], bid: Bid):
+    shard = get_table(table)
+    async with shard.lock:
+        try:
+            await aio.run(shard.service.bid, bid.bid)
+        except ValueError as e:
+            raise fastapi.HTTPException(status_code=400, detail=str(e))
+        return score_response(shard, render.JSON)
+
+
+async def table_undo(table: Optional[str]):
+    shard = get_table(table)
+    async with shard.lock:
+        await aio.run(shard.service.undo)
+        return score_response(shard, render.JSON)
+
+
+async def table_new_game(table: Optional[str]):
+    shard = get_table(table)
+    async with shard.lock:
+        await aio.run(shard.service.new_game)
+        return score_response(shard, render.JSON)
+
+
+def sse_message(event) -> str:
+    name, data = event
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+
+
+async def table_events(table: Optional[str]):
+    """server sent events, a score event with the whole score followed by a diff event for each bid
+    and a score event for each undo or new game, see bridgepy.service"""
+    shard = get_table(table)
+    await shard.load()
+    async with shard.lock:
+        if shard.service.hands == None:
+            await aio.run(shard.service.load)
+        broadcaster = shard.get_broadcaster()
+        queue = broadcaster.subscribe()
+
+    async def stream():
+        try:
+            while True:
+                yield sse_message(await queue.get())
+        finally:
+            broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 
 @app.get("/")
 async def index():
-    #return Response(content=score())
-    return Response("""
-      We | They
-  50 |   0
-  30 |   0
--------------
-  40 |   0
--------------
- 120 |   0
- """)
-
-@app.get("/hand")
-async def new_hand():
-    global hands
-    hands.append({len(hands):"hands"})
-    return hands
-
-@app.get("/hands")
-async def get_hands():
-    global hands
-    return hands
-
-@app.get("/hand/{id}")
-async def get_hands(id: int):
-    global hands
-    return hands[id]
-
-def score():
-    s = score_print(bridgepy.read_hands(bridgepy.existing_game_file(".")))
-    return s
-    #lines = s.split("\n")
-    #return "<br>".join(lines)
-
-def score_print(hands):
-    "Print the score for a set of hands by converting them to rubbers and printing the rubbers"
-    point_format = " {:4d} | {:4d}"
-    we_total = 0
-    they_total = 0
-    rs = bridgepy.rubbers(hands)
-    ret = ""
-    for r in rs:
-        ret += '  We  | They' + "\n"
-        above_count = max(len(r.above[0]), len(r.above[1]))
-        for i in range(above_count - 1, -1, -1):
-            we = 0 if len(r.above[0]) <= i else r.above[0][i]
-            they = 0 if len(r.above[1]) <= i else r.above[1][i]
-            ret += point_format.format(we, they) + "\n"
-        ret += "---------------" + "\n"
-        first_game = True
-        for game in r.games:
-            if first_game:
-                first_game = False
-            else:
-                ret += "- - - - - - - -" + "\n"
-            score_count = max(len(game[0]), len(game[1]))
-            for i in range(0, score_count):
-                we = 0 if len(game[0]) <= i else game[0][i]
-                they = 0 if len(game[1]) <= i else game[1][i]
-                ret += point_format.format(we, they) + "\n"
-        ret += "---------------" + "\n"
-        ret += point_format.format(r.total[0], r.total[1]) + "\n"
-        we_total += r.total[0]
-        they_total += r.total[1]
-    if len(rs) > 1:
-        # print total for all the rubbers
-        ret += "=================" + "\n"
-        ret += "== All Rubbers ==" + "\n"
-        ret += "=================" + "\n"
-        ret += point_format.format(we_total, they_total) + "\n"
-    return ret
+    return await table_score(None, render.TEXT)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.REGISTRY.text(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/score")
+async def score(format: str = render.TEXT):
+    return await table_score(None, format)
+
+
+@app.get("/events")
+async def events():
+    return await table_events(None)
+
+
+@app.post("/bid")
+async def bid(bid: Bid):
+    return await table_bid(None, bid)
+
+
+@app.post("/undo")
+async def undo():
+    return await table_undo(None)
+
+
+@app.post("/new")
+async def new_game():
+    return await table_new_game(None)
+
+
+@app.get("/tables/{table}/score")
+async def score_table(table: str, format: str = render.TEXT):
+    return await table_score(table, format)
+
+
+@app.get("/tables/{table}/events")
+async def events_table(table: str):
+    return await table_events(table)
+
+
+@app.post("/tables/{table}/bid")
+async def bid_table(table: str, bid: Bid):
+    return await table_bid(table, bid)
+
+
+@app.post("/tables/{table}/undo")
+async def undo_table(table: str):
+    return await table_undo(table)
+
+
+@app.post("/tables/{table}/new")
+async def new_game_table(table: str):
+    return await table_new_game(table)
+
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,184 @@
+"""
+Counters, histograms and timing spans kept in the process and written in the Prometheus text format.
+span() times a block into the SPAN_SECONDS histogram, the span names are the constants below.
+log_spans() also logs each span, for the command line and the cloud function where there is no /metrics
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+from typing import Iterator, Sequence
+
+# spans
+STORAGE_LOAD = "storage_load"  # read a game from a ResultsFile or ResultsCOS
+STORAGE_STORE = "storage_store"  # write a game
+STORAGE_LATEST = "storage_latest"  # find the latest game in a ResultsCOS
+CHECKPOINT_LOAD = "checkpoint_load"
+CHECKPOINT_STORE = "checkpoint_store"
+ARTIFACT_STORE = "artifact_store"  # publish the score artifacts of a game
+DECODE = "decode"  # json or packed bytes to results
+PARSE = "parse"  # bid string to result
+SCORE = "score"  # results to rubbers
+RENDER = "render"  # rubbers to text, json or html
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+def label_str(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    labels = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    "a value that only goes up, for each combination of the label values"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # type: dict[tuple[str, ...], float]
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def lines(self) -> Iterator[str]:
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} counter".format(self.name)
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield "{}{} {}".format(self.name, label_str(self.labelnames, key), value)
+
+
+class Histogram:
+    "the count of observations in cumulative buckets, their count and their sum for each combination of the label values"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # type: dict[tuple[str, ...], tuple[list[int], list[float]]] counts per bucket and +Inf, [count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0, 0.0]))
+            counts[index] += 1
+            total[0] += 1
+            total[1] += value
+
+    def count(self, **labels) -> int:
+        value = self.values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return 0 if value == None else value[1][0]
+
+    def sum(self, **labels) -> float:
+        value = self.values.get(tuple(str(labels[name]) for name in self.labelnames))
+        return 0.0 if value == None else value[1][1]
+
+    def lines(self) -> Iterator[str]:
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        with self.lock:
+            values = sorted((key, (list(counts), list(total))) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield "{}_bucket{} {}".format(self.name, label_str(self.labelnames, key, 'le="{}"'.format(le)), cumulative)
+            yield "{}_count{} {}".format(self.name, label_str(self.labelnames, key), total[0])
+            yield "{}_sum{} {}".format(self.name, label_str(self.labelnames, key), total[1])
+
+
+class Registry:
+    "the metrics of the process by name"
+
+    def __init__(self):
+        self.metrics = {}  # type: dict[str, object]
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def text(self) -> str:
+        "all of the metrics in the Prometheus text exposition format"
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "".join(line + "\n" for metric in metrics for line in metric.lines())
+
+
+REGISTRY = Registry()
+SPAN_SECONDS = REGISTRY.histogram("bridgepy_span_seconds", "seconds spent in each span", ["span"])
+SPAN_ERRORS = REGISTRY.counter("bridgepy_span_errors_total", "spans that raised an exception", ["span"])
+REQUESTS = REGISTRY.counter("bridgepy_requests_total", "HTTP requests", ["method", "route", "status"])
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@contextlib.contextmanager
+def span(name: str):
+    "time the block into SPAN_SECONDS, count it in SPAN_ERRORS if it raises and log it, see log_spans()"
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SPAN_ERRORS.inc(span=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        SPAN_SECONDS.observe(seconds, span=name)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("span %s %.6f", name, seconds)
+
+
+def timed(name: str):
+    "decorator that runs the function in a span"
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+span_handler = None  # type: logging.Handler | None
+
+
+def log_spans(enable: bool = True, stream=None):
+    "log each span to stream, stderr by default, or stop logging them"
+    global span_handler
+    if span_handler != None:
+        logger.removeHandler(span_handler)
+        span_handler = None
+    if enable:
+        span_handler = logging.StreamHandler(sys.stderr if stream == None else stream)
+        logger.addHandler(span_handler)
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.NOTSET)
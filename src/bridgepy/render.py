@@ -0,0 +1,136 @@
+"""
+Render the score of a list of rubbers.  walk() produces the rows of the score sheet once and each output format
+turns the rows into chunks of text, so a score can be streamed into a file, click.echo or an HTTP response
+without building the whole string
+"""
+import json
+from typing import TYPE_CHECKING, Callable, Iterator, List, Tuple
+
+if TYPE_CHECKING:
+    from .scoring import Rubber  # scoring imports this module
+
+TEXT = "text"
+JSON = "json"
+HTML = "html"
+FORMATS = [TEXT, JSON, HTML]
+CONTENT_TYPES = {TEXT: "text/plain", JSON: "application/json", HTML: "text/html"}
+
+# rows produced by walk()
+RUBBER = "rubber"  # (RUBBER, rubber index) start of a rubber
+ABOVE = "above"  # (ABOVE, we, they) points above the line, top row first
+GAME = "game"  # (GAME, game index) start of a game below the line
+BELOW = "below"  # (BELOW, we, they) points below the line in the current game
+RUBBER_TOTAL = "rubber_total"  # (RUBBER_TOTAL, we, they) end of a rubber
+TOTAL = "total"  # (TOTAL, we, they) total of all of the rubbers, last row
+
+
+def walk(rubbers: List["Rubber"]) -> Iterator[Tuple]:
+    "yield the rows of the score sheet for the rubbers, see the row constants above"
+    we_total = 0
+    they_total = 0
+    for rubber_index, r in enumerate(rubbers):
+        yield (RUBBER, rubber_index)
+        above_count = max(len(r.above[0]), len(r.above[1]))
+        for i in range(above_count - 1, -1, -1):
+            we = 0 if len(r.above[0]) <= i else r.above[0][i]
+            they = 0 if len(r.above[1]) <= i else r.above[1][i]
+            yield (ABOVE, we, they)
+        for game_index, game in enumerate(r.games):
+            yield (GAME, game_index)
+            score_count = max(len(game[0]), len(game[1]))
+            for i in range(0, score_count):
+                we = 0 if len(game[0]) <= i else game[0][i]
+                they = 0 if len(game[1]) <= i else game[1][i]
+                yield (BELOW, we, they)
+        yield (RUBBER_TOTAL, r.total[0], r.total[1])
+        we_total += r.total[0]
+        they_total += r.total[1]
+    yield (TOTAL, we_total, they_total)
+
+
+def text_chunks(rubbers: List["Rubber"]) -> Iterator[str]:
+    "the score as a text table, one line per chunk.  The total of all rubbers is only shown for more than one rubber"
+    point_format = " {:3d} | {:3d}\n"
+    for row in walk(rubbers):
+        kind = row[0]
+        if kind == RUBBER:
+            yield "  We | They\n"
+        elif kind == ABOVE or kind == BELOW:
+            yield point_format.format(row[1], row[2])
+        elif kind == GAME:
+            yield "-------------\n" if row[1] == 0 else "- - - - - - -\n"
+        elif kind == RUBBER_TOTAL:
+            yield "-------------\n"
+            yield point_format.format(row[1], row[2])
+            yield "\n"
+        elif kind == TOTAL and len(rubbers) > 1:
+            yield "=================\n"
+            yield "== All Rubbers ==\n"
+            yield "=================\n"
+            yield point_format.format(row[1], row[2])
+
+
+def json_chunks(rubbers: List["Rubber"]) -> Iterator[str]:
+    """the score as a json document, one chunk per rubber:
+    {"rubbers": [{"above": [[we, they], ...], "games": [[[we, they], ...], ...], "total": [we, they]}, ...],
+     "total": [we, they]}"""
+    rubber = None
+    game = None
+    separator = ""
+    yield '{"rubbers": ['
+    for row in walk(rubbers):
+        kind = row[0]
+        if kind == RUBBER:
+            rubber = {"above": [], "games": [], "total": None}
+        elif kind == ABOVE:
+            rubber["above"].append([row[1], row[2]])
+        elif kind == GAME:
+            game = []
+            rubber["games"].append(game)
+        elif kind == BELOW:
+            game.append([row[1], row[2]])
+        elif kind == RUBBER_TOTAL:
+            rubber["total"] = [row[1], row[2]]
+            yield separator + json.dumps(rubber)
+            separator = ", "
+        elif kind == TOTAL:
+            yield '], "total": ' + json.dumps([row[1], row[2]]) + "}"
+
+
+def html_chunks(rubbers: List["Rubber"]) -> Iterator[str]:
+    "the score as html tables, one table per rubber and one row per chunk"
+    row_format = "<tr><td>{}</td><td>{}</td></tr>\n"
+    for row in walk(rubbers):
+        kind = row[0]
+        if kind == RUBBER:
+            yield '<table class="rubber">\n<tr><th>We</th><th>They</th></tr>\n'
+        elif kind == ABOVE or kind == BELOW:
+            yield row_format.format(row[1], row[2])
+        elif kind == GAME:
+            separator_class = "line" if row[1] == 0 else "game"
+            yield '<tr class="{}"><td colspan="2"></td></tr>\n'.format(separator_class)
+        elif kind == RUBBER_TOTAL:
+            yield '<tr class="line"><td colspan="2"></td></tr>\n'
+            yield '<tr class="total"><td>{}</td><td>{}</td></tr>\n</table>\n'.format(
+                row[1], row[2]
+            )
+        elif kind == TOTAL and len(rubbers) > 1:
+            yield '<table class="all-rubbers">\n<tr class="total"><td>{}</td><td>{}</td></tr>\n</table>\n'.format(
+                row[1], row[2]
+            )
+
+
+RENDERERS = {TEXT: text_chunks, JSON: json_chunks, HTML: html_chunks}
+
+
+def render(rubbers: List["Rubber"], format: str = TEXT) -> Iterator[str]:
+    "yield the score of the rubbers in chunks of the format, one of FORMATS"
+    if format not in RENDERERS:
+        raise ValueError("format must be one of", FORMATS, format)
+    return RENDERERS[format](rubbers)
+
+
+def write(rubbers: List["Rubber"], out: Callable[[str], object], format: str = TEXT):
+    "write the score of the rubbers with the out function, like a file write or a partial of click.echo"
+    for chunk in render(rubbers, format):
+        out(chunk)
@@ -0,0 +1,449 @@
+"""
+Parse bids and score hands into rubbers.  This module does not import click or ibm_boto3 so scoring stays
+cheap to import, the command line is in cli.py
+"""
+import json
+import re
+from typing import Dict, List, Tuple
+from .storage import Result, Team, Suit, Honors, Double, pack_result, unpack_result
+from .storage import TEXT_ARTIFACT_SUFFIX, JSON_ARTIFACT_SUFFIX, TOTALS_ARTIFACT_SUFFIX
+from . import metrics, render
+
+BID_TEAMS = {"w": Team.WE, "t": Team.THEY}
+BID_SUITS = {suit.value: suit for suit in Suit}
+BID_DOUBLES = {"": Double.NONE, "d": Double.DOUBLE, "r": Double.REDOUBLE}
+BID_HONORS = {"": Honors.NONE, "0": Honors.H100, "5": Honors.H150}
+BID_DOWN_DIGITS = 9  # the count is one digit
+
+
+def bid_table() -> Dict[str, Result]:
+    """every valid bid string -> its Result.  Equal Results are the same object, shared with the hands read from
+    packed games, see storage.unpack_result"""
+    table = {}
+    for team_char, team in BID_TEAMS.items():
+        for bid in range(1, 8):
+            for suit_char, suit in BID_SUITS.items():
+                prefix = team_char + str(bid) + suit_char
+                bases = [(prefix + "m" + str(made), made - bid) for made in range(0, 8)]
+                bases += [(prefix + "d" + str(down), -down) for down in range(1, min(6 + bid, BID_DOWN_DIGITS) + 1)]
+                for base, over in bases:
+                    for double_char, double in BID_DOUBLES.items():
+                        for honors_char, honors in BID_HONORS.items():
+                            result = unpack_result(pack_result(Result(team, bid, suit, over, honors, double)))
+                            table[base + double_char + honors_char] = result
+                            table[base + honors_char + double_char] = result
+    return table
+
+
+bids = None  # the bid_table(), built on the first parse so importing stays cheap
+
+
+def bid_lookup() -> Dict[str, Result]:
+    global bids
+    if bids == None:
+        bids = bid_table()
+    return bids
+
+
+BID_TOKEN = re.compile(r"[^\s,;]+")
+
+
+class BidError(ValueError):
+    "a bid that can not be parsed, position is the index in the text of the first character that is not valid"
+
+    def __init__(self, bid: str, position: int, reason: str):
+        super().__init__("{} at position {} of {!r}".format(reason, position, bid))
+        self.bid = bid
+        self.position = position
+        self.reason = reason
+
+
+def bid_error(bid: str, offset: int = 0) -> BidError:
+    "return the BidError for a bid that is not in the bid_table(), the bid starts at offset in the text"
+
+    def error(position: int, reason: str) -> BidError:
+        return BidError(bid, offset + position, reason)
+
+    expected = [
+        (BID_TEAMS, "team must be w or t"),
+        ("1234567", "bid must be 1 to 7"),
+        (BID_SUITS, "suit must be n, s, h, d or c"),
+        ("md", "must be m for made or d for down"),
+    ]
+    for position, (allowed, reason) in enumerate(expected):
+        if position >= len(bid):
+            return error(position, "bid is incomplete, " + reason)
+        if bid[position] not in allowed:
+            return error(position, reason)
+    if len(bid) == 4:
+        return error(4, "bid is incomplete, number of tricks made or down is missing")
+    bid_tricks = int(bid[1])
+    if bid[3] == "m" and bid[4] not in "01234567":
+        return error(4, "tricks made must be 0 to 7")
+    if bid[3] == "d" and bid[4] not in "123456789"[: min(6 + bid_tricks, BID_DOWN_DIGITS)]:
+        return error(4, "tricks down must be 1 to {}".format(min(6 + bid_tricks, BID_DOWN_DIGITS)))
+    seen = ""
+    for position in range(5, len(bid)):
+        char = bid[position]
+        if char in "dr" and not any(c in seen for c in "dr"):
+            seen += char
+        elif char in "05" and not any(c in seen for c in "05"):
+            seen += char
+        else:
+            return error(position, "expected at most one of d or r for double and one of 0 or 5 for honors")
+    return error(0, "bid is not valid")
+
+
+def bid_parse(bid: str) -> Result:
+    """
+    bid: (wt)N(nshdc)(md)M[dr][05], like w3sm2 or w3sd1 both me team WE bid 3 SPADES made 8 tricks, down 1
+    0 (wt) - We or They, must choose one
+    1 N - bid number in excess of 6
+    2 (nshdc) - suit
+    3 (md) - one of either Made or Down
+    4 M - amount made or down
+    5/6 [dr] - optional double or redouble
+    5/6 [05] - optional 100 or 150 honors points
+    Examples:
+    w3sm25: WE, 3, SPADES, -1, honors 150
+    w3sd1d0: WE, 3, SPADES, -1, honors 100, doubled
+    w3sm3r: WE, 3, SPADES, 0, Redoubled
+    Raise BidError if the bid is not valid
+    """
+    result = bid_lookup().get(bid)
+    if result == None:
+        raise bid_error(bid)
+    return result
+
+
+def bid_parse_many(text: str) -> List[Result]:
+    """parse the bids in text, like a pasted score sheet or the contents of a file, separated by white space,
+    commas or semicolons.  Raise BidError with the position in text of the first bid that is not valid"""
+    table = bid_lookup()
+    results = []
+    for match in BID_TOKEN.finditer(text):
+        result = table.get(match.group())
+        if result == None:
+            raise bid_error(match.group(), match.start())
+        results.append(result)
+    return results
+
+
+def score_str(hands: List[Result]) -> str:
+    "generate a string score for a set of hands by converting them to rubbers and printing the rubbers"
+    return rubbers_str(rubbers(hands))
+
+
+def rubbers_str(rs: List["Rubber"], format: str = render.TEXT) -> str:
+    "generate a string score for a list of rubbers"
+    with metrics.span(metrics.RENDER):
+        return "".join(render.render(rs, format))
+
+
+class Rubber:
+    """
+    state of a rubber.  Call the add() function to add another hand result to the rubber
+    Example
+    we | they
+    50 | 
+    30 | 
+    ---------
+    70 |
+    30 |
+    - - - - - 
+       | 90
+    - - - - - 
+    180|90
+
+    above: [[30, 50], []] # above line, over tricks, honors, rubber bonus, ... arranged by time, print in reverse order
+    games: [ 
+                [[70, 30],[]], # game 1
+                [[], [90]] # game 2
+            ]
+    totoal: [100, 90] # just a sum of everything
+    """
+
+    def __init__(self):
+        self.above = [[], []]  # we and they list above the line
+        self.games = [
+            [[], []]
+        ]  # games below the line, list of games, each game has a list of contracts won for We and They
+        self.games_won = [0, 0]  # we, they games won
+        self.total = [0, 0]  # we and they totals
+
+    def to_json_dictionary(self) -> dict:
+        "Convert self to a jsonable dictionary"
+        return {
+            "above": self.above,
+            "games": self.games,
+            "games_won": self.games_won,
+            "total": self.total,
+        }
+
+    def from_json_dictionary(**rubber_dict: dict) -> "Rubber":
+        "Create a Rubber from a jsonable dictionary"
+        rubber = Rubber()
+        rubber.above = rubber_dict["above"]
+        rubber.games = rubber_dict["games"]
+        rubber.games_won = rubber_dict["games_won"]
+        rubber.total = rubber_dict["total"]
+        return rubber
+
+    def complete(self):
+        return 2 in self.games_won  # either team
+
+    def add(self, result: Result) -> bool:
+        """add the result to the rubber return True if the rubber is now complete"""
+        if self.complete():
+            raise Exception("Can not add to this Rubber, is is complete")
+        contract_winner = result.team.value
+        contract_loser = 1 - contract_winner
+        vulnerable = self.games_won[contract_winner] == 1
+        contract = (result.bid, result.suit, result.over, result.double, vulnerable)
+        points = CONTRACT_POINTS.get(contract)
+        if points == None:
+            # a result outside the table, like the over tricks of a game stored before bids were checked
+            points = contract_points(*contract)
+        under_points, above_points, set_points = points
+        if result.over >= 0:  # made contract
+            last_game = self.games[len(self.games) - 1]
+            last_game[contract_winner].append(under_points)
+            above_points = list(above_points)
+            if result.honors != Honors.NONE:
+                above_points.append(result.honors.value)
+            if sum(last_game[contract_winner]) >= 100:
+                self.games_won[
+                    contract_winner
+                ] += 1  # keep track of games won for each team
+                if self.complete():
+                    rubber_bonus = 700 if self.games_won[contract_loser] == 0 else 500
+                    above_points.append(rubber_bonus)
+                else:
+                    self.games.append([[], []])  # add a new game
+
+            self.above[contract_winner].extend(above_points)
+            self.total[contract_winner] += under_points
+            self.total[contract_winner] += sum(above_points)
+        else:  # set
+            self.above[contract_loser].append(set_points)
+            self.total[contract_loser] += set_points
+        return self.complete()
+
+
+#          vu   vd      vr   nu  nd      nr
+SET_TRICK1 = [100, 200, 0, 400, 50, 100, 0, 200]  # first set trick
+SET_TRICK23 = [100, 300, 0, 600, 50, 200, 0, 400]  # second and third
+SET_TRICK4 = [100, 300, 0, 600, 50, 300, 0, 600]  # fourth and later
+# indexed by 4 * (0 if vulnerable else 1) + double value - 1, double value is 1, 2, 4
+
+
+def contract_points(
+    bid: int, suit: Suit, over: int, double: Double, vulnerable: bool
+) -> Tuple[int, Tuple[int, ...], int]:
+    """the points of a contract: the points below the line and the tuple of points above the line, over tricks,
+    slam bonus and insult, for the declaring team when it is made and the points for the defending team when it
+    is set.  Honors and the rubber bonus are added by Rubber.add"""
+    if over < 0:
+        point_index = 4 * (0 if vulnerable else 1) + double.value - 1
+        set_tricks = -over
+        set_points = (
+            SET_TRICK1[point_index]
+            + SET_TRICK23[point_index] * min(set_tricks - 1, 2)
+            + SET_TRICK4[point_index] * max(set_tricks - 3, 0)
+        )
+        return 0, (), set_points
+    above_points = []
+    trick_value = 20 if suit == Suit.DIAMOND or suit == Suit.CLUB else 30
+    under_points = trick_value * bid * double.value
+    under_points += 10 if suit == Suit.NOTRUMP else 0
+    if over > 0:
+        if double == Double.NONE:
+            above_points.append(trick_value * over)
+        else:
+            above_points.append(50 * over * double.value * (2 if vulnerable else 1))
+    if bid == 6:
+        above_points.append(750 if vulnerable else 500)
+    if bid == 7:
+        above_points.append(1000 if vulnerable else 1500)
+    if double != Double.NONE:
+        above_points.append(50 if double == Double.DOUBLE else 100)  # insult
+    return under_points, tuple(above_points), 0
+
+
+def contract_table() -> Dict[Tuple[int, Suit, int, Double, bool], Tuple[int, Tuple[int, ...], int]]:
+    "(bid, suit, over, double, vulnerable) -> contract_points() for every possible contract"
+    return {
+        (bid, suit, over, double, vulnerable): contract_points(
+            bid, suit, over, double, vulnerable
+        )
+        for bid in range(1, 8)
+        for suit in Suit
+        for over in range(-(6 + bid), 8 - bid)
+        for double in Double
+        for vulnerable in (False, True)
+    }
+
+
+CONTRACT_POINTS = contract_table()
+
+
+@metrics.timed(metrics.SCORE)
+def rubbers(results: List[Result]) -> List[Rubber]:
+    rubber = Rubber()
+    ret = [rubber]
+    for result in results:
+        if rubber.add(result):
+            rubber = Rubber()
+            ret.append(rubber)
+    return ret
+
+
+def score_artifacts(hands: List[Result]) -> Dict[str, bytes]:
+    """the score of the hands rendered for readers, suffix -> content: the text score, the json score and the
+    totals {"hands": n, "rubbers": n, "we": points, "they": points}"""
+    rs = rubbers(hands)
+    with metrics.span(metrics.RENDER):
+        text = "".join(render.render(rs, render.TEXT))
+        score_json = "".join(render.render(rs, render.JSON))
+    totals = {
+        "hands": len(hands),
+        "rubbers": len(rs),
+        "we": sum(r.total[0] for r in rs),
+        "they": sum(r.total[1] for r in rs),
+    }
+    return {
+        TEXT_ARTIFACT_SUFFIX: text.encode(),
+        JSON_ARTIFACT_SUFFIX: score_json.encode(),
+        TOTALS_ARTIFACT_SUFFIX: json.dumps(totals).encode(),
+    }
+
+
+CHECKPOINT_SLACK = 16  # entries a checkpoint may grow by before it is rewritten, see Score.checkpoint()
+
+
+class Score:
+    """
+    Scored state of a game, the rubbers for the first hand_count hands.  The score is persisted as a
+    checkpoint next to the hands so adding a bid only needs to add one hand to the last rubber.
+    The checkpoint is a list of entries, each the state of one rubber, a later entry for a rubber replaces an
+    earlier one.  Each entry has the version of the stored game it was computed for, see game_version() of the
+    storages, the checkpoint is stale when the last entry is not for the version of the game that was loaded
+    """
+
+    VERSION = 3
+
+    def __init__(self):
+        self.rubbers = [Rubber()]
+        self.hand_count = 0
+        self.game_version = None
+        self.unchanged = 0  # rubbers that are the same in the stored checkpoint
+        self.entries = 0  # in the stored checkpoint, 0 when there is not one
+
+    def add(self, result: Result):
+        "add the result to the current rubber, starting a new rubber if it completes the current one"
+        self.unchanged = min(self.unchanged, len(self.rubbers) - 1)
+        if self.rubbers[-1].add(result):
+            self.rubbers.append(Rubber())
+        self.hand_count += 1
+
+    def replay(hands: List[Result]) -> "Score":
+        "Create a Score by adding all of the hands from the beginning"
+        score = Score()
+        for hand in hands:
+            score.add(hand)
+        return score
+
+    def checkpoint(self, game_version: str) -> Tuple[List[dict], bool]:
+        """return the checkpoint entries of the rubbers changed since the checkpoint was read or stored, for the
+        version of the game stored, and True if they replace the checkpoint.  Every rubber is written again
+        once the checkpoint has more than twice as many entries as rubbers"""
+        self.game_version = game_version
+        replace = (
+            self.entries == 0
+            or self.entries + len(self.rubbers) - self.unchanged
+            > 2 * len(self.rubbers) + CHECKPOINT_SLACK
+        )
+        first = 0 if replace else self.unchanged
+        entries = [
+            {
+                "version": Score.VERSION,
+                "game_version": game_version,
+                "hand_count": self.hand_count,
+                "rubber": i,
+                "state": self.rubbers[i].to_json_dictionary(),
+            }
+            for i in range(first, len(self.rubbers))
+        ]
+        self.entries = len(entries) if replace else self.entries + len(entries)
+        self.unchanged = len(self.rubbers)
+        return entries, replace
+
+    def from_checkpoint(entries: List[dict]) -> "Score":
+        "Create a Score from the entries of a checkpoint, raise ValueError if it is not the current version"
+        score = Score()
+        rubbers = []
+        for entry in entries:
+            if entry.get("version") != Score.VERSION:
+                raise ValueError("Score checkpoint version", entry.get("version"))
+            i = entry["rubber"]
+            if i > len(rubbers):
+                raise ValueError("Score checkpoint rubber missing", i)
+            rubber = Rubber.from_json_dictionary(**entry["state"])
+            if i == len(rubbers):
+                rubbers.append(rubber)
+            else:
+                rubbers[i] = rubber
+        if len(rubbers) == 0:
+            raise ValueError("Score checkpoint empty")
+        score.rubbers = rubbers
+        score.hand_count = entries[-1]["hand_count"]
+        score.game_version = entries[-1]["game_version"]
+        score.unchanged = len(rubbers)
+        score.entries = len(entries)
+        return score
+
+
+def game_score(results_storage, hands: List[Result]) -> Score:
+    """return the Score of the hands from the stored checkpoint, replay all of the hands if the checkpoint is missing
+    or was not stored for the version of the game that was loaded.  The SCORE span does not include reading the
+    checkpoint, that is the CHECKPOINT_LOAD span of the storage"""
+    entries = results_storage.existing_checkpoint()
+    with metrics.span(metrics.SCORE):
+        if entries:
+            try:
+                score = Score.from_checkpoint(entries)
+                if (
+                    score.game_version == results_storage.game_version()
+                    and score.hand_count == len(hands)
+                ):
+                    return score
+            except (KeyError, TypeError, ValueError):
+                pass
+        return Score.replay(hands)
+
+
+UNDO = "u"
+
+
+def apply_bid(results_storage, hands: List[Result], score: Score, bid: str) -> Score:
+    """apply the bid, or UNDO, to the hands and to their score then store both.  Return the new score,
+    undo replays the hands so score is not used and can be None"""
+    if bid == UNDO:
+        if len(hands) == 0:
+            return Score()
+        hands.pop()
+        with metrics.span(metrics.SCORE):
+            score = Score.replay(hands)
+    else:
+        with metrics.span(metrics.PARSE):
+            result = bid_parse(bid)
+        hands.append(result)
+        with metrics.span(metrics.SCORE):
+            score.add(result)
+    if results_storage.store_results(hands):
+        # the hands were changed by someone else, they are now the rebased hands
+        with metrics.span(metrics.SCORE):
+            score = Score.replay(hands)
+    entries, replace = score.checkpoint(results_storage.game_version())
+    results_storage.store_checkpoint(entries, replace)
+    return score
@@ -0,0 +1,283 @@
+"""
+The current game of a storage kept in memory for the HTTP service in fast.py
+"""
+import asyncio
+import copy
+import os
+from typing import Callable, Iterator, List, Optional, Tuple
+from .storage import check_table
+from .scoring import Score, apply_bid, bid_parse, game_score, UNDO
+from .cli import (
+    results_storage,
+    ENV_PREFIX,
+    ROOT,
+    STORAGE_COS,
+    COS_INSTANCE_ID,
+    COS_SERVICE_ENDPOINT,
+)
+from . import render
+from . import aio
+from .aio import POOL_SIZE
+
+
+def storage_from_environment(table: Optional[str] = None, environ=os.environ):
+    """create the storage for the table configured by the same BRIDGEPY_ environment variables as the command line:
+    BRIDGEPY_STORAGE file, sqlite or cos (default), BRIDGEPY_ROOT, BRIDGEPY_API_KEY, BRIDGEPY_COS_INSTANCE_ID
+    and BRIDGEPY_COS_SERVICE_ENDPOINT.  BRIDGEPY_ARTIFACTS, when set, publishes the score artifacts on each store.
+    A COS storage keeps pool_size_from_environment() connections open"""
+
+    def env(name: str, default: Optional[str] = None) -> Optional[str]:
+        return environ.get(ENV_PREFIX + "_" + name, default)
+
+    storage = env("STORAGE", STORAGE_COS)
+    kwargs = {}
+    if storage == STORAGE_COS:
+        kwargs["max_pool_connections"] = pool_size_from_environment(environ)
+    return results_storage(
+        storage,
+        env("ROOT", ROOT),
+        env("API_KEY"),
+        env("COS_INSTANCE_ID", COS_INSTANCE_ID),
+        env("COS_SERVICE_ENDPOINT", COS_SERVICE_ENDPOINT),
+        table=table,
+        artifacts=bool(env("ARTIFACTS")),
+        **kwargs
+    )
+
+
+def pool_size_from_environment(environ=os.environ) -> int:
+    "BRIDGEPY_POOL_SIZE, the threads that call the storages and the COS connections of each storage, see bridgepy.aio"
+    return int(environ.get(ENV_PREFIX + "_POOL_SIZE", POOL_SIZE))
+
+
+CORS_ORIGINS = "https://powellquiring.github.io"  # the GitHub Pages site of docs/, see README.md
+
+
+def cors_origins_from_environment(environ=os.environ) -> List[str]:
+    """BRIDGEPY_CORS_ORIGINS, the comma separated origins of the pages that may read the scores and the events,
+    the GitHub Pages site by default"""
+    origins = environ.get(ENV_PREFIX + "_CORS_ORIGINS", CORS_ORIGINS)
+    return [origin.strip() for origin in origins.split(",") if origin.strip() != ""]
+
+
+SCORE_EVENT = "score"  # data is the whole score, see score_event()
+DIFF_EVENT = "diff"  # data is what one bid added to the score, see diff_event()
+
+
+def rubber_totals(score: Score) -> List[int]:
+    return [sum(r.total[0] for r in score.rubbers), sum(r.total[1] for r in score.rubbers)]
+
+
+def score_event(score: Score) -> Tuple[str, dict]:
+    """(SCORE_EVENT, {"rubbers": [{"above": [we list, they list], "games": [[we list, they list], ...],
+    "total": [we, they], "games_won": [we, they]}, ...], "total": [we, they]})"""
+    return (
+        SCORE_EVENT,
+        {
+            "rubbers": copy.deepcopy([r.to_json_dictionary() for r in score.rubbers]),
+            "total": rubber_totals(score),
+        },
+    )
+
+
+def score_mark(score: Score) -> Tuple[int, List[int], int, List[int]]:
+    "the position in the score where the next hand will add points, used by diff_event()"
+    r = score.rubbers[-1]
+    return (
+        len(score.rubbers) - 1,
+        [len(r.above[0]), len(r.above[1])],
+        len(r.games) - 1,
+        [len(r.games[-1][0]), len(r.games[-1][1])],
+    )
+
+
+def diff_event(score: Score, mark: Tuple[int, List[int], int, List[int]]) -> Tuple[str, dict]:
+    """(DIFF_EVENT, {"rubber": index, "above": [new we, new they], "games": [{"game": index, "below": [new we,
+    new they]}, ...], "total": rubber [we, they], "games_won": rubber [we, they], "rubbers": number of rubbers,
+    "totals": all rubbers [we, they]}) the points added to the score since the mark was taken.  Applying
+    it to the score of the SCORE_EVENT for the mark, appending the new points to the lists, gives the current score.
+    Events are copies, they do not change with the score"""
+    rubber_index, above_count, game_index, below_count = mark
+    r = score.rubbers[rubber_index]
+    games = []
+    for i in range(game_index, len(r.games)):
+        start = below_count if i == game_index else [0, 0]
+        games.append(
+            {"game": i, "below": [r.games[i][0][start[0] :], r.games[i][1][start[1] :]]}
+        )
+    return (
+        DIFF_EVENT,
+        {
+            "rubber": rubber_index,
+            "above": [r.above[0][above_count[0] :], r.above[1][above_count[1] :]],
+            "games": games,
+            "total": list(r.total),
+            "games_won": list(r.games_won),
+            "rubbers": len(score.rubbers),
+            "totals": rubber_totals(score),
+        },
+    )
+
+
+class ScoreService:
+    """
+    The hands and the Score of the current game are loaded from the storage once and kept in memory.
+    Bids and undos update them in memory and are written through to the storage.
+    Callers serialize calls that change the game.
+    Each change is passed to the listeners as a DIFF_EVENT for a bid and a SCORE_EVENT otherwise
+    """
+
+    def __init__(self, result_storage):
+        self.result_storage = result_storage
+        self.hands = None
+        self.score = None
+        self.listeners = []  # type: List[Callable[[Tuple[str, dict]], None]]
+
+    def notify(self, event: Tuple[str, dict]):
+        for listener in self.listeners:
+            listener(event)
+
+    def load(self):
+        "load the current game from the storage if it is not already in memory"
+        if self.hands == None:
+            hands = self.result_storage.existing_results()
+            self.score = game_score(self.result_storage, hands)
+            self.hands = hands
+
+    def new_game(self):
+        self.hands = self.result_storage.new_results()
+        self.score = Score()
+        self.notify(score_event(self.score))
+
+    def bid(self, bid: str) -> Score:
+        "add the bid to the game, raise BidError, a ValueError, if the bid can not be parsed"
+        self.load()
+        bid_parse(bid)  # raise the BidError before anything is changed
+        mark = score_mark(self.score)
+        self.apply(bid)
+        self.notify(diff_event(self.score, mark))
+        return self.score
+
+    def undo(self) -> Score:
+        "remove the last hand from the game"
+        self.load()
+        if len(self.hands) == 0:
+            return self.score
+        self.apply(UNDO)
+        self.notify(score_event(self.score))
+        return self.score
+
+    def apply(self, bid: str) -> Score:
+        try:
+            self.score = apply_bid(self.result_storage, self.hands, self.score, bid)
+        except:
+            # the game in memory may not match the storage, load it again next time
+            self.hands = None
+            raise
+        return self.score
+
+    def render(self, format: str = render.TEXT) -> Iterator[str]:
+        "yield the score of the game in chunks of the format"
+        self.load()
+        return render.render(self.score.rubbers, format)
+
+
+class ScoreBroadcaster:
+    """
+    Fan the events of a ScoreService out to subscribers, like the server sent event streams in fast.py.
+    A subscriber starts with a SCORE_EVENT.  A subscriber that falls maxsize events behind is sent a SCORE_EVENT
+    instead of the events it missed.  Create it and subscribe in the event loop, the service can publish from any thread
+    """
+
+    def __init__(self, service: ScoreService, maxsize: int = 64):
+        self.service = service
+        self.maxsize = maxsize
+        self.queues = []  # type: List[asyncio.Queue]
+        self.loop = asyncio.get_running_loop()
+        service.listeners.append(self.publish)
+
+    def subscribe(self) -> asyncio.Queue:
+        self.service.load()
+        queue = asyncio.Queue(self.maxsize)
+        queue.put_nowait(score_event(self.service.score))
+        self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.queues.remove(queue)
+
+    def publish(self, event: Tuple[str, dict]):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self.deliver(event)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver, event)
+
+    def deliver(self, event: Tuple[str, dict]):
+        for queue in self.queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(score_event(self.service.score))
+
+
+class Table:
+    """
+    the shard of a table: its ScoreService, the lock that serializes access to it and its ScoreBroadcaster.
+    load() reads the game into the service once, concurrent callers share the read.  loads counts the shared reads started
+    """
+
+    def __init__(self, service: ScoreService):
+        self.service = service
+        self.lock = asyncio.Lock()
+        self.broadcaster = None
+        self.loading = None  # type: Optional[asyncio.Future]
+        self.loads = 0
+
+    async def load(self):
+        """load the game of the service if it is not in memory.  Concurrent calls share one in-flight load, it runs
+        in the pool of bridgepy.aio with the lock held.  A caller that is cancelled does not cancel the load"""
+        if self.service.hands != None:
+            return
+        loading = self.loading
+        if loading == None:
+            self.loads += 1
+            loading = self.loading = asyncio.ensure_future(self.read())
+        await asyncio.shield(loading)
+
+    async def read(self):
+        try:
+            async with self.lock:
+                if self.service.hands == None:
+                    await aio.run(self.service.load)
+        finally:
+            self.loading = None
+
+    def get_broadcaster(self) -> ScoreBroadcaster:
+        if self.broadcaster == None:
+            self.broadcaster = ScoreBroadcaster(self.service)
+        return self.broadcaster
+
+
+class ScoreTables:
+    """
+    The Table of each table id, None is the default table.  A Table is created on first use with the storage
+    from storage_factory(table).  Tables are independent, there is no lock across tables
+    """
+
+    def __init__(self, storage_factory: Callable[[Optional[str]], object] = storage_from_environment):
+        self.storage_factory = storage_factory
+        self.tables = {}  # type: dict[Optional[str], Table]
+
+    def get(self, table: Optional[str] = None) -> Table:
+        "raise ValueError for a table id that is not valid, see storage.check_table"
+        shard = self.tables.get(table)
+        if shard == None:
+            shard = Table(ScoreService(self.storage_factory(check_table(table))))
+            self.tables[table] = shard
+        return shard
@@ -0,0 +1,190 @@
+"""
+The ResultsSQLite storage, the games of every table in one SQLite database with one row per hand.
+The database is in WAL mode so readers, like the threads of the HTTP service, do not block the writer
+"""
+import json
+import sqlite3
+import threading
+import time
+from typing import (List, Iterator, Optional)
+from . import metrics
+from .storage import (Result, Team, Suit, Honors, Double, check_table, hands_diff, rebase_hands, CONFLICT_RETRIES)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    table_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (table_id, name)
+);
+CREATE TABLE IF NOT EXISTS hands (
+    game INTEGER NOT NULL REFERENCES games (id),
+    position INTEGER NOT NULL,
+    team INTEGER NOT NULL,
+    bid INTEGER NOT NULL,
+    suit TEXT NOT NULL,
+    over INTEGER NOT NULL,
+    honors INTEGER NOT NULL,
+    double INTEGER NOT NULL,
+    PRIMARY KEY (game, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hands_team ON hands (team, game);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    game INTEGER NOT NULL REFERENCES games (id),
+    rubber INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (game, rubber)
+) WITHOUT ROWID;
+"""
+BUSY_TIMEOUT = 30.0 # seconds a writer waits for another writer
+
+def hand_row(game: int, position: int, hand: Result) -> tuple:
+    return (game, position, hand.team.value, hand.bid, hand.suit.value, hand.over, hand.honors.value, hand.double.value)
+
+def row_hand(row: tuple) -> Result:
+    team, bid, suit, over, honors, double = row
+    return Result(Team(team), bid, Suit(suit), over, Honors(honors), Double(double))
+
+class ResultsSQLite:
+    """
+    Games are rows of the games table, named like the games of the other storages and unique in a table, the hands
+    of a game are rows of the hands table in the order they were played.  store_results deletes and inserts only the
+    hands that changed.  Each store increments the version of the game, a store by another connection since the game
+    was read is a conflict and is rebased like ResultsCOS.store_results.
+    A connection is opened for each thread
+    """
+    def __init__(self, path: str, table: Optional[str] = None, conflict_retries: int = CONFLICT_RETRIES):
+        self.path = path
+        self.table = check_table(table)
+        self.table_id = "" if table == None else table
+        self.conflict_retries = conflict_retries
+        self.local = threading.local()
+        self.game = None
+        self.name = None
+        self.version = None
+        self.stored = []
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection == None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+    def close(self):
+        "close the connection of this thread"
+        connection = getattr(self.local, "connection", None)
+        if connection != None:
+            connection.close()
+            self.local.connection = None
+    def read_game(self, game: int) -> List[Result]:
+        rows = self.connection.execute("SELECT team, bid, suit, over, honors, double FROM hands WHERE game = ? ORDER BY position", (game,))
+        return [row_hand(row) for row in rows]
+    def loaded(self, game: int, name: str, version: int, hands: List[Result]) -> List[Result]:
+        "remember the game read from the database, store_results only replaces this version of it"
+        self.game = game
+        self.name = name
+        self.version = version
+        self.stored = list(hands)
+        return hands
+    def game_version(self) -> str:
+        "the version of the current game as it was loaded or stored"
+        return str(self.version)
+    def new_results(self) -> List[Result]:
+        "create a new game and return an empty list of results"
+        name = time.strftime("%Y-%m-%d-%H-%M-%S")
+        try:
+            cursor = self.connection.execute("INSERT INTO games (table_id, name) VALUES (?, ?)", (self.table_id, name))
+        except sqlite3.IntegrityError:
+            raise FileExistsError(name)
+        return self.loaded(cursor.lastrowid, name, 0, [])
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def existing_results(self) -> List[Result]:
+        "return a list results from the latest game, create a new game if there are no games"
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            row = connection.execute("SELECT id, name, version FROM games WHERE table_id = ? ORDER BY name DESC LIMIT 1", (self.table_id,)).fetchone()
+            if row != None:
+                hands = self.read_game(row[0])
+        finally:
+            connection.execute("COMMIT")
+        if row == None:
+            return self.new_results()
+        return self.loaded(row[0], row[1], row[2], hands)
+    def game_names(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[str]:
+        "the names of the games of the table, oldest first, created from start up to end if given, see GameCatalog.between()"
+        sql = "SELECT name FROM games WHERE table_id = ?"
+        parameters = [self.table_id]
+        if start != None:
+            sql += " AND name >= ?"
+            parameters.append(start)
+        if end != None:
+            sql += " AND name < ?"
+            parameters.append(end)
+        rows = self.connection.execute(sql + " ORDER BY name", parameters).fetchall()
+        return iter([row[0] for row in rows])
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def load_game(self, name: str) -> List[Result]:
+        "return the results of the game named by game_names(), the current game is not changed"
+        row = self.connection.execute("SELECT id FROM games WHERE table_id = ? AND name = ?", (self.table_id, name)).fetchone()
+        if row == None:
+            raise FileNotFoundError(name)
+        return self.read_game(row[0])
+    @metrics.timed(metrics.STORAGE_STORE)
+    def store_results(self, hands: List[Result]) -> bool:
+        """store the changes to the hands since they were read or stored, the undone hands are deleted and the new
+        hands are inserted.  When the game was changed by another connection the bids and undos made to hands are
+        applied again to the changed game, the hands list is updated in place, and the store is retried.
+        Return True if hands was changed"""
+        connection = self.connection
+        rebased = False
+        for attempt in range(self.conflict_retries + 1):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = connection.execute("SELECT version FROM games WHERE id = ?", (self.game,)).fetchone()[0]
+                if version == self.version:
+                    removed, added = hands_diff(self.stored, hands)
+                    first = len(self.stored) - removed
+                    connection.execute("DELETE FROM hands WHERE game = ? AND position >= ?", (self.game, first))
+                    connection.executemany("INSERT INTO hands VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [hand_row(self.game, first + i, hand) for i, hand in enumerate(added)])
+                    connection.execute("UPDATE games SET version = ? WHERE id = ?", (version + 1, self.game))
+                    connection.execute("COMMIT")
+                    self.loaded(self.game, self.name, version + 1, hands)
+                    return rebased
+                current = self.read_game(self.game)
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            if attempt == self.conflict_retries:
+                raise RuntimeError("conflicting stores of game", self.name)
+            hands[:] = rebase_hands(self.stored, hands, current)
+            self.loaded(self.game, self.name, version, current)
+            rebased = True
+    @metrics.timed(metrics.CHECKPOINT_LOAD)
+    def existing_checkpoint(self) -> Optional[List[dict]]:
+        "return the entries of the scoring checkpoint of the current game, one row per rubber, or None if there is not one"
+        rows = self.connection.execute("SELECT entry FROM checkpoints WHERE game = ? ORDER BY rubber", (self.game,)).fetchall()
+        try:
+            return [json.loads(row[0]) for row in rows] if len(rows) > 0 else None
+        except ValueError:
+            return None
+    @metrics.timed(metrics.CHECKPOINT_STORE)
+    def store_checkpoint(self, entries: List[dict], replace: bool = True):
+        "replace the rows of the rubbers of the entries in the scoring checkpoint of the current game, or all of the rows"
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if replace:
+                connection.execute("DELETE FROM checkpoints WHERE game = ?", (self.game,))
+            connection.executemany("INSERT OR REPLACE INTO checkpoints (game, rubber, entry) VALUES (?, ?, ?)",
+                [(self.game, entry["rubber"], json.dumps(entry)) for entry in entries])
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
@@ -1,12 +1,24 @@
+import bisect
+import collections.abc
+import contextlib
+import fnmatch
+import hashlib
 import io
+import mmap
+import os
 import pathlib
-import click
 import json
-import ibm_boto3
+import re
+import struct
 import time
-from ibm_botocore.client import Config
 import enum
-from typing import (NamedTuple, List, IO)
+import zlib
+from typing import (NamedTuple, Dict, List, IO, Iterator, Optional, Tuple)
+from . import metrics
+try:
+    import fcntl
+except ImportError: # windows, updates of the game catalog are not serialized across processes
+    fcntl = None
 
 class Team(enum.Enum):
     WE = 0
@@ -68,127 +80,561 @@ def hands_from_json_file(f: IO[str]) -> List[Result]:
     out = json.load(f)
     return [Result.from_json_dictionary(**hand_json) for hand_json in out]
 
-def new_name_string() -> str:
-    return time.strftime("%Y-%m-%d-%H-%M-%S.json")
+# Packed binary games: a PACKED_HEADER followed by one little endian 16 bit code per hand, see pack_result()
+PACKED_MAGIC = b"BPYG"
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct("<4sBxxxI") # magic, version, hand count
+PACKED_HAND = struct.Struct("<H")
+PACKED_SUITS = list(Suit)
+PACKED_HONORS = [Honors.NONE, Honors.H100, Honors.H150]
+PACKED_DOUBLES = [Double.NONE, Double.DOUBLE, Double.REDOUBLE]
+PACKED_OVER_OFFSET = 13 # down 13 is the worst possible result
+PACKED_OVER_MAX = 31 - PACKED_OVER_OFFSET # the most over + PACKED_OVER_OFFSET that fits in 5 bits
 
-def new_game_file(dir_str: str) -> pathlib.Path:
-    file_name = new_name_string()
+def pack_result(result: Result) -> int:
+    """bit 0 team, 1-3 bid - 1, 4-6 suit, 7-11 over + PACKED_OVER_OFFSET, 12-13 honors, 14-15 double.
+    Raise ValueError for a field that does not fit"""
+    if not -PACKED_OVER_OFFSET <= result.over <= PACKED_OVER_MAX:
+        raise ValueError("over can not be packed", result.over)
+    if not 1 <= result.bid <= 8:
+        raise ValueError("bid can not be packed", result.bid)
+    return (result.team.value
+        | (result.bid - 1) << 1
+        | PACKED_SUITS.index(result.suit) << 4
+        | (result.over + PACKED_OVER_OFFSET) << 7
+        | PACKED_HONORS.index(result.honors) << 12
+        | PACKED_DOUBLES.index(result.double) << 14)
+
+packed_results = {} # code -> Result, every hand with the same code shares one Result
+
+def unpack_result(code: int) -> Result:
+    result = packed_results.get(code)
+    if result == None:
+        result = Result(
+            Team(code & 1),
+            (code >> 1 & 7) + 1,
+            PACKED_SUITS[code >> 4 & 7],
+            (code >> 7 & 31) - PACKED_OVER_OFFSET,
+            PACKED_HONORS[code >> 12 & 3],
+            PACKED_DOUBLES[code >> 14 & 3])
+        packed_results[code] = result
+    return result
+
+def pack_hands(hands: List[Result]) -> bytes:
+    "return the hands in the packed binary format"
+    return PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, len(hands)) + b"".join(PACKED_HAND.pack(pack_result(hand)) for hand in hands)
+
+def is_packed(data: bytes) -> bool:
+    return data[:len(PACKED_MAGIC)] == PACKED_MAGIC
+
+class PackedHands(collections.abc.Sequence):
+    """Read only sequence of the hands in a packed buffer, bytes, memoryview or mmap.  The buffer is not copied,
+    each Result is decoded when it is accessed"""
+    def __init__(self, buffer):
+        magic, version, count = PACKED_HEADER.unpack_from(buffer)
+        if magic != PACKED_MAGIC:
+            raise ValueError("not a packed game")
+        if version != PACKED_VERSION:
+            raise ValueError("unsupported packed game version", version)
+        self.view = memoryview(buffer)[PACKED_HEADER.size:PACKED_HEADER.size + count * PACKED_HAND.size]
+        if len(self.view) != count * PACKED_HAND.size:
+            raise ValueError("packed game is truncated")
+    def __len__(self) -> int:
+        return len(self.view) // PACKED_HAND.size
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return unpack_result(PACKED_HAND.unpack_from(self.view, index * PACKED_HAND.size)[0])
+    def __iter__(self) -> Iterator[Result]:
+        for (code,) in PACKED_HAND.iter_unpack(self.view):
+            yield unpack_result(code)
+    def release(self):
+        self.view.release()
+
+@contextlib.contextmanager
+def open_packed_file(path: pathlib.Path) -> Iterator[PackedHands]:
+    "memory map the packed game file at path, the PackedHands can only be used inside the with block"
+    with path.open(mode="rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        hands = PackedHands(m)
+        try:
+            yield hands
+        finally:
+            hands.release()
+
+@metrics.timed(metrics.DECODE)
+def hands_from_bytes(data: bytes) -> List[Result]:
+    "return the hands in data which is either a packed or a json game"
+    if is_packed(data):
+        return list(PackedHands(data))
+    return [Result.from_json_dictionary(**hand_json) for hand_json in json.loads(data)]
+
+@metrics.timed(metrics.DECODE)
+def hands_from_path(path: pathlib.Path) -> List[Result]:
+    "return the hands in the file at path which is either a packed or a json game"
+    with path.open(mode="rb") as f:
+        packed = is_packed(f.read(len(PACKED_MAGIC)))
+    if packed:
+        with open_packed_file(path) as hands:
+            return list(hands)
+    with path.open(mode="r") as f:
+        return hands_from_json_file(f)
+
+def hands_to_bytes(name: str, hands: List[Result]) -> bytes:
+    "return the hands in the format for the game named name, packed if it ends in PACKED_SUFFIX otherwise json"
+    if name.endswith(PACKED_SUFFIX):
+        return pack_hands(hands)
+    return json.dumps([hand.to_json_dictionary() for hand in hands]).encode()
+
+TABLE_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+def check_table(table: Optional[str]) -> Optional[str]:
+    "a table id names a directory or a key prefix, raise ValueError if it is not letters, digits, _ and -"
+    if table != None and not TABLE_PATTERN.fullmatch(table):
+        raise ValueError("table must be letters, digits, _ and -", table)
+    return table
+
+def hands_diff(old: List[Result], new: List[Result]) -> Tuple[int, List[Result]]:
+    "return the number of hands to remove from the end of old and the hands to append to turn old into new"
+    common = 0
+    for old_hand, new_hand in zip(old, new):
+        if old_hand != new_hand:
+            break
+        common += 1
+    return len(old) - common, new[common:]
+
+JSON_SUFFIX = ".json"
+PACKED_SUFFIX = ".bpk"
+GAME_SUFFIXES = (JSON_SUFFIX, PACKED_SUFFIX)
+
+# Archives of games: each game packed and compressed with zlib, then the index, json {"version": ARCHIVE_VERSION,
+# "games": [[name, offset, length], ...]}, then an ARCHIVE_FOOTER.  The index is read from the end of the archive,
+# then a game is read with one ranged read of its offset and length
+ARCHIVE_PREFIX = "archive-"
+ARCHIVE_SUFFIX = ".bpa"
+ARCHIVE_MAGIC = b"BPYA"
+ARCHIVE_VERSION = 1
+ARCHIVE_FOOTER = struct.Struct("<QI4s") # index offset, index length, magic
+ARCHIVE_TAIL = 65536 # bytes read from the end of an archive, enough for the index of a thousand games
+
+def is_archive_name(name: str) -> bool:
+    return name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_SUFFIX)
+
+def archive_bytes(games: List[Tuple[str, List[Result]]]) -> bytes:
+    "return the archive of the (name, hands) of each game"
+    chunks = []
+    index = []
+    offset = 0
+    for name, hands in games:
+        data = zlib.compress(pack_hands(hands))
+        index.append([name, offset, len(data)])
+        chunks.append(data)
+        offset += len(data)
+    index_data = json.dumps({"version": ARCHIVE_VERSION, "games": index}).encode()
+    chunks.append(index_data)
+    chunks.append(ARCHIVE_FOOTER.pack(offset, len(index_data), ARCHIVE_MAGIC))
+    return b"".join(chunks)
+
+def archive_footer(tail: bytes) -> Tuple[int, int]:
+    "return the offset and the length of the index from the last bytes of an archive"
+    if len(tail) < ARCHIVE_FOOTER.size:
+        raise ValueError("not a game archive")
+    offset, length, magic = ARCHIVE_FOOTER.unpack(tail[-ARCHIVE_FOOTER.size:])
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError("not a game archive")
+    return offset, length
+
+def archive_index(data: bytes) -> List[Tuple[str, int, int]]:
+    "return the (name, offset, length) of the games from the index of an archive"
+    index = json.loads(data)
+    if index.get("version") != ARCHIVE_VERSION:
+        raise ValueError("unsupported game archive version", index.get("version"))
+    return [(name, offset, length) for name, offset, length in index["games"]]
+
+def archived_hands(data: bytes) -> List[Result]:
+    "return the hands of a game read from an archive"
+    return hands_from_bytes(zlib.decompress(data))
+
+CONFLICT_RETRIES = 5 # times a store that conflicts with another writer is rebased and retried
+
+def rebase_hands(base: List[Result], local: List[Result], current: List[Result]) -> List[Result]:
+    """return the hands that result from applying the bids and undos that turned base into local to current,
+    where current is base as changed by someone else"""
+    removed, added = hands_diff(base, local)
+    if current[:len(base)] == base:
+        # current only added hands, keep them and drop the hands of base that local removed
+        return base[:len(base) - removed] + current[len(base):] + added
+    return current[:max(len(current) - removed, 0)] + added
+
+def new_name_string(suffix: str = JSON_SUFFIX) -> str:
+    return time.strftime("%Y-%m-%d-%H-%M-%S") + suffix
+
+def is_game_name(name: str) -> bool:
+    return name.endswith(GAME_SUFFIXES) and not name.endswith(ARTIFACT_SUFFIXES)
+
+def game_stem(game_name: str) -> str:
+    "the game name without the suffix that identifies the format"
+    return game_name.rsplit(".", 1)[0]
+
+CHECKPOINT_SUFFIX = ".score"
+
+def checkpoint_name(game_name: str) -> str:
+    "name of the scoring checkpoint stored next to the game named game_name"
+    return game_stem(game_name) + CHECKPOINT_SUFFIX
+
+# Score artifacts published next to a game so readers serve the score without scoring, see score_artifacts()
+TEXT_ARTIFACT_SUFFIX = ".txt"
+JSON_ARTIFACT_SUFFIX = ".score.json"
+TOTALS_ARTIFACT_SUFFIX = ".totals.json"
+ARTIFACT_SUFFIXES = (TEXT_ARTIFACT_SUFFIX, JSON_ARTIFACT_SUFFIX, TOTALS_ARTIFACT_SUFFIX)
+ARTIFACT_CONTENT_TYPES = {TEXT_ARTIFACT_SUFFIX: "text/plain", JSON_ARTIFACT_SUFFIX: "application/json", TOTALS_ARTIFACT_SUFFIX: "application/json"}
+
+def artifact_name(game_name: str, suffix: str) -> str:
+    "name of the score artifact with the suffix, one of ARTIFACT_SUFFIXES, stored next to the game named game_name"
+    return game_stem(game_name) + suffix
+
+def score_artifacts(hands: List[Result]) -> Dict[str, bytes]:
+    "the score artifacts of the hands, suffix -> content"
+    from .scoring import score_artifacts # scoring imports this module
+    return score_artifacts(hands)
+
+JOURNAL_SUFFIX = ".journal"
+COMPACT_EVERY = 64
+FSYNC_ALWAYS = "always" # fsync every journal append and every snapshot
+FSYNC_COMPACT = "compact" # fsync the snapshot written by a compaction
+FSYNC_NEVER = "never" # leave it to the operating system
+FSYNC_POLICIES = [FSYNC_ALWAYS, FSYNC_COMPACT, FSYNC_NEVER]
+
+def journal_name(game_name: str) -> str:
+    "name of the journal of bid and undo events stored next to the game named game_name"
+    return game_stem(game_name) + JOURNAL_SUFFIX
+
+def snapshot_sha1(path: pathlib.Path) -> str:
+    "the hash of the snapshot file at path kept in the first line of its journal, see ResultsFile.read_journal()"
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+def new_game_file(dir_str: str, suffix: str = JSON_SUFFIX) -> pathlib.Path:
+    file_name = new_name_string(suffix)
     directory = pathlib.Path(dir_str)
     file = directory / file_name
-    if file.exists():
+    if any((directory / (game_stem(file_name) + game_suffix)).exists() for game_suffix in GAME_SUFFIXES):
         raise FileExistsError()
-    file.write_text("[]")
+    file.write_bytes(hands_to_bytes(file_name, []))
     return file
     
-def existing_game_file(dir_str: str) -> pathlib.Path:
+GAME_FILE_PATTERN = "*-*-*-*-*-*.*" # the names of games start with the time, see new_name_string()
+
+def is_game_file_name(name: str) -> bool:
+    return fnmatch.fnmatch(name, GAME_FILE_PATTERN) and is_game_name(name)
+
+def game_files(dir_str: str) -> List[pathlib.Path]:
+    "the game files in the directory, oldest first"
     directory = pathlib.Path(dir_str)
-    paths = list(directory.glob("*-*-*-*-*-*.json"))
+    paths = [path for path in directory.glob(GAME_FILE_PATTERN) if is_game_name(path.name)]
+    paths.sort()
+    return paths
+
+def existing_game_file(dir_str: str) -> pathlib.Path:
+    paths = game_files(dir_str)
     if len(paths) == 0:
         raise FileNotFoundError()
-    paths.sort()
     return paths[-1]
 
-class ResultsFile:
+CATALOG_NAME = "catalog.json"
+CATALOG_LOCK_NAME = "catalog.lock"
+CATALOG_VERSION = 1
+
+class GameCatalog:
+    """
+    The sorted names of the games in a directory kept in the CATALOG_NAME file so the latest game and the games in a
+    range of dates are found without listing the directory.  Game names start with the time they were created so
+    sorted by name is sorted by time.  The file is replaced atomically and updates are serialized by a lock file.
+    A missing or unreadable catalog is rebuilt from a scan of the directory.  Games added or removed by something
+    else are drift, see drift() and rebuild().  The modification time of the catalog file is set to the modification
+    time of the directory when the catalog was written or last checked against it, see checked()
+    """
     def __init__(self, dir: str):
+        self.dir = pathlib.Path(dir)
+        self.path = self.dir / CATALOG_NAME
+        self.lock_file = None # while locked()
+    def games(self) -> List[str]:
+        "the names of the games, oldest first"
+        try:
+            with self.path.open(mode="r") as f:
+                catalog = json.load(f)
+            if catalog["version"] == CATALOG_VERSION:
+                return catalog["games"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        return self.rebuild()
+    def checked(self) -> List[str]:
+        """the names of the games, oldest first, checked against the directory.  When the directory was changed since
+        the catalog was written or last checked the names in it are scanned, not read, and the catalog is rebuilt if
+        they are not the games of the catalog, like a game copied in or downloaded by sync or one removed"""
+        games = self.games()
+        mtime = os.stat(self.dir).st_mtime_ns
+        if mtime != os.stat(self.path).st_mtime_ns:
+            found = sorted(entry.name for entry in os.scandir(self.dir) if is_game_file_name(entry.name))
+            if found != games:
+                return self.rebuild()
+            self.mark(mtime)
+        return games
+    def latest(self) -> Optional[str]:
+        "the name of the latest game or None if there are no games, see checked()"
+        games = self.checked()
+        return games[-1] if len(games) > 0 else None
+    def between(self, start: Optional[str] = None, end: Optional[str] = None) -> List[str]:
+        """the names of the games created from start up to but not including end, oldest first, see checked().  start
+        and end are times in the format of the names, or a prefix of it like 2020-01 or 2020-01-31-18, None is unbounded"""
+        games = self.checked()
+        first = 0 if start == None else bisect.bisect_left(games, start)
+        last = len(games) if end == None else bisect.bisect_left(games, end)
+        return games[first:last]
+    def add(self, name: str):
+        "add the name of a new game"
+        with self.locked():
+            games = self.games()
+            if name not in games:
+                bisect.insort(games, name)
+                self.write(games)
+    def rebuild(self) -> List[str]:
+        "replace the catalog with the games found by a scan of the directory and return them"
+        with self.locked():
+            games = [path.name for path in game_files(str(self.dir))]
+            self.write(games)
+            return games
+    def drift(self) -> Tuple[List[str], List[str]]:
+        "scan the directory and return the games in the catalog that are missing and the games that are not in the catalog"
+        games = self.games()
+        found = [path.name for path in game_files(str(self.dir))]
+        return sorted(set(games) - set(found)), sorted(set(found) - set(games))
+    def write(self, games: List[str]):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open(mode="w") as f:
+            json.dump({"version": CATALOG_VERSION, "games": games}, f)
+        os.replace(tmp_path, self.path)
+        self.mark(os.stat(self.dir).st_mtime_ns)
+    def mark(self, mtime: int):
+        "record that the catalog is up to date with the directory at its modification time mtime, see checked()"
+        os.utime(self.path, ns=(mtime, mtime))
+    @contextlib.contextmanager
+    def locked(self):
+        "hold the lock on the catalog, nested calls do not lock again"
+        if fcntl == None or self.lock_file != None:
+            yield
+            return
+        with (self.dir / CATALOG_LOCK_NAME).open(mode="a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.lock_file = lock_file
+            try:
+                yield
+            finally:
+                self.lock_file = None
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class ResultsFile:
+    """
+    Games are stored as a json or, when packed, a packed binary snapshot of the hands.  In journal mode store_results appends one line per bid
+    or undo to a journal next to the snapshot instead of rewriting it.  The first line of the journal is the
+    number of hands and the hash of the snapshot it applies to, see read_journal().  After compact_every events the journal
+    is compacted into a new snapshot.  fsync is one of the FSYNC_POLICIES.
+    The games of a table are kept in a sub directory named for the table.  The games are listed in a GameCatalog.
+    With artifacts each store also replaces the score artifacts next to the game, see publish_artifacts()
+    """
+    def __init__(self, dir: str, journal: bool = False, compact_every: int = COMPACT_EVERY, fsync: str = FSYNC_COMPACT, packed: bool = False, table: Optional[str] = None, artifacts: bool = False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of", FSYNC_POLICIES, fsync)
+        self.table = check_table(table)
         self.dir = dir
+        if table != None:
+            self.dir = os.path.join(dir, table)
+            os.makedirs(self.dir, exist_ok=True)
+        self.suffix = PACKED_SUFFIX if packed else JSON_SUFFIX
+        self.journal = journal
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.stored = []
+        self.journal_events = 0
+        self.snapshot = None # hash of the snapshot of the current game, see game_version()
+        self.artifacts = artifacts
+        self.catalog = GameCatalog(self.dir)
     def new_results(self) -> List[Result]:
         "create a new results file and return an empty list of results"
-        self.hands_path = new_game_file(self.dir)
+        self.hands_path = new_game_file(self.dir, self.suffix)
+        self.catalog.add(self.hands_path.name)
+        self.stored = []
+        self.journal_events = 0
+        self.snapshot = snapshot_sha1(self.hands_path)
         return []
+    @metrics.timed(metrics.STORAGE_LOAD)
     def existing_results(self) -> List[Result]:
         "return a list results from the last results file persisted, create a new file if no files exist"
+        name = self.catalog.latest()
+        if name != None and not (pathlib.Path(self.dir) / name).exists():
+            # the catalog has drifted, the latest game was removed
+            self.catalog.rebuild()
+            name = self.catalog.latest()
+        if name == None:
+            return self.new_results()
+        hands_path = pathlib.Path(self.dir) / name
+        hands = hands_from_path(hands_path)
+        self.hands_path = hands_path
+        self.snapshot = snapshot_sha1(hands_path)
+        self.journal_events = self.read_journal(hands, sha1=self.snapshot)
+        self.stored = list(hands)
+        return hands
+    def game_version(self) -> str:
+        "the version of the current game as it was loaded or stored, the hash of the snapshot and the number of journal events"
+        return "{}+{}".format(self.snapshot, self.journal_events)
+    def game_names(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[str]:
+        "the names of the games, oldest first, created from start up to end if given, see GameCatalog.between()"
+        return iter(self.catalog.between(start, end))
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def load_game(self, name: str) -> List[Result]:
+        "return the results of the game named by game_names() with its journal applied, the current game is not changed"
+        hands_path = pathlib.Path(self.dir) / name
+        hands = hands_from_path(hands_path)
+        self.read_journal(hands, hands_path)
+        return hands
+    def journal_path(self, hands_path: Optional[pathlib.Path] = None) -> pathlib.Path:
+        hands_path = self.hands_path if hands_path == None else hands_path
+        return hands_path.with_name(journal_name(hands_path.name))
+    def read_journal(self, hands: List[Result], hands_path: Optional[pathlib.Path] = None, sha1: Optional[str] = None) -> int:
+        """apply the events in the journal of the snapshot hands, the current game by default, return the number of events.
+        sha1 is the hash of the snapshot if it is known.
+        A journal left behind by an interrupted compaction is ignored, its first line does not match the length and the
+        hash of the snapshot.  A journal with a torn first line, or a first line without the hash, is corrupt and is
+        ignored too"""
+        hands_path = self.hands_path if hands_path == None else hands_path
         try:
-            hands_path = existing_game_file(self.dir)
+            f = self.journal_path(hands_path).open(mode="r")
         except FileNotFoundError:
-            return self.new_results()
-        with hands_path.open(mode="r") as f:
-            self.hands_path = hands_path
-            return hands_from_json_file(f)
+            return 0
+        with f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+            if header["base"] != len(hands) or header["sha1"] != (snapshot_sha1(hands_path) if sha1 == None else sha1):
+                return 0
+        except (IndexError, ValueError, KeyError, TypeError):
+            return 0
+        events = 0
+        for line in lines[1:]:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                break # torn write of the last line
+            if "bid" in event:
+                hands.append(Result.from_json_dictionary(**event["bid"]))
+            elif len(hands) > 0:
+                hands.pop()
+            events += 1
+        return events
+    @metrics.timed(metrics.STORAGE_STORE)
     def store_results(self, hands:List[Result]):
         "store the results in the file created by new or existing_results"
-        with self.hands_path.open(mode="w") as f:
-            hands_to_json_file(f, hands)
-
-class ResultsCOS:
-    def __init__(self, bucket_name: str, ibm_api_key_id: str, ibm_service_instance_id: str, endpoint_url: str):
-        print(bucket_name, ibm_api_key_id, ibm_service_instance_id, endpoint_url)
-
-        # ibm_api_key_id = "EUbuWkafzLMJnT3gMuGfenF4iOQy3mCxIKjGlsT7P7g1"
-        # ibm_service_instance_id = "crn:v1:bluemix:public:cloud-object-storage:global:a/713c783d9a507a53135fe6793c37cc74:4d533d24-ae88-471c-a86b-af2f29b9bd73::"
-        # ibm_service_instance_id = "crn:v1:bluemix:public:cloud-object-storage:global:a/713c783d9a507a53135fe6793c37cc74:4d533d24-ae88-471c-a86b-af2f29b9bd73::"
-        # endpoint_url = "https://s3.us-south.cloud-object-storage.appdomain.cloud"
-
-        self.client = ibm_boto3.client('s3',
-            ibm_api_key_id=ibm_api_key_id,
-            ibm_service_instance_id=ibm_service_instance_id,
-            config=Config(signature_version='oauth'),
-            endpoint_url=endpoint_url,
-        )
-        self.resource = ibm_boto3.resource('s3',
-            ibm_api_key_id=ibm_api_key_id,
-            ibm_service_instance_id=ibm_service_instance_id,
-            config=Config(signature_version='oauth'),
-            endpoint_url=endpoint_url,
-        )
-        #self.bucket = self.get_or_create_bucket(bucket_name)
-        self.bucket = self.resource.Bucket(bucket_name)
-        for b in self.client.list_buckets():
-            print(b)
-        print('a0')
-        for bo in self.client.list_objects(Bucket=bucket_name):
-            print(bo)
-        print('a1')
-        for o in self.bucket.objects.all():
-            print(o)
-        print('a2')
-
-    def get_bucket(self, bucket_name):
-        for b in self.client.list_buckets():
-            print(b)
-        for bo in self.client.list_objects(Bucket=bucket_name):
-            print(bo)
-        for o in self.bucket.objects.all():
-            print(o)
-        bucket.load()
-        bucket = self.resource.Bucket(bucket_name)
-        return bucket
-
-    def get_or_create_bucket(self, bucket_name):
-        try:
-            # self.client.head_bucket(Bucket=bucket_name) # raise exception if bucket_name does not exist
-            return self.get_bucket(bucket_name)
-        except:
-            waiter_bucket_exists = self.client.get_waiter('bucket_exists')
-            bucket = self.resource.create_bucket(Bucket=bucket_name)
-            waiter_bucket_exists.wait(Bucket=bucket_name)
-            return self.get_bucket()
-
-    def get_latest_result_object(self):
-        "Return the key of the object that is latest"
-        object_summaries = self.bucket.objects.all()
-        key_summary = {object_summary.key: object_summary for object_summary in self.bucket.objects.all()}
-        keys = sorted(key_summary.keys())
-        if len(keys) > 0:
-            return keys[len(keys) - 1]
+        if not self.journal:
+            self.compact(hands)
         else:
+            self.append_journal(hands)
+        if self.artifacts:
+            self.publish_artifacts(hands)
+    def append_journal(self, hands:List[Result]):
+        "append the bids and undos since the last store to the journal, compact when it is full"
+        removed, added = hands_diff(self.stored, hands)
+        if self.journal_events + removed + len(added) > self.compact_every:
+            self.compact(hands)
+            return
+        lines = [json.dumps({"undo": 1}) for i in range(removed)]
+        lines.extend(json.dumps({"bid": hand.to_json_dictionary()}) for hand in added)
+        if self.journal_events == 0:
+            lines.insert(0, json.dumps({"base": len(self.stored), "sha1": self.snapshot}))
+        with self.journal_path().open(mode="w" if self.journal_events == 0 else "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+            if self.fsync == FSYNC_ALWAYS:
+                f.flush()
+                os.fsync(f.fileno())
+        self.journal_events += removed + len(added)
+        self.stored = list(hands)
+    def compact(self, hands:List[Result]):
+        """atomically replace the snapshot with the hands and remove the journal.  A journal left by a crash before
+        it is removed no longer matches the hash of the snapshot.  When the snapshot already has the hands it is not
+        replaced and the journal is only removed, a crash before then leaves the game as it was before the store"""
+        data = hands_to_bytes(self.hands_path.name, hands)
+        journal_path = self.journal_path()
+        if not (journal_path.exists() and self.hands_path.read_bytes() == data):
+            tmp_path = self.hands_path.with_name(self.hands_path.name + ".tmp")
+            with tmp_path.open(mode="wb") as f:
+                f.write(data)
+                if self.fsync != FSYNC_NEVER:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.hands_path)
+        try:
+            journal_path.unlink()
+        except FileNotFoundError:
+            pass
+        self.journal_events = 0
+        self.snapshot = hashlib.sha1(data).hexdigest()
+        self.stored = list(hands)
+    def artifact_path(self, suffix: str, hands_path: Optional[pathlib.Path] = None) -> pathlib.Path:
+        hands_path = self.hands_path if hands_path == None else hands_path
+        return hands_path.with_name(artifact_name(hands_path.name, suffix))
+    @metrics.timed(metrics.ARTIFACT_STORE)
+    def publish_artifacts(self, hands: List[Result]):
+        """write the score artifacts of the hands next to the current game.  Each one is written to a temporary file
+        and renamed over the last one so a reader sees a whole score, the previous or the new one"""
+        for suffix, content in score_artifacts(hands).items():
+            path = self.artifact_path(suffix)
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+    def existing_artifact(self, suffix: str, name: Optional[str] = None) -> Optional[bytes]:
+        """return the score artifact with the suffix of the game named name, the latest game by default, or None if
+        there is not one or it is older than the snapshot or the journal of the game, left by a store without artifacts"""
+        name = self.catalog.latest() if name == None else name
+        if name == None:
             return None
+        hands_path = pathlib.Path(self.dir) / name
+        try:
+            path = self.artifact_path(suffix, hands_path)
+            stored = max(p.stat().st_mtime_ns for p in (hands_path, self.journal_path(hands_path)) if p.exists())
+            if path.stat().st_mtime_ns < stored:
+                return None
+            return path.read_bytes()
+        except (FileNotFoundError, ValueError):
+            return None
+    @metrics.timed(metrics.CHECKPOINT_LOAD)
+    def existing_checkpoint(self) -> Optional[List[dict]]:
+        "return the entries of the scoring checkpoint stored next to the current game or None if there is not one"
+        try:
+            with self.hands_path.with_name(checkpoint_name(self.hands_path.name)).open(mode="r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        try:
+            return json.loads("[" + ",".join(lines) + "]")
+        except ValueError:
+            pass
+        try:
+            # torn write of the last line, the entries before it are for an earlier version of the game
+            return json.loads("[" + ",".join(lines[:-1]) + "]")
+        except ValueError:
+            return None
+    @metrics.timed(metrics.CHECKPOINT_STORE)
+    def store_checkpoint(self, entries: List[dict], replace: bool = True):
+        "append the entries to the scoring checkpoint next to the current game, one line each, or replace it with them"
+        with self.hands_path.with_name(checkpoint_name(self.hands_path.name)).open(mode="w" if replace else "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
 
-    def existing_results(self) -> List[Result]:
-        "return a list results from the last results file persisted, create a new file if no files exist"
-        key = self.get_latest_result_object()
-        if key == None:
-            return self.new_results()
-        self.key = key
-        hand_jsons = json.load(self.bucket.Object(key=key).get()["Body"])
-        return [Result.from_json_dictionary(**hand_json) for hand_json in hand_jsons]
-    def new_results(self) -> List[Result]:
-        "create a new results file and return an empty list of results"
-        self.key = None
-        return []
-    def store_results(self, hands:List[Result]):
-        "store the results in the file created by new or existing_results"
-        name = self.key
-        if name == None:
-            name = new_name_string()
-        s = json.dumps([hand.to_json_dictionary() for hand in hands])
-        self.bucket.Object(key=name).put(Body=s)
\ No newline at end of file
+COS_NAMES = ("LATEST_KEY", "is_no_such_key", "cos_resources", "cos_resource", "CONFLICT_CODES", "register_conditional_writes", "ResultsCOS")
+
+def __getattr__(name: str):
+    "the COS backend moved to bridgepy.cos, it is imported on first use because ibm_boto3 is slow to import"
+    if name in COS_NAMES:
+        from . import cos
+        return getattr(cos, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,268 @@
+"""
+Sync the games of a ResultsFile directory and of a ResultsCOS bucket in both directions.  The games, checkpoints
+and artifacts of a table are compared by name and by the MD5 of the file and the ETag of the object.
+The manifest in the directory keeps the MD5 and the ETag of each name when it was last the same on both sides, so
+a difference is copied from the side that changed.  An upload is If-Match the ETag listed, or If-None-Match * for a
+new name, so an object changed since it was listed is a conflict.  Transfers run on a pool of threads with a bound
+on the bytes in flight.  Each transfer is recorded in the manifest as it completes so a sync that was interrupted
+resumes where it stopped.  Deletes are not synced, a name missing on one side is copied to it.
+Archives are not copied, a game archived in the bucket is downloaded from its archive and is only uploaded again
+when it is changed in the directory.  The checkpoints and artifacts of the archived games are not uploaded
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Collection, Dict, List, NamedTuple, Optional, Tuple
+from .storage import (ResultsFile, game_files, hands_to_bytes, is_game_name, is_archive_name, checkpoint_name, artifact_name, CHECKPOINT_SUFFIX, ARTIFACT_SUFFIXES)
+
+if TYPE_CHECKING:
+    from .cos import ResultsCOS
+
+MANIFEST_PREFIX = "sync-"
+MANIFEST_SUFFIX = ".manifest" # not a game suffix, whatever the name of the bucket
+MANIFEST_VERSION = 1
+MANIFEST_INTERVAL = 1.0 # seconds between writes of the manifest while transfers complete
+WORKERS = 8
+MAX_IN_FLIGHT = 64 * 1024 * 1024 # bytes read or written by the transfers at a time
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+CONFLICT = "conflict" # changed on both sides, see prefer in sync()
+PREFER_LOCAL = "local"
+PREFER_REMOTE = "remote"
+PREFERENCES = [PREFER_LOCAL, PREFER_REMOTE]
+
+TIME_NAME = re.compile(r"\d{4}-\d\d-\d\d-\d\d-\d\d-\d\d\.")
+
+def is_synced_name(name: str) -> bool:
+    "True for the games, checkpoints and artifacts, not for the archives, the catalog, journals or the manifest"
+    return TIME_NAME.match(name) != None and (is_game_name(name) or name.endswith((CHECKPOINT_SUFFIX,) + ARTIFACT_SUFFIXES))
+
+def compact_journals(dir: str) -> int:
+    "compact the journal of each game in the directory into its snapshot so the files have every hand, return the number compacted"
+    result_file = ResultsFile(dir)
+    compacted = 0
+    for path in game_files(dir):
+        if result_file.journal_path(path).exists():
+            result_file.hands_path = path
+            result_file.compact(result_file.load_game(path.name))
+            compacted += 1
+    return compacted
+
+def plan(local: Dict[str, str], remote: Dict[str, str], synced: Dict[str, List[str]], prefer: Optional[str] = None, archived: Collection[str] = ()) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """return the names that are the same on both sides and the (UPLOAD, DOWNLOAD or CONFLICT, name) of the rest.
+    local is name -> MD5 of the file, remote is name -> ETag of the object and synced is name -> [MD5, ETag] when
+    the name was last the same.  archived are the names of the games in the archives of the bucket, a game that is
+    not an object is downloaded from its archive and is uploaded only when the file changed since it was synced.
+    A name changed on both sides is copied from the prefer side, PREFER_LOCAL or PREFER_REMOTE, otherwise it is a
+    CONFLICT"""
+    same = []
+    actions = []
+    for name in sorted(set(local) | set(remote) | set(archived)):
+        md5 = local.get(name)
+        etag = remote.get(name)
+        base_md5, base_etag = synced.get(name, (None, None))
+        if etag == None and name in archived:
+            if md5 == None:
+                actions.append((DOWNLOAD, name))
+            elif md5 == base_md5:
+                same.append(name)
+            elif base_md5 != None or prefer == PREFER_LOCAL:
+                actions.append((UPLOAD, name))
+            elif prefer == PREFER_REMOTE:
+                actions.append((DOWNLOAD, name))
+            else:
+                actions.append((CONFLICT, name))
+        elif md5 == etag or (md5 == base_md5 and etag == base_etag):
+            same.append(name)
+        elif etag == None or (md5 != base_md5 and etag == base_etag):
+            actions.append((UPLOAD, name))
+        elif md5 == None or (md5 == base_md5 and etag != base_etag):
+            actions.append((DOWNLOAD, name))
+        elif prefer == PREFER_LOCAL:
+            actions.append((UPLOAD, name))
+        elif prefer == PREFER_REMOTE:
+            actions.append((DOWNLOAD, name))
+        else:
+            actions.append((CONFLICT, name))
+    return same, actions
+
+class ByteBudget:
+    "bytes in flight, acquire() waits until the bytes fit.  An object larger than the budget is transferred alone"
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+    def acquire(self, size: int):
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+    def release(self, size: int):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+class SyncStats(NamedTuple):
+    "what sync() did"
+    uploaded: List[str]
+    downloaded: List[str]
+    same: int
+    conflicts: List[str]
+    failed: List[Tuple[str, str]] # (name, error)
+    bytes: int
+    seconds: float
+
+class Manifest:
+    """
+    The manifest of a directory and a bucket, json {"version": MANIFEST_VERSION, "hashes": {name: [size, mtime_ns, MD5]},
+    "synced": {name: [MD5, ETag]}}.  hashes keeps the MD5 of the files so a file is only hashed when it changes
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.hashes = {}
+        self.synced = {}
+        self.lock = threading.RLock()
+        self.written = time.monotonic()
+        try:
+            with path.open(mode="r") as f:
+                manifest = json.load(f)
+            if manifest["version"] == MANIFEST_VERSION:
+                self.hashes = manifest["hashes"]
+                self.synced = manifest["synced"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+    def md5(self, path: pathlib.Path) -> str:
+        "the MD5 of the file, hashed if it changed since it was last hashed"
+        stat = path.stat()
+        cached = self.hashes.get(path.name)
+        if cached != None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        md5 = hashlib.md5(path.read_bytes()).hexdigest()
+        self.hashes[path.name] = [stat.st_size, stat.st_mtime_ns, md5]
+        return md5
+    def record(self, name: str, md5: str, etag: str, stat: Optional[os.stat_result] = None):
+        "the name is the same on both sides, the manifest is written if it was not written for MANIFEST_INTERVAL"
+        with self.lock:
+            self.synced[name] = [md5, etag]
+            if stat != None:
+                self.hashes[name] = [stat.st_size, stat.st_mtime_ns, md5]
+            if time.monotonic() - self.written > MANIFEST_INTERVAL:
+                self.write()
+    def write(self):
+        with self.lock:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with tmp_path.open(mode="w") as f:
+                json.dump({"version": MANIFEST_VERSION, "hashes": self.hashes, "synced": self.synced}, f)
+            os.replace(tmp_path, self.path)
+            self.written = time.monotonic()
+
+def sync(local: ResultsFile, remote: "ResultsCOS", workers: int = WORKERS, max_in_flight: int = MAX_IN_FLIGHT, prefer: Optional[str] = None, progress: Optional[Callable[[str, str, int], None]] = None) -> SyncStats:
+    """sync the games of the local directory and the remote bucket, see the module.  progress is called with the
+    action, the name and the bytes of each transfer as it completes.  Journals are compacted first.  The catalog of the
+    directory is rebuilt when games are downloaded and the latest pointer of the bucket is updated when games are uploaded"""
+    from ibm_botocore.exceptions import ClientError
+    from .cos import is_conflict
+    start = time.perf_counter()
+    dir = pathlib.Path(local.dir)
+    compact_journals(local.dir)
+    manifest = Manifest(dir / (MANIFEST_PREFIX + remote.bucket_name + MANIFEST_SUFFIX))
+    paths = {entry.name: pathlib.Path(entry.path) for entry in os.scandir(dir) if entry.is_file() and is_synced_name(entry.name)}
+    local_md5 = {name: manifest.md5(path) for name, path in paths.items()}
+    remote_sizes = {}
+    remote_etags = {}
+    archive_keys = []
+    for object_summary in remote.bucket.objects.filter(Prefix=remote.prefix):
+        name = object_summary.key[len(remote.prefix):]
+        if "/" in name:
+            continue
+        if is_synced_name(name):
+            remote_sizes[name] = object_summary.size
+            remote_etags[name] = object_summary.e_tag.strip('"')
+        elif is_archive_name(name):
+            archive_keys.append(object_summary.key)
+    archived = set()
+    for key, (archive_key, offset, length) in remote.read_archives(archive_keys).items():
+        name = key[len(remote.prefix):]
+        if name not in remote_etags:
+            archived.add(name)
+            remote_sizes[name] = length
+    # archive() deleted them with the game
+    derived = set(checkpoint_name(name) for name in archived) | set(artifact_name(name, suffix) for name in archived for suffix in ARTIFACT_SUFFIXES)
+    local_md5 = {name: md5 for name, md5 in local_md5.items() if name not in derived or name in remote_etags}
+    same, actions = plan(local_md5, remote_etags, manifest.synced, prefer, archived)
+    for name in same:
+        if name in remote_etags:
+            manifest.synced[name] = [local_md5[name], remote_etags[name]]
+    client = remote.client
+    budget = ByteBudget(max_in_flight)
+
+    def upload(name: str) -> int:
+        data = paths[name].read_bytes()
+        conditions = {"IfNoneMatch": "*"} if name not in remote_etags else {"IfMatch": '"{}"'.format(remote_etags[name])}
+        response = client.put_object(Bucket=remote.bucket_name, Key=remote.prefix + name, Body=data, **conditions)
+        manifest.record(name, hashlib.md5(data).hexdigest(), response["ETag"].strip('"'))
+        return len(data)
+
+    def download(name: str) -> int:
+        if name in archived:
+            data = hands_to_bytes(name, remote.load_game(remote.prefix + name))
+            etag = None
+        else:
+            response = client.get_object(Bucket=remote.bucket_name, Key=remote.prefix + name)
+            data = response["Body"].read()
+            etag = response["ETag"].strip('"')
+        path = dir / name
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        manifest.record(name, hashlib.md5(data).hexdigest(), etag, path.stat())
+        return len(data)
+
+    def transfer(action: str, name: str, size: int) -> int:
+        try:
+            return (upload if action == UPLOAD else download)(name)
+        finally:
+            budget.release(size)
+
+    uploaded = []
+    downloaded = []
+    conflicts = [name for action, name in actions if action == CONFLICT]
+    failed = []
+    transferred = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = {}
+            for action, name in actions:
+                if action == CONFLICT:
+                    continue
+                size = paths[name].stat().st_size if action == UPLOAD else remote_sizes[name]
+                budget.acquire(size)
+                futures[executor.submit(transfer, action, name, size)] = (action, name)
+            for future in concurrent.futures.as_completed(futures):
+                action, name = futures[future]
+                try:
+                    nbytes = future.result()
+                except Exception as e:
+                    if action == UPLOAD and isinstance(e, ClientError) and is_conflict(e):
+                        # the object was changed since it was listed
+                        conflicts.append(name)
+                    else:
+                        failed.append((name, str(e)))
+                    continue
+                transferred += nbytes
+                (uploaded if action == UPLOAD else downloaded).append(name)
+                if progress != None:
+                    progress(action, name, nbytes)
+    finally:
+        manifest.write()
+    if any(is_game_name(name) for name in downloaded):
+        local.catalog.rebuild()
+    if any(is_game_name(name) for name in uploaded):
+        remote.list_latest_result_object()
+    return SyncStats(sorted(uploaded), sorted(downloaded), len(same), conflicts, failed, transferred, time.perf_counter() - start)
@@ -0,0 +1,258 @@
+"""
+The ResultsWriteBehind storage, a cache on the local disk in front of a ResultsCOS for the command line.  A store
+is committed to the local state file so a bid is scored without waiting for COS, flush() pushes the changes to COS
+"""
+import contextlib
+import json
+import os
+import pathlib
+import time
+import uuid
+from typing import TYPE_CHECKING, List, Optional
+from . import metrics
+from .storage import Result, new_name_string, rebase_hands, fcntl
+
+if TYPE_CHECKING:
+    from .cos import ResultsCOS
+
+STATE_NAME = "writebehind.json"
+LOCK_NAME = "writebehind.lock"
+STATE_VERSION = 1
+FLUSH_RETRIES = 3 # times a push that failed is retried by flush()
+FLUSH_BACKOFF = 0.5 # seconds before the first retry, doubled for each retry
+
+def hands_json(hands: List[Result]) -> List[dict]:
+    return [hand.to_json_dictionary() for hand in hands]
+
+def json_hands(hands: List[dict]) -> List[Result]:
+    return [Result.from_json_dictionary(**hand) for hand in hands]
+
+def is_pending(game: dict) -> bool:
+    "True if the hands of the game are not the hands in COS"
+    return game["hands"] != game["base"]
+
+def new_game(key: str, etag: Optional[str], hands: List[Result]) -> dict:
+    "a game of the state, hands is the version of the game in COS with etag"
+    return {"key": key, "etag": etag, "base": hands_json(hands), "hands": hands_json(hands), "version": 0, "checkpoint": None}
+
+class ResultsWriteBehind:
+    """
+    The games played with this cache are kept in the state file in dir, a sub directory for the table, in the order
+    they were played.  Each game has the key of its object in COS, the ETag and the hands, the base, of the version
+    in COS that it changes, its hands, the version of its hands counted up when they change, and its scoring checkpoint.  The state file is replaced atomically and synced
+    to disk on every store, updates are serialized across processes by a lock file.
+    flush() pushes the pending games to COS oldest first and stops at the first game that can not be pushed so games
+    reach COS in order.  A game changed in COS by someone else is rebased like ResultsCOS.store_results.
+    The first read of a table with no state reads the latest game from COS
+    """
+    def __init__(self, dir: str, remote: "ResultsCOS"):
+        self.remote = remote
+        self.dir = pathlib.Path(dir) if remote.table == None else pathlib.Path(dir) / remote.table
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.dir / STATE_NAME
+        self.table = remote.table
+        self.key = None
+        self.version = None
+        self.stored = []
+        self.flushed = [] # (key, hands) of the games pushed by the last flush()
+        self.lock_file = None # while locked()
+    def read_state(self) -> Optional[dict]:
+        try:
+            with self.path.open(mode="r") as f:
+                state = json.load(f)
+            if state["version"] == STATE_VERSION:
+                return state
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        return None
+    def write_state(self, state: dict):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open(mode="w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    @contextlib.contextmanager
+    def locked(self):
+        "hold the lock on the state, nested calls do not lock again, see GameCatalog.locked()"
+        if fcntl == None or self.lock_file != None:
+            yield
+            return
+        with (self.dir / LOCK_NAME).open(mode="a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.lock_file = lock_file
+            try:
+                yield
+            finally:
+                self.lock_file = None
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    def current_game(self, state: Optional[dict]) -> dict:
+        "the game read by existing_results or created by new_results, raise RuntimeError if another process started a new game since"
+        if state == None or len(state["games"]) == 0 or state["games"][-1]["key"] != self.key:
+            raise RuntimeError("the current game was changed by another process", self.key)
+        return state["games"][-1]
+    def pending(self) -> int:
+        "the number of games with changes that are not in COS"
+        state = self.read_state()
+        return 0 if state == None else sum(1 for game in state["games"] if is_pending(game))
+    def loaded(self, game: dict) -> List[Result]:
+        hands = json_hands(game["hands"])
+        self.key = game["key"]
+        self.version = game["version"]
+        self.stored = list(hands)
+        return hands
+    def game_version(self) -> str:
+        "the version of the current game as it was loaded or stored"
+        return str(self.version)
+    @metrics.timed(metrics.STORAGE_LOAD)
+    def existing_results(self) -> List[Result]:
+        "return the results of the current game from the state, it is read from the latest game in COS when there is no state"
+        with self.locked():
+            state = self.read_state()
+            if state == None or len(state["games"]) == 0:
+                hands = self.remote.existing_results()
+                key = self.remote.key
+                if key == None:
+                    key = self.remote.prefix + new_name_string(self.remote.suffix)
+                state = {"version": STATE_VERSION, "games": [new_game(key, self.remote.etag, hands)]}
+                self.write_state(state)
+        return self.loaded(state["games"][-1])
+    def new_results(self) -> List[Result]:
+        "start a new game in the state, it is created in COS by the flush of its first store"
+        key = self.remote.prefix + new_name_string(self.remote.suffix)
+        with self.locked():
+            state = self.read_state()
+            games = [] if state == None else state["games"]
+            if any(game["key"] == key for game in games):
+                raise FileExistsError(key)
+            games = [game for game in games if is_pending(game)]
+            games.append(new_game(key, None, []))
+            self.write_state({"version": STATE_VERSION, "games": games})
+        return self.loaded(games[-1])
+    @metrics.timed(metrics.STORAGE_STORE)
+    def store_results(self, hands: List[Result]) -> bool:
+        """commit the hands of the current game to the state, flush() pushes them to COS.  When the game was changed
+        by another process since it was read the bids and undos made to hands are applied again to the changed game,
+        the hands list is updated in place.  Return True if hands was changed"""
+        with self.locked():
+            state = self.read_state()
+            game = self.current_game(state)
+            current = json_hands(game["hands"])
+            rebased = current != self.stored
+            if rebased:
+                hands[:] = rebase_hands(self.stored, hands, current)
+            game["hands"] = hands_json(hands)
+            game["version"] += 1
+            game["checkpoint"] = None
+            self.write_state(state)
+        self.version = game["version"]
+        self.stored = list(hands)
+        return rebased
+    @metrics.timed(metrics.CHECKPOINT_LOAD)
+    def existing_checkpoint(self) -> Optional[List[dict]]:
+        "return the entries of the scoring checkpoint of the current game or None if there is not one"
+        state = self.read_state()
+        if state == None or len(state["games"]) == 0 or state["games"][-1]["key"] != self.key:
+            return None
+        return state["games"][-1].get("checkpoint")
+    @metrics.timed(metrics.CHECKPOINT_STORE)
+    def store_checkpoint(self, entries: List[dict], replace: bool = True):
+        """replace the rubbers of the entries in the scoring checkpoint of the current game in the state, or all of
+        them, checkpoints are not pushed to COS"""
+        with self.locked():
+            state = self.read_state()
+            game = self.current_game(state)
+            rubbers = {} if replace or game["checkpoint"] == None else {entry["rubber"]: entry for entry in game["checkpoint"]}
+            rubbers.update((entry["rubber"], entry) for entry in entries)
+            game["checkpoint"] = [rubbers[rubber] for rubber in sorted(rubbers)]
+            self.write_state(state)
+    def flush(self, retries: int = FLUSH_RETRIES, backoff: float = FLUSH_BACKOFF) -> int:
+        """push the pending games to COS oldest first and return the number of games pushed.  A push that fails is
+        retried retries times, waiting backoff seconds doubled for each retry, then the exception is raised and the
+        games not pushed are left for the next flush"""
+        self.flushed = []
+        with self.locked():
+            state = self.read_state()
+            if state == None:
+                return 0
+            games = state["games"]
+            try:
+                for game in games:
+                    if not is_pending(game):
+                        continue
+                    hands = game["hands"]
+                    for attempt in range(retries + 1):
+                        try:
+                            self.push(state, game)
+                            if game["hands"] != hands:
+                                # rebased, the checkpoint is for the hands before
+                                game["version"] += 1
+                                game["checkpoint"] = None
+                            break
+                        except Exception:
+                            if attempt == retries:
+                                raise
+                        time.sleep(backoff * 2 ** attempt)
+                    self.flushed.append((game["key"], json_hands(game["hands"])))
+            finally:
+                # the games before the current one are dropped once they are pushed
+                state["games"] = [game for game in games[:-1] if is_pending(game)] + games[-1:]
+                self.write_state(state)
+            if len(games) > 0 and games[-1]["key"] == self.key:
+                # the current game may have been rebased
+                self.stored = json_hands(games[-1]["hands"])
+            return len(self.flushed)
+    def push(self, state: dict, game: dict):
+        """store the hands of the game in COS, the hands and the base become the rebased hands that were stored.
+        The id and the hands of a push are recorded in the state before the store, the id is kept in the metadata of
+        the game in COS, so a push that was interrupted after it was stored is not applied again"""
+        remote = self.remote
+        hands = json_hands(game["hands"])
+        new = game["etag"] == None
+        pushing = game.get("pushing")
+        if pushing:
+            current = remote.existing_version(game["key"])
+            if current != None and pushing["id"] in current[2]:
+                # the game in COS has the hands pushed, rebased, the stores to the state since are applied again to it
+                hands = rebase_hands(json_hands(pushing["hands"]), hands, current[1])
+                self.pushed(game, current[0], current[1], new)
+                game["hands"] = hands_json(hands)
+                if not is_pending(game):
+                    return
+                new = False
+        push_id = uuid.uuid4().hex
+        game["pushing"] = {"id": push_id, "hands": game["hands"]}
+        self.write_state(state)
+        remote.loaded(game["key"], game["etag"], json_hands(game["base"]))
+        remote.store_results(hands, push_id=push_id)
+        self.pushed(game, remote.etag, hands, new)
+        self.write_state(state)
+    def pushed(self, game: dict, etag: str, hands: List[Result], new: bool):
+        if new:
+            # a new game, it is now the latest
+            self.remote.store_latest_result_object(game["key"])
+        game.update(etag=etag, base=hands_json(hands), hands=hands_json(hands), pushing=False)
+    def verify(self) -> List[str]:
+        "return the keys of the games pushed by the last flush() that are not in COS as they were pushed"
+        mismatched = []
+        for key, hands in self.flushed:
+            current = self.remote.existing_version(key)
+            if current == None or current[1] != hands:
+                mismatched.append(key)
+        return mismatched
+    def pull(self) -> Optional[str]:
+        """replace the current game with the latest game in COS when the current game has no pending changes so bids
+        entered by others are seen, return the key of the game or None if the current game is pending"""
+        with self.locked():
+            state = self.read_state()
+            if state != None and any(is_pending(game) for game in state["games"]):
+                return None
+            key = self.remote.get_latest_result_object()
+            current = None if key == None else self.remote.existing_version(key)
+            if current == None:
+                return None
+            state = {"version": STATE_VERSION, "games": [new_game(key, current[0], current[1])]}
+            self.write_state(state)
+            self.loaded(state["games"][-1])
+            return key
+
@@ -5,6 +5,21 @@ import json
 from click.testing import CliRunner
 import os
 import time
+import asyncio
+import functools
+import ibm_boto3
+import itertools
+import pytest
+import subprocess
+import sys
+import threading
+from bridgepy import metrics, render
+from bridgepy.storage import hands_to_bytes, is_archive_name, pack_result, unpack_result, checkpoint_name, artifact_name, TEXT_ARTIFACT_SUFFIX, JSON_ARTIFACT_SUFFIX, TOTALS_ARTIFACT_SUFFIX
+from bridgepy.scoring import BidError, apply_bid, bid_parse_many, CHECKPOINT_SLACK
+from bridgepy.cos import cos_resources, LATEST_KEY
+from bridgepy.cli import GameTotals, archive_cli, bucket_cli, catalog_cli, rescore, rescore_cli, results_storage, sync_cli
+from bridgepy.writebehind import ResultsWriteBehind
+from bridgepy.service import ScoreBroadcaster, score_event
 
 FAST = False
 
@@ -83,6 +98,156 @@ def test_results_COS():
     storage_test(result_storage)
 
 
+LOCAL_API_KEY = "local-api-key"
+LOCAL_INSTANCE_ID = "local-instance-id"
+
+
+def local_resource(endpoint_url):
+    "create the resource of the local S3 stand-in and register it in the COS resource pool"
+    resource = ibm_boto3.resource(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id="local",
+        aws_secret_access_key="local",
+        region_name="us-east-1",
+    )
+    cos_resources[(endpoint_url, LOCAL_INSTANCE_ID, LOCAL_API_KEY)] = resource
+    return resource
+
+
+@pytest.fixture(scope="module")
+def local_cos():
+    """Start a local S3 stand-in and register its resource in the COS resource pool
+    return a function that creates a ResultsCOS for a new bucket"""
+    moto_server = pytest.importorskip("moto.server")
+    server = moto_server.ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint_url = "http://{}:{}".format(host, port)
+    resource = local_resource(endpoint_url)
+    count = [0]
+
+    def results_cos():
+        count[0] += 1
+        bucket_name = "bridgepy-test-{}".format(count[0])
+        resource.create_bucket(Bucket=bucket_name)
+        return ResultsCOS(bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, endpoint_url)
+
+    yield results_cos
+    server.stop()
+
+
+def test_results_local_cos_packed(local_cos):
+    bucket_storage = local_cos()
+    result_storage = ResultsCOS(
+        bucket_storage.bucket_name,
+        LOCAL_API_KEY,
+        LOCAL_INSTANCE_ID,
+        bucket_storage.endpoint_url,
+        packed=True,
+    )
+    storage_test(result_storage)
+    assert result_storage.get_latest_result_object().endswith(".bpk")
+
+
+def test_results_local_cos(local_cos):
+    result_storage = local_cos()
+    storage_test(result_storage)
+    # the latest pointer is used, listing is the fall back when it is missing
+    latest = result_storage.get_latest_result_object()
+    assert result_storage.bucket.Object(key=LATEST_KEY).get()["Body"].read().decode() == latest
+    result_storage.bucket.Object(key=LATEST_KEY).delete()
+    assert ResultsCOS(
+        result_storage.bucket_name,
+        LOCAL_API_KEY,
+        LOCAL_INSTANCE_ID,
+        result_storage.endpoint_url,
+    ).existing_results() == [bid_parse("w1sm1")]
+    assert result_storage.bucket.Object(key=LATEST_KEY).get()["Body"].read().decode() == latest
+    # the resource is shared by every ResultsCOS with the same credentials
+    assert result_storage.resource is local_cos().resource
+
+
+def test_results_local_cos_tables(local_cos):
+    bucket_storage = local_cos()
+
+    def table_storage(table):
+        return ResultsCOS(
+            bucket_storage.bucket_name,
+            LOCAL_API_KEY,
+            LOCAL_INSTANCE_ID,
+            bucket_storage.endpoint_url,
+            table=table,
+        )
+
+    storage_test(table_storage("t1"))
+    assert table_storage("t1").get_latest_result_object().startswith("t1/")
+    assert table_storage("t2").existing_results() == []
+    assert table_storage(None).existing_results() == []
+    storage_test(table_storage(None))
+    assert table_storage("t1").existing_results() == [bid_parse("w1sm1")]
+
+
+def test_results_local_cos_conflict(local_cos):
+    scorer1 = local_cos()
+    scorer2 = ResultsCOS(
+        scorer1.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, scorer1.endpoint_url
+    )
+    hands1 = scorer1.existing_results()
+    hands1.append(bid_parse("w1sm1"))
+    assert not scorer1.store_results(hands1)
+    hands1 = scorer1.existing_results()
+    hands2 = scorer2.existing_results()
+    # both scorers enter a bid at the same time
+    hands1.append(bid_parse("w2hm2"))
+    hands2.append(bid_parse("t3dm3"))
+    assert not scorer1.store_results(hands1)
+    assert scorer2.store_results(hands2)
+    expected = [bid_parse("w1sm1"), bid_parse("w2hm2"), bid_parse("t3dm3")]
+    assert hands2 == expected
+    # an undo is rebased too
+    hands1 = scorer1.existing_results()
+    hands1.append(bid_parse("t1nm1"))
+    hands2.pop()
+    assert not scorer1.store_results(hands1)
+    assert scorer2.store_results(hands2)
+    expected = [bid_parse("w1sm1"), bid_parse("w2hm2"), bid_parse("t1nm1")]
+    assert hands2 == expected
+    assert ResultsCOS(
+        scorer1.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, scorer1.endpoint_url
+    ).existing_results() == expected
+
+
+def test_rebase_hands():
+    a, b, c, d = [bid_parse(bid) for bid in ["w1sm1", "t2hm2", "w3nm3", "t4sm4"]]
+    assert rebase_hands([a], [a, b], [a, c]) == [a, c, b]
+    assert rebase_hands([a, b], [a], [a, b, c]) == [a, c]
+    assert rebase_hands([a, b], [a, d], [a, b, c]) == [a, c, d]
+    # current is not an extension of base, the undo removes the last hand
+    assert rebase_hands([a, b], [a], [a, c]) == [a]
+
+
+def test_score_cache(local_cos):
+    result_storage = local_cos()
+    cache = ScoreCache()
+    assert cache.score_str(result_storage) == score_str([])
+    hands = result_storage.new_results()
+    hands.append(bid_parse("w3sm3"))
+    result_storage.store_results(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (1, 2)
+    hands.append(bid_parse("t2hm4"))
+    result_storage.store_results(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (1, 3)
+    # a latest pointer to a game that was removed falls back to listing the games
+    result_storage.store_latest_result_object("2000-01-01-00-00-00.json")
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert result_storage.get_latest_result_object() == result_storage.key
+
+
 def test_bid():
     hand = bid_parse("w3sm3")
     assert hand == Result(Team.WE, 3, Suit.SPADE, 0, Honors.NONE, Double.NONE)
@@ -96,6 +261,173 @@ def test_bid():
     assert hand == Result(Team.WE, 3, Suit.NOTRUMP, 0, Honors.H100, Double.REDOUBLE)
     hand = bid_parse("w3nm3r5")
     assert hand == Result(Team.WE, 3, Suit.NOTRUMP, 0, Honors.H150, Double.REDOUBLE)
+    # equal results are the same object
+    assert bid_parse("w3nm3r5") is bid_parse("w3nm35r")
+    assert bid_parse("w3nm3r5") is unpack_result(pack_result(hand))
+    # a result with a field that does not fit its bits is not packed
+    for over in (-13, 18):
+        hand = Result(Team.WE, 1, Suit.CLUB, over, Honors.NONE, Double.NONE)
+        assert unpack_result(pack_result(hand)) == hand
+    for over in (-14, 19):
+        with pytest.raises(ValueError):
+            pack_result(Result(Team.WE, 1, Suit.CLUB, over, Honors.NONE, Double.NONE))
+
+
+def reference_bid_parse(bid):
+    "the character by character parser that the bid table replaced"
+    suffixes = {
+        "d": {"double": Double.DOUBLE},
+        "r": {"double": Double.REDOUBLE},
+        "0": {"honors": Honors.H100},
+        "5": {"honors": Honors.H150},
+    }
+    team = Team.WE if bid[0] == "w" else Team.THEY
+    bid_tricks = int(bid[1])
+    over_tricks = int(bid[4])
+    over_tricks = -over_tricks if bid[3] == "d" else over_tricks - bid_tricks
+    ret = Result(team, bid_tricks, Suit(bid[2]), over_tricks)
+    for indx in range(5, len(bid)):
+        ret = ret._replace(**suffixes[bid[indx]])
+    return ret
+
+
+def test_bid_table():
+    from bridgepy.scoring import bid_table
+
+    table = bid_table()
+    for bid, result in table.items():
+        assert result == reference_bid_parse(bid)
+    for hand in random_hands(200):
+        if hand.over >= -9:
+            assert table[bid_str(hand)] == hand
+
+
+def reference_add(rubber, result):
+    "the branching Rubber.add that the contract table replaced"
+    contract_winner = result.team.value
+    contract_loser = 1 - contract_winner
+    vulnerable = rubber.games_won[contract_winner] == 1
+    if result.over >= 0:
+        above_points = []
+        last_game = rubber.games[len(rubber.games) - 1]
+        trick_value = 20 if result.suit == Suit.DIAMOND or result.suit == Suit.CLUB else 30
+        under_points = trick_value * result.bid * result.double.value
+        under_points += 10 if result.suit == Suit.NOTRUMP else 0
+        last_game[contract_winner].append(under_points)
+        if result.over > 0:
+            if result.double == Double.NONE:
+                over_trick_points = trick_value * result.over * result.double.value
+            else:
+                over_trick_points = 50 * result.over * result.double.value * (2 if vulnerable else 1)
+            above_points.append(over_trick_points)
+        slam_bonus = 0
+        if result.bid == 6:
+            slam_bonus = 750 if vulnerable else 500
+        if result.bid == 7:
+            slam_bonus = 1000 if vulnerable else 1500
+        if slam_bonus:
+            above_points.append(slam_bonus)
+        if result.double != Double.NONE:
+            above_points.append(50 if result.double == Double.DOUBLE else 100)
+        if result.honors != Honors.NONE:
+            above_points.append(result.honors.value)
+        if sum(last_game[contract_winner]) >= 100:
+            rubber.games_won[contract_winner] += 1
+            if rubber.complete():
+                above_points.append(700 if rubber.games_won[contract_loser] == 0 else 500)
+            else:
+                rubber.games.append([[], []])
+        rubber.above[contract_winner].extend(above_points)
+        rubber.total[contract_winner] += under_points
+        rubber.total[contract_winner] += sum(above_points)
+    else:
+        trick1 = [100, 200, 0, 400, 50, 100, 0, 200]
+        trick23 = [100, 300, 0, 600, 50, 200, 0, 400]
+        trick4 = [100, 300, 0, 600, 50, 300, 0, 600]
+        set_tricks = -result.over
+        point_index = 4 * (0 if vulnerable else 1) + result.double.value - 1
+        set_points = trick1[point_index]
+        set_tricks -= 1
+        for i in range(0, set_tricks if set_tricks <= 2 else 2):
+            set_points += trick23[point_index]
+            set_tricks -= 1
+        for i in range(0, set_tricks):
+            set_points += trick4[point_index]
+        rubber.above[contract_loser].append(set_points)
+        rubber.total[contract_loser] += set_points
+    return rubber.complete()
+
+
+def test_contract_table():
+    "every contract in every vulnerability, and with a part score that it may complete a game or the rubber"
+    for games_won, part_score in itertools.product([[0, 0], [1, 0], [0, 1], [1, 1]], [0, 70]):
+        for team, bid, suit, honors, double in itertools.product(Team, range(1, 8), Suit, Honors, Double):
+            for over in range(-(6 + bid), 8 - bid):
+                result = Result(team, bid, suit, over, honors, double)
+                rubber, reference = Rubber(), Rubber()
+                for r in (rubber, reference):
+                    r.games_won = list(games_won)
+                    r.games[0][team.value].append(part_score)
+                assert rubber.add(result) == reference_add(reference, result)
+                assert rubber.to_json_dictionary() == reference.to_json_dictionary(), result
+    # results outside the table, like those of games stored before bids were checked, are still scored
+    legacy = [
+        Result(Team.WE, 1, Suit.SPADE, 9),
+        Result(Team.THEY, 2, Suit.HEART, -10, Honors.NONE, Double.DOUBLE),
+        Result(Team.WE, 3, Suit.NOTRUMP, 0),
+    ]
+    rubber, reference = Rubber(), Rubber()
+    for result in legacy:
+        assert rubber.add(result) == reference_add(reference, result)
+    assert rubber.to_json_dictionary() == reference.to_json_dictionary()
+    with tempfile.TemporaryDirectory() as dir:
+        path = Path(dir) / "2020-01-01-00-00-00.json"
+        path.write_bytes(hands_to_bytes(path.name, legacy))
+        result_storage = ResultsFile(dir)
+        hands = result_storage.existing_results()
+        assert hands == legacy
+        assert score_str(hands) == rubbers_str([reference])
+
+
+def test_bid_errors():
+    for bid, position in [
+        ("x3sm3", 0),
+        ("w8sm3", 1),
+        ("w3xm3", 2),
+        ("w3sx3", 3),
+        ("w3sm8", 4),
+        ("w1sd8", 4),
+        ("w3sm3x", 5),
+        ("w3sm3dr", 6),
+        ("w3sm305", 6),
+        ("w3s", 3),
+        ("", 0),
+    ]:
+        with pytest.raises(BidError) as e:
+            bid_parse(bid)
+        assert e.value.position == position, bid
+        assert e.value.bid == bid
+        assert isinstance(e.value, ValueError)
+    # the command line reports the bid and the position without a traceback
+    with tempfile.TemporaryDirectory() as dir:
+        result = CliRunner().invoke(click_cli, ["--file", "-r", dir, "w3sx3"])
+        assert result.exit_code == 2
+        assert not isinstance(result.exception, BidError)
+        assert "bid 'w3sx3' must be m for made or d for down at position 3" in result.output
+        assert "  w3sx3\n     ^" in result.output
+        assert ResultsFile(dir).existing_results() == []
+
+
+def test_bid_parse_many():
+    text = "w3sm3 t2hm4\nw1nd1d0,t7cm7r; w4sm4\n"
+    assert bid_parse_many(text) == [
+        bid_parse(bid) for bid in ["w3sm3", "t2hm4", "w1nd1d0", "t7cm7r", "w4sm4"]
+    ]
+    assert bid_parse_many("") == []
+    with pytest.raises(BidError) as e:
+        bid_parse_many("w3sm3 t2hm4\nw1nq1 w4sm4")
+    assert e.value.bid == "w1nq1"
+    assert e.value.position == len("w3sm3 t2hm4\nw1n")
 
 
 def test_score():
@@ -129,6 +461,121 @@ def test_score():
     assert r.total[Team.THEY.value] == 1640
 
 
+def bid_str(hand):
+    "the bid string that bid_parse turns into hand"
+    ret = "wt"[hand.team.value] + str(hand.bid) + hand.suit.value
+    ret += "d" + str(-hand.over) if hand.over < 0 else "m" + str(hand.bid + hand.over)
+    ret += {Double.NONE: "", Double.DOUBLE: "d", Double.REDOUBLE: "r"}[hand.double]
+    ret += {Honors.NONE: "", Honors.H100: "0", Honors.H150: "5"}[hand.honors]
+    return ret
+
+
+def random_hands(count, seed=0):
+    import random
+
+    rand = random.Random(seed)
+    hands = []
+    for i in range(count):
+        bid = rand.randint(1, 7)
+        hands.append(
+            Result(
+                rand.choice(list(Team)),
+                bid,
+                rand.choice(list(Suit)),
+                rand.randint(-(6 + bid), 7 - bid),
+                rand.choice(list(Honors)),
+                rand.choice(list(Double)),
+            )
+        )
+    return hands
+
+
+def test_score_batch():
+    pytest.importorskip("numpy")
+    from bridgepy import batch
+
+    hands = random_hands(5000)
+    above, below = batch.score_results(hands)
+    def below_line(rubber):
+        return [sum(sum(game[team]) for game in rubber.games) for team in range(2)]
+
+    rubber = Rubber()
+    for i, hand in enumerate(hands):
+        total = list(rubber.total)
+        below_total = below_line(rubber)
+        complete = rubber.add(hand)
+        for team in range(2):
+            assert below[i][team] == below_line(rubber)[team] - below_total[team]
+            assert above[i][team] + below[i][team] == rubber.total[team] - total[team]
+        if complete:
+            rubber = Rubber()
+
+
+def test_render():
+    hands = random_hands(100)
+    rs = rubbers(hands)
+    assert len(rs) > 1
+    text = rubbers_str(rs)
+    assert text.startswith("  We | They\n")
+    assert text.endswith("== All Rubbers ==\n=================\n {:3d} | {:3d}\n".format(
+        sum(r.total[0] for r in rs), sum(r.total[1] for r in rs)
+    ))
+    f = io.StringIO()
+    render.write(rs, f.write)
+    assert f.getvalue() == text
+    score = json.loads(rubbers_str(rs, render.JSON))
+    assert len(score["rubbers"]) == len(rs)
+    assert score["rubbers"][0]["games"] == [
+        [list(row) for row in itertools.zip_longest(*game, fillvalue=0)]
+        for game in rs[0].games
+    ]
+    assert score["total"] == [sum(r.total[0] for r in rs), sum(r.total[1] for r in rs)]
+    assert rubbers_str(rs, render.HTML).count('<table class="rubber">') == len(rs)
+
+
+def apply_diff(score, diff):
+    "apply a service DIFF_EVENT to the data of a SCORE_EVENT like the docs/guestbook.js client"
+    while len(score["rubbers"]) < diff["rubbers"]:
+        score["rubbers"].append(Rubber().to_json_dictionary())
+    rubber = score["rubbers"][diff["rubber"]]
+    for team in range(2):
+        rubber["above"][team].extend(diff["above"][team])
+    for game in diff["games"]:
+        if len(rubber["games"]) <= game["game"]:
+            rubber["games"].append([[], []])
+        for team in range(2):
+            rubber["games"][game["game"]][team].extend(game["below"][team])
+    rubber["total"] = diff["total"]
+    rubber["games_won"] = diff["games_won"]
+    score["total"] = diff["totals"]
+
+
+def test_score_broadcaster():
+    with tempfile.TemporaryDirectory() as dir:
+        service = ScoreService(ResultsFile(dir))
+
+        async def run():
+            broadcaster = ScoreBroadcaster(service)
+            queue = broadcaster.subscribe()
+            name, score = queue.get_nowait()
+            assert name == "score"
+            # bids can only be down 9
+            hands = [hand for hand in random_hands(100) if hand.over >= -9]
+            for hand in hands:
+                service.bid(bid_str(hand))
+                name, diff = queue.get_nowait()
+                assert name == "diff"
+                apply_diff(score, diff)
+            assert score == score_event(service.score)[1]
+            service.undo()
+            name, score = queue.get_nowait()
+            assert name == "score"
+            assert score == score_event(Score.replay(hands[:-1]))[1]
+            broadcaster.unsubscribe(queue)
+
+        asyncio.run(run())
+
+
 def test_io():
     f = io.StringIO("")
     hands_to_json_file(f, [bid_parse("w3sm3"), bid_parse("w1nd1")])
@@ -141,7 +588,6 @@ def test_io():
 
 from pathlib import Path
 import tempfile
-import time
 
 
 def test_file():
@@ -160,3 +606,833 @@ def test_file():
         assert p != p3
         assert p3 == existing_game_file(dir)
 
+
+
+def test_score_checkpoint():
+    bids = ["w2nm3", "t4hm4", "t5cd2", "w4sm5d", "w3cm4", "t6dm65", "w1sm1"]
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsFile(dir)
+        hands = result_storage.new_results()
+        assert result_storage.existing_checkpoint() == None
+        for bid in bids:
+            bid_and_store(result_storage, hands, bid)
+            hands = result_storage.existing_results()
+            score = game_score(result_storage, hands)
+            assert score.game_version == result_storage.game_version()
+            assert rubbers_str(score.rubbers) == score_str(hands)
+        # a bid appends the state of the rubbers it changed
+        checkpoint = result_storage.existing_checkpoint()
+        assert checkpoint[-1]["hand_count"] == len(bids)
+        assert len(checkpoint) == len(bids) + len(rubbers(hands)) - 1
+        # undo replays the hands and rewrites the checkpoint
+        bid_and_store(result_storage, hands, "u")
+        hands = result_storage.existing_results()
+        assert len(result_storage.existing_checkpoint()) == len(rubbers(hands))
+        assert result_storage.existing_checkpoint()[-1]["hand_count"] == len(bids) - 1
+        # a checkpoint for another version of the game is ignored
+        result_storage.store_checkpoint(checkpoint)
+        score = game_score(result_storage, hands)
+        assert score.hand_count == len(hands)
+        assert rubbers_str(score.rubbers) == score_str(hands)
+        # a hand edited in the middle of the game with the same count and last hand is another version too
+        result_storage.store_checkpoint(Score.replay(hands).checkpoint(result_storage.game_version())[0])
+        hands[1] = bid_parse("w4hm4")
+        result_storage.store_results(hands)
+        score = game_score(result_storage, hands)
+        assert score.game_version == None
+        assert rubbers_str(score.rubbers) == score_str(hands)
+        # the checkpoint is rewritten once it has more than twice as many entries as rubbers
+        score = Score.replay(hands)
+        for i in range(40):
+            score = apply_bid(result_storage, hands, score, "w1cm1")
+        checkpoint = result_storage.existing_checkpoint()
+        assert len(checkpoint) <= 2 * len(score.rubbers) + CHECKPOINT_SLACK
+        assert rubbers_str(Score.from_checkpoint(checkpoint).rubbers) == score_str(hands)
+
+
+def test_results_file_journal():
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsFile(dir, journal=True, compact_every=4)
+        storage_test(result_storage)
+        hands = result_storage.existing_results()
+        snapshot = result_storage.hands_path.read_text()
+        hands.append(bid_parse("t2hm2"))
+        result_storage.store_results(hands)
+        hands.pop()
+        result_storage.store_results(hands)
+        # events went to the journal, the snapshot is untouched
+        assert result_storage.hands_path.read_text() == snapshot
+        assert ResultsFile(dir).existing_results() == hands
+        for bid in ["t2hm2", "w1nm1"]:
+            hands.append(bid_parse(bid))
+            result_storage.store_results(hands)
+        # compacted into a new snapshot
+        assert not result_storage.journal_path().exists()
+        assert ResultsFile(dir).existing_results() == hands
+        # a journal left by a compaction that crashed before removing it is not applied to the new snapshot
+        # of the same length
+        for bid in ["t3cm3", "w4hm4"]:
+            hands.append(bid_parse(bid))
+            result_storage.store_results(hands)
+        journal = result_storage.journal_path().read_text()
+        hands[-3:] = [bid_parse("t5dm5")]
+        result_storage.compact(hands)
+        assert json.loads(journal.splitlines()[0])["base"] == len(hands)
+        result_storage.journal_path().write_text(journal)
+        assert ResultsFile(dir).existing_results() == hands
+        # a torn first line is ignored
+        result_storage.journal_path().write_text('{"ba')
+        assert ResultsFile(dir).existing_results() == hands
+        # a first line without the hash of the snapshot is corrupt and ignored
+        result_storage.journal_path().write_text(json.dumps({"base": len(hands)}) + "\n" + json.dumps({"undo": 1}) + "\n")
+        assert ResultsFile(dir).existing_results() == hands
+
+
+def test_results_file_packed():
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsFile(dir, packed=True)
+        storage_test(result_storage)
+        assert result_storage.hands_path.suffix == ".bpk"
+    with tempfile.TemporaryDirectory() as dir:
+        # a legacy json game is still read and written as json
+        json_game = ResultsFile(dir)
+        hands = json_game.new_results()
+        hands.append(bid_parse("w1sm1"))
+        json_game.store_results(hands)
+        result_storage = ResultsFile(dir, packed=True)
+        assert result_storage.existing_results() == hands
+        hands.append(bid_parse("t2hm2"))
+        result_storage.store_results(hands)
+        assert result_storage.hands_path.suffix == ".json"
+        assert ResultsFile(dir).existing_results() == hands
+
+
+def test_packed():
+    hands = random_hands(1000)
+    data = pack_hands(hands)
+    assert len(data) == 12 + 2 * len(hands)
+    packed = PackedHands(data)
+    assert len(packed) == len(hands)
+    assert list(packed) == hands
+    assert packed[-1] == hands[-1]
+    assert packed[10:20] == hands[10:20]
+    assert hands_from_bytes(data) == hands
+    assert hands_from_bytes(b"[]") == []
+    with tempfile.TemporaryDirectory() as dir:
+        path = Path(dir) / "game.bpk"
+        path.write_bytes(data)
+        with open_packed_file(path) as packed:
+            assert list(packed) == hands
+
+
+def test_results_file_tables():
+    with tempfile.TemporaryDirectory() as dir:
+        storage_test(ResultsFile(dir, table="t1"))
+        t2 = ResultsFile(dir, table="t2")
+        assert t2.existing_results() == []
+        assert ResultsFile(dir).existing_results() == []
+        with pytest.raises(ValueError):
+            ResultsFile(dir, table="../t1")
+
+
+def test_hands_diff():
+    a, b, c = bid_parse("w1sm1"), bid_parse("t2hm2"), bid_parse("w3nm3")
+    assert hands_diff([a, b], [a, b, c]) == (0, [c])
+    assert hands_diff([a, b], [a]) == (1, [])
+    assert hands_diff([a, b], [a, c]) == (1, [c])
+
+
+def rescore_games(result_storage, count):
+    "store count games of random hands in the storage, return the expected GameTotals"
+    expected = []
+    for i in range(count):
+        name = "2020-01-01-00-00-{:02d}.json".format(i)
+        hands = random_hands(20 + i, seed=i)
+        if isinstance(result_storage, ResultsFile):
+            path = Path(result_storage.dir) / name
+            path.write_bytes(hands_to_bytes(name, hands))
+        else:
+            name = result_storage.prefix + name
+            result_storage.bucket.Object(key=name).put(Body=hands_to_bytes(name, hands))
+        rs = rubbers(hands)
+        expected.append(
+            GameTotals(
+                name,
+                len(hands),
+                len(rs),
+                sum(r.total[0] for r in rs),
+                sum(r.total[1] for r in rs),
+            )
+        )
+    return expected
+
+
+def test_rescore():
+    with tempfile.TemporaryDirectory() as dir:
+        expected = rescore_games(ResultsFile(dir), 5)
+        # the journal of a game is applied
+        result_storage = ResultsFile(dir, journal=True)
+        hands = result_storage.existing_results()
+        hands.append(bid_parse("w7nm7"))
+        result_storage.store_results(hands)
+        assert result_storage.journal_path().exists()
+        rs = rubbers(hands)
+        expected[-1] = GameTotals(
+            expected[-1].name,
+            len(hands),
+            len(rs),
+            sum(r.total[0] for r in rs),
+            sum(r.total[1] for r in rs),
+        )
+        factory = functools.partial(results_storage, "file", dir)
+        assert list(rescore(factory, workers=2, in_flight=1)) == expected
+        assert list(rescore(factory, workers=1)) == expected
+
+        result = CliRunner().invoke(rescore_cli, ["--file", "-r", dir, "-j", "2"])
+        assert result.exit_code == 0, result.output
+        lines = result.output.splitlines()
+        assert len(lines) == 6
+        assert lines[0] == "{} hands {} rubbers {} we {} they {}".format(*expected[0])
+        assert lines[-1].startswith(
+            "games 5 hands {} we {} they {} ".format(
+                sum(t.hands for t in expected),
+                sum(t.we for t in expected),
+                sum(t.they for t in expected),
+            )
+        )
+
+
+def test_rescore_local_cos(local_cos):
+    result_storage = local_cos()
+    table_storage = ResultsCOS(
+        result_storage.bucket_name,
+        LOCAL_API_KEY,
+        LOCAL_INSTANCE_ID,
+        result_storage.endpoint_url,
+        table="t1",
+    )
+    expected = rescore_games(result_storage, 3)
+    table_expected = rescore_games(table_storage, 2)
+    # the latest pointer and the games of other tables are not games
+    result_storage.store_latest_result_object(expected[-1].name)
+    factory = functools.partial(
+        results_storage,
+        "cos",
+        result_storage.bucket_name,
+        LOCAL_API_KEY,
+        LOCAL_INSTANCE_ID,
+        result_storage.endpoint_url,
+    )
+    assert list(rescore(factory, workers=1)) == expected
+    assert list(rescore(functools.partial(factory, table="t1"), workers=1)) == table_expected
+    # a pool of worker processes, each with its own resource
+    worker_factory = functools.partial(
+        local_worker_storage,
+        os.getpid(),
+        result_storage.endpoint_url,
+        result_storage.bucket_name,
+    )
+    assert list(rescore(worker_factory, workers=2, in_flight=1)) == expected
+    assert list(rescore(functools.partial(worker_factory, table="t1"), workers=2)) == table_expected
+
+
+def local_worker_storage(parent_pid, endpoint_url, bucket_name, table=None):
+    """storage factory of the rescore workers, rescore_init removed the resource forked from the parent so a
+    worker creates its own resource of the local S3 stand-in"""
+    key = (endpoint_url, LOCAL_INSTANCE_ID, LOCAL_API_KEY)
+    if os.getpid() != parent_pid:
+        assert key not in cos_resources
+        local_resource(endpoint_url)
+    return ResultsCOS(bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, endpoint_url, table=table)
+
+
+def test_metrics():
+    from bridgepy import metrics
+
+    registry = metrics.Registry()
+    histogram = registry.histogram("h_seconds", "help", ["span"], buckets=[0.1, 1])
+    histogram.observe(0.05, span="a")
+    histogram.observe(0.5, span="a")
+    histogram.observe(5, span="a")
+    counter = registry.counter("c_total", "help")
+    counter.inc()
+    counter.inc(2)
+    assert registry.text() == "".join(
+        line + "\n"
+        for line in [
+            "# HELP h_seconds help",
+            "# TYPE h_seconds histogram",
+            'h_seconds_bucket{span="a",le="0.1"} 1',
+            'h_seconds_bucket{span="a",le="1"} 2',
+            'h_seconds_bucket{span="a",le="+Inf"} 3',
+            'h_seconds_count{span="a"} 3',
+            'h_seconds_sum{span="a"} 5.55',
+            "# HELP c_total help",
+            "# TYPE c_total counter",
+            "c_total 3",
+        ]
+    )
+    # spans are timed, counted when they fail and logged when enabled
+    errors = metrics.SPAN_ERRORS.value(span=metrics.PARSE)
+    out = io.StringIO()
+    metrics.log_spans(stream=out)
+    try:
+        with pytest.raises(ValueError):
+            with metrics.span(metrics.PARSE):
+                raise ValueError()
+        score_str([bid_parse("w1sm1")])
+    finally:
+        metrics.log_spans(False)
+    assert metrics.SPAN_ERRORS.value(span=metrics.PARSE) == errors + 1
+    spans = [line.split()[1] for line in out.getvalue().splitlines()]
+    assert spans == [metrics.PARSE, metrics.SCORE, metrics.RENDER]
+    # the score span does not include reading the checkpoint
+    class SlowCheckpoint:
+        def existing_checkpoint(self):
+            time.sleep(0.2)
+            return None
+    seconds = metrics.SPAN_SECONDS.sum(span=metrics.SCORE)
+    game_score(SlowCheckpoint(), [bid_parse("w1sm1")])
+    assert metrics.SPAN_SECONDS.sum(span=metrics.SCORE) - seconds < 0.2
+
+
+IMPORT_BUDGET_SECONDS = 0.15
+IMPORT_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import bridgepy
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [m for m in ("ibm_boto3", "click", "asyncio") if m in sys.modules]]))
+"""
+
+
+def test_import_time():
+    "import bridgepy in new interpreters, the COS, command line and service dependencies are imported on first use"
+    runs = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", IMPORT_CODE], capture_output=True, text=True, check=True
+            ).stdout
+        )
+        for i in range(3)
+    ]
+    assert runs[0][1] == []
+    assert min(seconds for seconds, modules in runs) < IMPORT_BUDGET_SECONDS
+    # the public names are still exported
+    import bridgepy
+
+    assert bridgepy.ResultsCOS.__module__ == "bridgepy.cos"
+    assert bridgepy.click_cli.name == "click-cli"
+    assert "ScoreTables" in dir(bridgepy)
+
+
+def test_results_file_catalog(monkeypatch):
+    with tempfile.TemporaryDirectory() as dir:
+        names = ["2020-01-{:02d}-12-00-00.json".format(day) for day in (1, 15, 31)]
+        names.append("2020-02-01-12-00-00.bpk")
+        for name in names:
+            (Path(dir) / name).write_bytes(hands_to_bytes(name, [bid_parse("w1sm1")]))
+        result_storage = ResultsFile(dir)
+        # a missing catalog is built from the directory
+        assert result_storage.existing_results() == [bid_parse("w1sm1")]
+        assert result_storage.hands_path.name == names[-1]
+        catalog = result_storage.catalog
+        assert catalog.games() == names
+        assert list(result_storage.game_names("2020-01-15", "2020-02")) == names[1:3]
+        assert catalog.between("2020-02") == names[3:]
+        assert catalog.drift() == ([], [])
+        # new games are added to the catalog
+        hands = result_storage.new_results()
+        assert catalog.latest() == result_storage.hands_path.name
+        hands.append(bid_parse("t2hm2"))
+        result_storage.store_results(hands)
+        assert ResultsFile(dir).existing_results() == hands
+        # drift, a game removed and a game added behind the catalog's back
+        result_storage.hands_path.unlink()
+        extra = "2019-12-31-12-00-00.json"
+        (Path(dir) / extra).write_bytes(hands_to_bytes(extra, []))
+        assert catalog.drift() == ([result_storage.hands_path.name], [extra])
+        result = CliRunner().invoke(catalog_cli, ["-r", dir])
+        assert result.exit_code == 1
+        assert "unlisted " + extra in result.output
+        # the latest game is missing so it is rebuilt
+        assert ResultsFile(dir).existing_results() == [bid_parse("w1sm1")]
+        assert catalog.drift() == ([], [])
+        assert catalog.games() == [extra] + names
+        assert CliRunner().invoke(catalog_cli, ["-r", dir]).exit_code == 0
+        # a newer game copied in is the latest, for a new storage and for one that already read the catalog
+        result_storage = ResultsFile(dir)
+        assert result_storage.existing_results() == [bid_parse("w1sm1")]
+        copied = "2030-01-01-12-00-00.json"
+        (Path(dir) / copied).write_bytes(hands_to_bytes(copied, [bid_parse("t3cm3")]))
+        assert result_storage.existing_results() == [bid_parse("t3cm3")]
+        assert ResultsFile(dir).existing_results() == [bid_parse("t3cm3")]
+        assert catalog.drift() == ([], [])
+        # an unchanged directory is not scanned again, not even by a new storage
+        scans = []
+        scandir = os.scandir
+        monkeypatch.setattr(os, "scandir", lambda path: scans.append(path) or scandir(path))
+        for i in range(3):
+            assert ResultsFile(dir).existing_results() == [bid_parse("t3cm3")]
+        assert scans == []
+        # an older game copied in is rescored
+        older = "2019-06-01-12-00-00.json"
+        (Path(dir) / older).write_bytes(hands_to_bytes(older, [bid_parse("w2dm2")]))
+        factory = functools.partial(results_storage, "file", dir)
+        assert [totals.name for totals in rescore(factory, workers=1)] == [older, extra] + names + [copied]
+
+
+def test_results_sqlite():
+    from bridgepy.sqlite import ResultsSQLite
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "games.db")
+        storage_test(ResultsSQLite(path))
+        result_storage = ResultsSQLite(path)
+        hands = result_storage.existing_results()
+        assert hands == [bid_parse("w1sm1")]
+        assert result_storage.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # only the changed hands are written
+        hands.extend([bid_parse("t2hm2"), bid_parse("w3nm3")])
+        result_storage.store_results(hands)
+        hands.pop()
+        hands.append(bid_parse("t4sm4"))
+        assert result_storage.store_results(hands) == False
+        assert ResultsSQLite(path).existing_results() == hands
+        # a store by another connection is rebased
+        other = ResultsSQLite(path)
+        other_hands = other.existing_results()
+        other_hands.append(bid_parse("w1cm1"))
+        other.store_results(other_hands)
+        hands.append(bid_parse("t1dm1"))
+        assert result_storage.store_results(hands) == True
+        assert hands == other_hands + [bid_parse("t1dm1")]
+        assert ResultsSQLite(path).existing_results() == hands
+        # tables, names and checkpoints
+        assert ResultsSQLite(path, table="t1").existing_results() == []
+        assert len(list(result_storage.game_names())) == 2
+        latest = list(result_storage.game_names())[-1]
+        assert result_storage.load_game(latest) == hands
+        assert list(result_storage.game_names(end=latest)) == list(result_storage.game_names())[:1]
+        assert result_storage.existing_checkpoint() == None
+        apply_bid(result_storage, hands, Score.replay(hands), "w2sm2")
+        reader = ResultsSQLite(path)
+        reader_hands = reader.existing_results()
+        assert reader.existing_checkpoint()[-1]["hand_count"] == len(hands)
+        assert game_score(reader, reader_hands).game_version == reader.game_version()
+        # a reader in another thread is not blocked by a write in progress
+        result_storage.connection.execute("BEGIN IMMEDIATE")
+        result_storage.connection.execute("UPDATE games SET version = version + 1")
+        loaded = []
+        thread = threading.Thread(target=lambda: loaded.append(reader.existing_results()))
+        thread.start()
+        thread.join()
+        result_storage.connection.execute("ROLLBACK")
+        assert loaded == [hands]
+
+
+def test_results_file_artifacts():
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsFile(dir, journal=True, artifacts=True)
+        hands = result_storage.new_results()
+        assert result_storage.existing_artifact(TEXT_ARTIFACT_SUFFIX) == None
+        for bid in ["w3sm3", "t4hm4", "w2nm2"]:
+            apply_bid(result_storage, hands, game_score(result_storage, hands), bid)
+            assert result_storage.existing_artifact(TEXT_ARTIFACT_SUFFIX).decode() == score_str(hands)
+        rs = rubbers(hands)
+        assert json.loads(result_storage.existing_artifact(JSON_ARTIFACT_SUFFIX)) == json.loads(rubbers_str(rs, render.JSON))
+        assert json.loads(result_storage.existing_artifact(TOTALS_ARTIFACT_SUFFIX)) == {
+            "hands": 3,
+            "rubbers": len(rs),
+            "we": sum(r.total[0] for r in rs),
+            "they": sum(r.total[1] for r in rs),
+        }
+        # an artifact older than the game, left by a store without artifacts, is not used
+        time.sleep(0.01)
+        plain_storage = ResultsFile(dir)
+        hands = plain_storage.existing_results()
+        hands.append(bid_parse("t1cm1"))
+        plain_storage.store_results(hands)
+        assert result_storage.existing_artifact(TEXT_ARTIFACT_SUFFIX) == None
+        # the artifacts are not games
+        assert result_storage.catalog.rebuild() == [result_storage.hands_path.name]
+        assert result_storage.catalog.drift() == ([], [])
+
+
+def test_score_cache_artifacts(local_cos):
+    bucket_storage = local_cos()
+    result_storage = ResultsCOS(
+        bucket_storage.bucket_name,
+        LOCAL_API_KEY,
+        LOCAL_INSTANCE_ID,
+        bucket_storage.endpoint_url,
+        artifacts=True,
+    )
+    hands = result_storage.new_results()
+    hands.append(bid_parse("w3sm3"))
+    result_storage.store_results(hands)
+    key = result_storage.key
+    assert list(result_storage.game_names()) == [key]
+    text = result_storage.bucket.Object(key=artifact_name(key, TEXT_ARTIFACT_SUFFIX)).get()
+    assert text["ContentType"] == "text/plain"
+    assert text["Body"].read().decode() == score_str(hands)
+    # the score is read from the artifact, the game is not loaded or scored
+    cache = ScoreCache()
+    loads = metrics.SPAN_SECONDS.count(span=metrics.DECODE)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert metrics.SPAN_SECONDS.count(span=metrics.DECODE) == loads
+    hands.append(bid_parse("t2hm4"))
+    result_storage.store_results(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (1, 2)
+    # a store without artifacts leaves the artifact of the previous version, it is not used
+    old_hands, old_etag = list(hands), result_storage.etag
+    plain_storage = ResultsCOS(bucket_storage.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, bucket_storage.endpoint_url)
+    hands = plain_storage.existing_results()
+    hands.append(bid_parse("w1nm1"))
+    plain_storage.store_results(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert cache.score_str(result_storage) == score_str(hands)
+    assert (cache.hits, cache.misses) == (2, 3)
+    # an artifact published out of order, for an older version of the game, is not used
+    result_storage.publish_artifacts(key, old_hands, old_etag)
+    assert ScoreCache().score_str(result_storage) == score_str(hands)
+    # a game stored without artifacts is scored
+    result_storage.bucket.Object(key=artifact_name(key, TEXT_ARTIFACT_SUFFIX)).delete()
+    assert ScoreCache().score_str(result_storage) == score_str(hands)
+
+
+def test_async_results():
+    with tempfile.TemporaryDirectory() as dir:
+        async_storage = AsyncResults(ResultsFile(dir))
+
+        async def run():
+            hands = await async_storage.new_results()
+            hands.append(bid_parse("w3sm3"))
+            await async_storage.store_results(hands)
+            # concurrent reads share one read of the game, each gets its own list
+            loaded = await asyncio.gather(*[async_storage.existing_results() for i in range(5)])
+            assert loaded == [hands] * 5
+            assert async_storage.reads == 1
+            assert len(set(id(hands) for hands in loaded)) == 5
+            loaded[0].append(bid_parse("t2hm2"))
+            await async_storage.store_results(loaded[0])
+            assert await async_storage.existing_results() == loaded[0]
+            assert async_storage.reads == 2
+            assert await async_storage.game_names() == [async_storage.result_storage.hands_path.name]
+
+        asyncio.run(run())
+
+
+def test_write_behind(local_cos):
+    remote = local_cos()
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsWriteBehind(dir, remote)
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w3sm3")
+        # the bid is only on the local disk until it is flushed
+        assert list(remote.game_names()) == []
+        assert result_storage.pending() == 1
+        assert result_storage.flush() == 1
+        assert result_storage.pending() == 0
+        key = result_storage.key
+        assert remote.get_latest_result_object() == key
+        assert remote.existing_version(key)[1] == hands
+        # a bid entered by someone else is rebased
+        other = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+        other_hands = other.existing_results()
+        other_hands.append(bid_parse("t2hm2"))
+        other.store_results(other_hands)
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w1nm1")
+        result_storage.flush()
+        expected = [bid_parse("w3sm3"), bid_parse("t2hm2"), bid_parse("w1nm1")]
+        assert ResultsWriteBehind(dir, remote).existing_results() == expected
+        assert remote.existing_version(key)[1] == expected
+        # a push that fails is left for the next flush, games are pushed in order
+        store_results = remote.store_results
+        remote.store_results = lambda hands, push_id=None: 1 / 0
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "t4sm4")
+        with pytest.raises(ZeroDivisionError):
+            result_storage.flush(retries=1, backoff=0)
+        time.sleep(1)  # games are named for the second they were created
+        hands = result_storage.new_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w2dm2")
+        assert result_storage.pending() == 2
+
+        # the store reaches COS but the flush is interrupted before it is recorded
+        def store_and_fail(hands, push_id=None):
+            remote.store_results = store_results
+            store_results(hands, push_id)
+            raise ConnectionError()
+
+        remote.store_results = store_and_fail
+        with pytest.raises(ConnectionError):
+            result_storage.flush(retries=0)
+        assert result_storage.flush() == 2
+        assert [key for key, hands in result_storage.flushed] == [key, result_storage.key]
+        assert result_storage.verify() == []
+        assert remote.existing_version(key)[1] == expected + [bid_parse("t4sm4")]
+        assert remote.existing_results() == [bid_parse("w2dm2")]
+        assert remote.get_latest_result_object() == result_storage.key
+        # sync
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "t1sm1")
+        result = CliRunner().invoke(
+            sync_cli,
+            ["-r", remote.bucket_name, "-k", LOCAL_API_KEY, "-i", LOCAL_INSTANCE_ID, "-e", remote.endpoint_url, "--cache", dir],
+        )
+        assert result.exit_code == 0
+        assert result.output == "pushed 1 verified 1 pending 0 latest {}\n".format(result_storage.key)
+        assert remote.existing_results() == [bid_parse("w2dm2"), bid_parse("t1sm1")]
+        # the command line prints the score and then pushes the bid
+        result = CliRunner().invoke(
+            click_cli,
+            ["-r", remote.bucket_name, "-k", LOCAL_API_KEY, "-i", LOCAL_INSTANCE_ID, "-e", remote.endpoint_url, "--cache", dir, "w4hm4"],
+        )
+        assert result.exit_code == 0
+        expected = [bid_parse("w2dm2"), bid_parse("t1sm1"), bid_parse("w4hm4")]
+        assert score_str(expected) in result.output
+        assert remote.existing_results() == expected
+
+
+def test_write_behind_interrupted_push(local_cos):
+    remote = local_cos()
+    other = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsWriteBehind(dir, remote)
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w3sm3")
+        result_storage.flush()
+        key = result_storage.key
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "t2hm2")
+        other_hands = other.existing_results()
+        other_hands.append(bid_parse("w1nm1"))
+        other.store_results(other_hands)
+        store_results = remote.store_results
+
+        # the rebased store reaches COS but the process dies before the state is written
+        def store_and_die(hands, push_id=None):
+            store_results(hands, push_id)
+            result_storage.write_state = lambda state: 1 / 0
+
+        remote.store_results = store_and_die
+        with pytest.raises(ZeroDivisionError):
+            result_storage.flush(retries=0)
+        remote.store_results = store_results
+        expected = [bid_parse("w3sm3"), bid_parse("w1nm1"), bid_parse("t2hm2")]
+        assert remote.existing_version(key)[1] == expected
+        # the push is found in COS and is not applied again, a bid stored in the cache since is pushed
+        result_storage = ResultsWriteBehind(dir, remote)
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w4nm4")
+        assert result_storage.flush() == 1
+        expected.append(bid_parse("w4nm4"))
+        assert remote.existing_version(key)[1] == expected
+        assert result_storage.existing_results() == expected
+        # the push is found after a bid stored by someone else on top of it
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "t1cm1")
+        remote.store_results = store_and_die
+        with pytest.raises(ZeroDivisionError):
+            result_storage.flush(retries=0)
+        remote.store_results = store_results
+        other_hands = other.existing_results()
+        other_hands.append(bid_parse("w2dm2"))
+        other.store_results(other_hands)
+        result_storage = ResultsWriteBehind(dir, remote)
+        assert result_storage.flush() == 1
+        expected += [bid_parse("t1cm1"), bid_parse("w2dm2")]
+        assert remote.existing_version(key)[1] == expected
+        assert result_storage.pending() == 0
+
+
+def test_archive(local_cos, monkeypatch):
+    remote = local_cos()
+    games = {}
+    for day in range(1, 6):
+        key = "2020-01-{:02d}-12-00-00{}".format(day, ".bpk" if day == 2 else ".json")
+        games[key] = random_hands(day * 10, seed=day)
+        remote.bucket.Object(key=key).put(Body=hands_to_bytes(key, games[key]))
+    keys = sorted(games)
+    remote.bucket.Object(key=checkpoint_name(keys[0])).put(Body="{}")
+    remote.store_latest_result_object(keys[-1])
+    args = ["-r", remote.bucket_name, "-k", LOCAL_API_KEY, "-i", LOCAL_INSTANCE_ID, "-e", remote.endpoint_url]
+    result = CliRunner().invoke(archive_cli, args)
+    assert result.exit_code == 0
+    assert result.output.startswith("archived {}\n".format(keys[0]))
+    # the archived games, their checkpoints and artifacts are deleted
+    objects = sorted(object_summary.key for object_summary in remote.bucket.objects.all())
+    assert len(objects) == 3
+    assert objects[0] == keys[-1]
+    assert objects[1].startswith("archive-")
+    assert objects[2] == LATEST_KEY
+    # the archived games are listed and read as before, one ranged GET per game once the index is read
+    reader = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+    assert list(reader.game_names()) == keys
+    ranges = []
+    read_range = reader.read_range
+    monkeypatch.setattr(reader, "read_range", lambda *args: ranges.append(args) or read_range(*args))
+    for key in keys:
+        assert reader.load_game(key) == games[key]
+    assert len(ranges) == len(keys) - 1
+    assert reader.existing_results() == games[keys[-1]]
+    # a long index is read with a second ranged GET, a storage that has not listed finds the archive
+    monkeypatch.setattr(sys.modules["bridgepy.cos"], "ARCHIVE_TAIL", 32)
+    reader = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+    assert reader.load_game(keys[1]) == games[keys[1]]
+    assert CliRunner().invoke(archive_cli, args).output == "no games to archive\n"
+
+
+def test_archive_stored_games(local_cos, monkeypatch):
+    remote = local_cos()
+    with tempfile.TemporaryDirectory() as dir:
+        result_storage = ResultsWriteBehind(dir, remote)
+        hands = result_storage.existing_results()
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "w3sm3")
+        result_storage.flush()
+        cached_key = result_storage.key
+        apply_bid(result_storage, hands, game_score(result_storage, hands), "t2hm2")
+        games = {}
+        for day in range(1, 4):
+            key = "2020-01-{:02d}-12-00-00.json".format(day)
+            games[key] = random_hands(day * 10, seed=day)
+            remote.bucket.Object(key=key).put(Body=hands_to_bytes(key, games[key]))
+        remote.bucket.Object(key="2099-01-01-12-00-00.json").put(Body=hands_to_bytes("2099-01-01-12-00-00.json", []))
+        remote.store_latest_result_object("2099-01-01-12-00-00.json")
+        keys = sorted(games)
+        writer = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+        writer.loaded(keys[1], *writer.existing_version(keys[1])[:2])
+        # a game stored after it was read by archive() is kept
+        read_archive_index = remote.read_archive_index
+
+        def store_and_read(archive_key):
+            games[keys[0]] = games[keys[0]] + [bid_parse("w1nm1")]
+            remote.bucket.Object(key=keys[0]).put(Body=hands_to_bytes(keys[0], games[keys[0]]))
+            return read_archive_index(archive_key)
+
+        monkeypatch.setattr(remote, "read_archive_index", store_and_read)
+        archive_key, archived, kept = remote.archive()
+        assert archived == keys[1:] + [cached_key]
+        assert kept == keys[:1]
+        reader = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+        assert reader.load_game(keys[0]) == games[keys[0]]
+        assert list(reader.game_names()) == keys + [cached_key, "2099-01-01-12-00-00.json"]
+        # a store to an archived game stores it again
+        assert result_storage.flush() == 1
+        assert reader.existing_version(cached_key)[1] == [bid_parse("w3sm3"), bid_parse("t2hm2")]
+        hands = list(games[keys[1]])
+        hands.append(bid_parse("w4sm4"))
+        writer.store_results(hands)
+        assert keys[1] in list(reader.game_names())
+        assert reader.load_game(keys[1]) == games[keys[1]] + [bid_parse("w4sm4")]
+
+
+def test_bucket(local_cos):
+    endpoint_url = local_cos().endpoint_url
+    args = ["-r", "bridgepy-test-bucket", "-e", endpoint_url]
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as dir:
+        creds = os.path.join(dir, "creds.json")
+        with open(creds, "w") as f:
+            json.dump({"apikey": LOCAL_API_KEY, "resource_instance_id": LOCAL_INSTANCE_ID}, f)
+        result = runner.invoke(bucket_cli, args + ["--creds", creds])
+    assert result.exit_code == 0, result.output
+    assert result.output == "bucket created bridgepy-test-bucket\n"
+    result = runner.invoke(bucket_cli, args + ["-k", LOCAL_API_KEY, "-i", LOCAL_INSTANCE_ID])
+    assert result.output == "bucket exists bridgepy-test-bucket\n"
+
+
+def test_sync_directory(local_cos, monkeypatch):
+    remote = local_cos()
+    games = {}
+    with tempfile.TemporaryDirectory() as dir:
+        for day in range(1, 4):
+            name = "2020-01-{:02d}-12-00-00.json".format(day)
+            games[name] = random_hands(day * 10, seed=day)
+            (Path(dir) / name).write_bytes(hands_to_bytes(name, games[name]))
+        # the bids in a journal are synced too
+        journal_storage = ResultsFile(dir, journal=True)
+        hands = journal_storage.existing_results()
+        apply_bid(journal_storage, hands, game_score(journal_storage, hands), "w3sm3")
+        games[name] = hands
+        for day in range(4, 6):
+            key = "2020-01-{:02d}-12-00-00.bpk".format(day)
+            games[key] = random_hands(day * 10, seed=day)
+            remote.bucket.Object(key=key).put(Body=hands_to_bytes(key, games[key]))
+        args = ["-r", remote.bucket_name, "-k", LOCAL_API_KEY, "-i", LOCAL_INSTANCE_ID, "-e", remote.endpoint_url, "--dir", dir]
+        # an upload that fails is retried by the next sync, the others are not transferred again
+        put_object = remote.client.put_object
+
+        def fail_put(**kwargs):
+            if kwargs["Key"] == "2020-01-02-12-00-00.json":
+                raise ConnectionError()
+            return put_object(**kwargs)
+
+        monkeypatch.setattr(remote.client, "put_object", fail_put)
+        result = CliRunner().invoke(sync_cli, args + ["-j", "2", "--max-in-flight", "100"])
+        assert result.exit_code == 1
+        assert "failed 2020-01-02-12-00-00.json" in result.output
+        # the checkpoint of the journal game is uploaded with the games
+        assert "uploaded 3 downloaded 2 same 0" in result.output
+        monkeypatch.setattr(remote.client, "put_object", put_object)
+        result = CliRunner().invoke(sync_cli, args)
+        assert result.exit_code == 0
+        assert result.output.startswith("upload 2020-01-02-12-00-00.json ")
+        assert "uploaded 1 downloaded 0 same 5 conflicts 0 failed 0" in result.output
+        assert "uploaded 0 downloaded 0 same 6" in CliRunner().invoke(sync_cli, args).output
+        local = ResultsFile(dir)
+        reader = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+        assert list(local.game_names()) == sorted(games)
+        assert list(reader.game_names()) == sorted(games)
+        for name, hands in games.items():
+            assert local.load_game(name) == hands
+            assert reader.load_game(name) == hands
+        assert reader.get_latest_result_object() == "2020-01-05-12-00-00.bpk"
+        # a change is copied from the side it was made on, a change on both sides is a conflict
+        local_name, remote_name = "2020-01-01-12-00-00.json", "2020-01-04-12-00-00.bpk"
+        (Path(dir) / local_name).write_bytes(hands_to_bytes(local_name, games[local_name][:1]))
+        remote.bucket.Object(key=remote_name).put(Body=hands_to_bytes(remote_name, games[remote_name][:1]))
+        result = CliRunner().invoke(sync_cli, args)
+        assert "uploaded 1 downloaded 1 same 4 conflicts 0" in result.output
+        assert reader.load_game(local_name) == games[local_name][:1]
+        assert local.load_game(remote_name) == games[remote_name][:1]
+        (Path(dir) / local_name).write_bytes(hands_to_bytes(local_name, games[local_name][:2]))
+        remote.bucket.Object(key=local_name).put(Body=hands_to_bytes(local_name, games[local_name][:3]))
+        result = CliRunner().invoke(sync_cli, args)
+        assert result.exit_code == 1
+        assert "conflict {}".format(local_name) in result.output
+        result = CliRunner().invoke(sync_cli, args + ["--prefer", "remote"])
+        assert result.exit_code == 0
+        assert local.load_game(local_name) == games[local_name][:3]
+        games[local_name] = games[local_name][:3]
+        games[remote_name] = games[remote_name][:1]
+        # the games archived in the bucket are not uploaded again, the archive is not downloaded
+        archive_key, archived, kept = remote.archive()
+        assert "uploaded 0 downloaded 0 same 5 conflicts 0 failed 0" in CliRunner().invoke(sync_cli, args).output
+        assert sorted(object_summary.key for object_summary in remote.bucket.objects.all()) == sorted([archive_key, "2020-01-05-12-00-00.bpk", LATEST_KEY])
+        assert not any(is_archive_name(path.name) for path in Path(dir).iterdir())
+        # an archived game changed in the directory is uploaded, a game that is only in an archive is downloaded from it
+        (Path(dir) / local_name).write_bytes(hands_to_bytes(local_name, games[local_name][:1]))
+        (Path(dir) / remote_name).unlink()
+        result = CliRunner().invoke(sync_cli, args)
+        assert "uploaded 1 downloaded 1 same 3 conflicts 0" in result.output
+        reader = ResultsCOS(remote.bucket_name, LOCAL_API_KEY, LOCAL_INSTANCE_ID, remote.endpoint_url)
+        assert list(reader.game_names()) == sorted(games)
+        assert reader.load_game(local_name) == games[local_name][:1]
+        assert ResultsFile(dir).load_game(remote_name) == games[remote_name]
+        assert "uploaded 0 downloaded 0 same 5" in CliRunner().invoke(sync_cli, args).output
+        # an upload over an object changed since it was listed is a conflict
+        (Path(dir) / local_name).write_bytes(hands_to_bytes(local_name, games[local_name][:2]))
+
+        def store_and_put(**kwargs):
+            put_object(Bucket=remote.bucket_name, Key=local_name, Body=hands_to_bytes(local_name, games[local_name]))
+            return put_object(**kwargs)
+
+        monkeypatch.setattr(remote.client, "put_object", store_and_put)
+        result = CliRunner().invoke(sync_cli, args)
+        assert result.exit_code == 1
+        assert "uploaded 0 downloaded 0 same 4 conflicts 1" in result.output
+        assert reader.load_game(local_name) == games[local_name]
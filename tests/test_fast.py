@@ -0,0 +1,110 @@
+import asyncio
+import tempfile
+import time
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+from bridgepy import fast, metrics, ResultsFile, ScoreTables, bid_parse, score_str
+
+
+@pytest.fixture
+def client():
+    with tempfile.TemporaryDirectory() as dir:
+        fast.tables = ScoreTables(lambda table: ResultsFile(dir, table=table))
+        yield TestClient(fast.app)
+        fast.tables = None
+
+
+def test_score_service(client):
+    response = client.get("/score")
+    assert response.status_code == 200
+    assert response.text == score_str([])
+    response = client.post("/bid", json={"bid": "w3sm3"})
+    assert response.status_code == 200
+    assert response.json()["total"] == [90, 0]
+    assert client.post("/bid", json={"bid": "t2hm4"}).json()["total"] == [90, 120]
+    assert client.post("/bid", json={"bid": "x"}).status_code == 400
+    hands = [bid_parse("w3sm3"), bid_parse("t2hm4")]
+    assert client.get("/score").text == score_str(hands)
+    assert client.get("/score", params={"format": "json"}).json()["total"] == [90, 120]
+    assert client.get("/score", params={"format": "xml"}).status_code == 400
+    # written through to the storage
+    dir = fast.tables.get(None).service.result_storage.dir
+    assert ResultsFile(dir).existing_results() == hands
+    assert client.post("/undo").json()["total"] == [90, 0]
+    assert ResultsFile(dir).existing_results() == hands[:1]
+
+
+def test_tables(client):
+    assert client.post("/tables/t1/bid", json={"bid": "w3sm3"}).json()["total"] == [90, 0]
+    assert client.post("/tables/t2/bid", json={"bid": "t2hm2"}).json()["total"] == [0, 60]
+    assert client.get("/tables/t1/score", params={"format": "json"}).json()["total"] == [90, 0]
+    assert client.get("/score", params={"format": "json"}).json()["total"] == [0, 0]
+    assert client.post("/tables/t1/undo").json()["total"] == [0, 0]
+    assert client.get("/tables/t2/score", params={"format": "json"}).json()["total"] == [0, 60]
+    assert client.get("/tables/..%2Fx/score").status_code in (400, 404)
+
+
+def test_metrics(client):
+    requests = metrics.REQUESTS.value(method="POST", route="/bid", status=200)
+    stores = metrics.SPAN_SECONDS.count(span=metrics.STORAGE_STORE)
+    assert client.post("/bid", json={"bid": "w3sm3"}).status_code == 200
+    assert client.post("/bid", json={"bid": "x"}).status_code == 400
+    assert metrics.REQUESTS.value(method="POST", route="/bid", status=200) == requests + 1
+    assert metrics.SPAN_SECONDS.count(span=metrics.STORAGE_STORE) == stores + 1
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'bridgepy_requests_total{method="POST",route="/bid",status="400"}' in response.text
+    assert 'bridgepy_span_seconds_bucket{span="storage_store",le="+Inf"}' in response.text
+
+
+def test_cors(client):
+    origin = "https://powellquiring.github.io"
+    response = client.get("/score", headers={"Origin": origin})
+    assert response.headers["access-control-allow-origin"] == origin
+    response = client.get("/score", headers={"Origin": "https://example.com"})
+    assert "access-control-allow-origin" not in response.headers
+
+
+def test_metrics_cancelled():
+    requests = metrics.REQUESTS.value(method="GET", route="unmatched", status=500)
+
+    async def call_next(request):
+        raise asyncio.CancelledError()
+
+    request = fast.fastapi.Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(fast.count_requests(request, call_next))
+    assert metrics.REQUESTS.value(method="GET", route="unmatched", status=500) == requests + 1
+
+
+def test_concurrent_loads():
+    httpx = pytest.importorskip("httpx")
+
+    class SlowResultsFile(ResultsFile):
+        reads = 0
+
+        def existing_results(self):
+            SlowResultsFile.reads += 1
+            time.sleep(0.1)
+            return super().existing_results()
+
+    async def get_scores():
+        transport = httpx.ASGITransport(app=fast.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*[client.get("/score") for i in range(8)])
+
+    with tempfile.TemporaryDirectory() as dir:
+        fast.tables = ScoreTables(lambda table: SlowResultsFile(dir, table=table))
+        try:
+            responses = asyncio.run(get_scores())
+            assert [response.status_code for response in responses] == [200] * 8
+            assert [response.text for response in responses] == [score_str([])] * 8
+            # the reads of the game that is not in memory share one load
+            assert SlowResultsFile.reads == 1
+            assert fast.tables.get(None).loads == 1
+        finally:
+            fast.tables = None